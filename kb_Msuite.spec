@@ -38,6 +38,11 @@ module kb_Msuite {
         thread -  number of threads
         reduced_tree - if set to 1, run checkM with the reduced_tree flag, which will keep memory limited to less than 16gb
         quiet - pass the --quite parameter to checkM, but doesn't seem to work for all subcommands
+
+        dpi, image_type, font_size, width, row_height - options of the bin_qa_plot and dist_plot
+                   subcommands (row_height only applies to bin_qa_plot); defaults are 150 dpi, png,
+                   font size 8, 6.5 inches wide and rows 0.3 inches high.  image_type is one of
+                   eps, pdf, png, ps or svg
     */
     typedef structure {
         string subcommand;
@@ -54,6 +59,12 @@ module kb_Msuite {
         int thread;
         boolean reduced_tree;
         boolean quiet;
+
+        int dpi;
+        string image_type;
+        int font_size;
+        float width;
+        float row_height;
     } CheckMInputParams;
 
 
@@ -66,6 +77,9 @@ module kb_Msuite {
     /*
         input_ref - reference to the input Assembly or BinnedContigs data
                     (could be expanded to include Genome objects as well)
+
+        dpi, image_type, font_size, width, row_height - options of the plots, as for run_checkM;
+                   image_type is png (the default) or svg
     */
     typedef structure {
         string input_ref;
@@ -74,6 +88,12 @@ module kb_Msuite {
 
         boolean save_output_dir;
         boolean save_plots_dir;
+
+        int dpi;
+        string image_type;
+        int font_size;
+        float width;
+        float row_height;
     } CheckMLineageWfParams;
 
     typedef structure {
@@ -86,4 +106,49 @@ module kb_Msuite {
 
 
 
+    /*
+        input_refs - references to the input Assembly or BinnedContigs data; CheckM is run once
+                     over the bins of all of them, with the bin and contig ids of each input
+                     prefixed by input1__, input2__, ..
+
+        dpi, image_type, font_size, width, row_height - options of the plots, as for run_checkM_lineage_wf
+    */
+    typedef structure {
+        list<string> input_refs;
+        string workspace_name;
+
+        boolean save_output_dir;
+        boolean save_plots_dir;
+
+        int dpi;
+        string image_type;
+        int font_size;
+        float width;
+        float row_height;
+    } CheckMLineageWfBatchParams;
+
+    /*
+        report of a single input of a batch run
+    */
+    typedef structure {
+        string input_ref;
+        string report_name;
+        string report_ref;
+    } CheckMLineageWfInputReport;
+
+    /*
+        report_name, report_ref - the combined report, with the summary of all bins and the output files
+        input_reports - a report for every input, in the order of input_refs
+    */
+    typedef structure {
+        string report_name;
+        string report_ref;
+        list<CheckMLineageWfInputReport> input_reports;
+    } CheckMLineageWfBatchResult;
+
+    funcdef run_checkM_lineage_wf_batch(CheckMLineageWfBatchParams params)
+        returns (CheckMLineageWfBatchResult result) authentication required;
+
+
+
 };
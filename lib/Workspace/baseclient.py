@@ -11,6 +11,7 @@ import json as _json
 import requests as _requests
 import random as _random
 import os as _os
+import threading as _threading
 
 try:
     from configparser import ConfigParser as _ConfigParser  # py 3
@@ -21,12 +22,57 @@ try:
     from urllib.parse import urlparse as _urlparse  # py3
 except ImportError:
     from urlparse import urlparse as _urlparse  # py2
+
+try:
+    from http.cookiejar import DefaultCookiePolicy as _CookiePolicy  # py3
+except ImportError:
+    from cookielib import DefaultCookiePolicy as _CookiePolicy  # py2
 import time
 
 _CT = 'content-type'
 _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
 
+# requests sessions shared by all clients of a process, per scheme://host:port and
+# pool size, and the pid of the process they were opened in
+_SESSIONS = dict()
+_SESSIONS_PID = _os.getpid()
+_SESSIONS_LOCK = _threading.Lock()
+
+
+def _reset_sessions():
+    # A forked process must not share sockets with its parent, nor wait on a
+    # lock that a thread of the parent held at the fork.
+    global _SESSIONS, _SESSIONS_PID, _SESSIONS_LOCK
+    _SESSIONS = dict()
+    _SESSIONS_PID = _os.getpid()
+    _SESSIONS_LOCK = _threading.Lock()
+
+
+if hasattr(_os, 'register_at_fork'):  # py 3.7+
+    _os.register_at_fork(after_in_child=_reset_sessions)
+
+
+def _get_session(url, pool_size):
+    # Sessions keep up to pool_size connections per host alive between calls, so
+    # consecutive calls to the same service don't pay for a new TCP and TLS
+    # handshake. They are shared by the clients of every user in the process, so
+    # they never store cookies: each call only sends the headers of its client.
+    if _SESSIONS_PID != _os.getpid():
+        _reset_sessions()
+    parsed = _urlparse(url)
+    key = (parsed.scheme, parsed.netloc, pool_size)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = _requests.Session()
+            session.cookies.set_policy(_CookiePolicy(allowed_domains=[]))
+            adapter = _requests.adapters.HTTPAdapter(pool_connections=1,
+                                                     pool_maxsize=pool_size)
+            session.mount(parsed.scheme + '://', adapter)
+            _SESSIONS[key] = session
+    return session
+
 
 def _get_token(user_id, password, auth_svc):
     # This is bandaid helper function until we get a full
@@ -116,6 +162,12 @@ class BaseClient(object):
     lookup_url - set to true when contacting KBase dynamic services.
     async_job_check_time_ms - the wait time between checking job state for
         asynchronous jobs run with the run_job method.
+    pool_size - the number of connections kept alive per service host, shared
+        by all clients in the process. Default from the KB_CLIENT_POOL_SIZE
+        environment variable, or 10.
+    keep_alive - set to False to open a new connection for every call.
+        Default from the KB_CLIENT_KEEP_ALIVE environment variable (0 or 1),
+        or True.
     '''
     def __init__(
             self, url=None, timeout=30 * 60, user_id=None,
@@ -125,7 +177,9 @@ class BaseClient(object):
             lookup_url=False,
             async_job_check_time_ms=100,
             async_job_check_time_scale_percent=150,
-            async_job_check_max_time_ms=300000):
+            async_job_check_max_time_ms=300000,
+            pool_size=None,
+            keep_alive=None):
         if url is None:
             raise ValueError('A url is required')
         scheme, _, _, _, _, _ = _urlparse(url)
@@ -140,6 +194,12 @@ class BaseClient(object):
         self.async_job_check_time_scale_percent = (
             async_job_check_time_scale_percent)
         self.async_job_check_max_time = async_job_check_max_time_ms / 1000.0
+        if pool_size is None:
+            pool_size = _os.environ.get('KB_CLIENT_POOL_SIZE', 10)
+        self.pool_size = int(pool_size)
+        if keep_alive is None:
+            keep_alive = _os.environ.get('KB_CLIENT_KEEP_ALIVE', '1') != '0'
+        self.keep_alive = keep_alive
         # token overrides user_id and password
         if token is not None:
             self._headers['AUTHORIZATION'] = token
@@ -159,6 +219,8 @@ class BaseClient(object):
                         authdata['user_id'], authdata['password'], auth_svc)
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
+        if self.pool_size < 1:
+            raise ValueError('Pool size must be at least 1')
 
     def _call(self, url, method, params, context=None):
         arg_hash = {'method': method,
@@ -172,9 +234,13 @@ class BaseClient(object):
             arg_hash['context'] = context
 
         body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        if self.keep_alive:
+            post = _get_session(url, self.pool_size).post
+        else:
+            post = _requests.post
+        ret = post(url, data=body, headers=self._headers,
+                   timeout=self.timeout,
+                   verify=not self.trust_all_ssl_certificates)
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
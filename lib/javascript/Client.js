@@ -44,6 +44,19 @@ function kb_Msuite(url, auth, auth_cb, timeout, async_job_check_time_ms, service
         return json_call_ajax(_url, "kb_Msuite.run_checkM_lineage_wf",
             [params], 1, _callback, _errorCallback);
     };
+ 
+     this.run_checkM_lineage_wf_batch = function (params, _callback, _errorCallback) {
+        if (typeof params === 'function')
+            throw 'Argument params can not be a function';
+        if (_callback && typeof _callback !== 'function')
+            throw 'Argument _callback must be a function if defined';
+        if (_errorCallback && typeof _errorCallback !== 'function')
+            throw 'Argument _errorCallback must be a function if defined';
+        if (typeof arguments === 'function' && arguments.length > 1+2)
+            throw 'Too many arguments ('+arguments.length+' instead of '+(1+2)+')';
+        return json_call_ajax(_url, "kb_Msuite.run_checkM_lineage_wf_batch",
+            [params], 1, _callback, _errorCallback);
+    };
   
     this.status = function (_callback, _errorCallback) {
         if (_callback && typeof _callback !== 'function')
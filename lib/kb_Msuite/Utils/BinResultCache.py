@@ -0,0 +1,272 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+from kb_Msuite.Utils.BinShards import MERGEABLE_STORAGE_TABLES, PER_BIN_FOLDERS
+from kb_Msuite.Utils.FilePlacement import link_or_copy
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# files under storage that are cached per bin, the others are cached per run (see BinResultCache)
+PER_BIN_STORAGE_FILES = MERGEABLE_STORAGE_TABLES + [os.path.relpath(f, 'storage') for f in PER_BIN_FOLDERS
+                                                    if f.startswith('storage' + os.sep)]
+
+
+def checkm_data_version(data_root='/data/checkm_data'):
+    '''
+    Returns a short fingerprint of the installed CheckM reference data, based on the data
+    manifest written by 'checkm data update', or None if no manifest can be found
+    '''
+    manifest = os.path.join(data_root, '.dmanifest')
+    if not os.path.isfile(manifest):
+        return None
+    return _sha256_file(manifest)[:16]
+
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BinResultCache(object):
+    '''
+    Persistent on-disk cache of the lineage_wf results of single bins.  Entries are keyed on
+    the SHA-256 of the bin FASTA file, the CheckM data version and the options that change the
+    result (eg reduced_tree), so a bin is only sent to checkm again if any of those changed.
+
+    An entry holds the rows of the bin in the storage tables and lineage.ms (without the bin
+    id, so a cached bin can be restored under a different name) and a copy of the per-bin
+    folders that the plotting commands read.
+
+    The other storage files of a run (eg the reference tree and the hmm info) hold all the bins of
+    the run, so they are kept per run, keyed on the ids and keys of its bins.  They are only
+    restored for a run over the very same bins: if all bins are cached but not as a single run,
+    they are all sent to checkm again.
+    '''
+
+    def __init__(self, cache_dir, data_version, options):
+        self.cache_dir = cache_dir
+        self.fingerprint = '|'.join([str(data_version)] +
+                                    [k + '=' + str(options[k]) for k in sorted(options)])
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+    def bin_key(self, bin_file):
+        return hashlib.sha256((_sha256_file(bin_file) + '|' + self.fingerprint).encode('utf-8')).hexdigest()
+
+
+    def split_cached_bins(self, bin_folder, uncached_bin_folder, extension='fna'):
+        '''
+        Looks up every bin of bin_folder in the cache.  Bins without a cache entry are hard
+        linked into uncached_bin_folder (which is recreated).
+
+        returns a dict of bin id to cache key of every bin, and the list of cached bin ids
+        '''
+        shutil.rmtree(uncached_bin_folder, ignore_errors=True)
+        os.makedirs(uncached_bin_folder)
+
+        bin_keys = {}
+        cached = []
+        for f in sorted(os.listdir(bin_folder)):
+            bin_file = os.path.join(bin_folder, f)
+            if not os.path.isfile(bin_file) or not f.endswith('.' + extension):
+                continue
+            bin_id = f[:-len(extension) - 1]
+            bin_keys[bin_id] = self.bin_key(bin_file)
+            if os.path.isdir(self._entry_dir(bin_keys[bin_id])):
+                cached.append(bin_id)
+            else:
+                link_or_copy(bin_file, os.path.join(uncached_bin_folder, f))
+
+        log('Found ' + str(len(cached)) + ' of ' + str(len(bin_keys)) + ' bins in the CheckM result cache')
+        if cached and len(cached) == len(bin_keys) and not os.path.isdir(self._run_dir(bin_keys)):
+            log('The reference tree of these bins is not cached, running all of them again')
+            for bin_id in cached:
+                f = bin_id + '.' + extension
+                link_or_copy(os.path.join(bin_folder, f), os.path.join(uncached_bin_folder, f))
+            cached = []
+        return bin_keys, cached
+
+
+    def store(self, out_folder, bin_keys):
+        '''
+        adds the results in out_folder of every bin of bin_keys (bin id to key) that is not cached yet,
+        and the storage files of the run over these bins
+        '''
+        tables = dict((t, self._read_rows(os.path.join(out_folder, 'storage', t))) for t in MERGEABLE_STORAGE_TABLES)
+        marker_rows = self._read_rows(os.path.join(out_folder, 'lineage.ms'))
+        marker_header = self._read_header(os.path.join(out_folder, 'lineage.ms'))
+
+        stored = 0
+        for bin_id, key in bin_keys.items():
+            entry_dir = self._entry_dir(key)
+            if os.path.isdir(entry_dir) or bin_id not in tables['bin_stats_ext.tsv']:
+                continue
+
+            tmp_dir = os.path.join(self.cache_dir, 'tmp_' + str(uuid.uuid4()))
+            os.makedirs(tmp_dir)
+            entry = {'tables': dict((t, tables[t].get(bin_id, [])) for t in tables),
+                     'lineage.ms': marker_rows.get(bin_id, []),
+                     'lineage.ms header': marker_header}
+            with open(os.path.join(tmp_dir, 'entry.json'), 'w') as f:
+                json.dump(entry, f)
+            for i, per_bin_folder in enumerate(PER_BIN_FOLDERS):
+                src = os.path.join(out_folder, per_bin_folder, bin_id)
+                if os.path.isdir(src):
+                    shutil.copytree(src, os.path.join(tmp_dir, 'folder_' + str(i)))
+
+            if self._rename_entry(tmp_dir, entry_dir):
+                stored += 1
+
+        log('Stored ' + str(stored) + ' bins in the CheckM result cache')
+        self._store_run(out_folder, bin_keys)
+
+
+    def _store_run(self, out_folder, bin_keys):
+        run_dir = self._run_dir(bin_keys)
+        storage = os.path.join(out_folder, 'storage')
+        if os.path.isdir(run_dir) or not os.path.isdir(storage):
+            return
+        tmp_dir = os.path.join(self.cache_dir, 'tmp_' + str(uuid.uuid4()))
+        shutil.copytree(storage, os.path.join(tmp_dir, 'storage'),
+                        ignore=lambda folder, names: PER_BIN_STORAGE_FILES if folder == storage else [])
+        self._rename_entry(tmp_dir, run_dir)
+
+
+    def restore(self, out_folder, bin_keys, bin_ids):
+        '''
+        Adds the cached results of bin_ids to out_folder, as if they had been computed by the
+        lineage_wf run that produced it.  Rows already present for these bins are replaced, so
+        restoring again is harmless.
+        '''
+        entries = {}
+        for bin_id in bin_ids:
+            with open(os.path.join(self._entry_dir(bin_keys[bin_id]), 'entry.json')) as f:
+                entries[bin_id] = json.load(f)
+        if not entries:
+            return
+
+        storage = os.path.join(out_folder, 'storage')
+        if not os.path.isdir(storage):
+            os.makedirs(storage)
+        if len(entries) == len(bin_keys):
+            self._restore_run(storage, bin_keys)
+        for table in MERGEABLE_STORAGE_TABLES:
+            self._replace_rows(os.path.join(storage, table),
+                               dict((b, e['tables'].get(table, [])) for b, e in entries.items()))
+
+        marker_file = os.path.join(out_folder, 'lineage.ms')
+        if not os.path.isfile(marker_file):
+            with open(marker_file, 'w') as f:
+                header = [e['lineage.ms header'] for e in entries.values() if e['lineage.ms header']]
+                if header:
+                    f.write(header[0])
+        self._replace_rows(marker_file, dict((b, e['lineage.ms']) for b, e in entries.items()), keep_header=True)
+
+        for bin_id in bin_ids:
+            entry_dir = self._entry_dir(bin_keys[bin_id])
+            for i, per_bin_folder in enumerate(PER_BIN_FOLDERS):
+                src = os.path.join(entry_dir, 'folder_' + str(i))
+                if not os.path.isdir(src):
+                    continue
+                dest = os.path.join(out_folder, per_bin_folder, bin_id)
+                shutil.rmtree(dest, ignore_errors=True)
+                shutil.copytree(src, dest)
+
+        log('Restored ' + str(len(entries)) + ' bins from the CheckM result cache')
+
+
+    def _restore_run(self, storage, bin_keys):
+        run_storage = os.path.join(self._run_dir(bin_keys), 'storage')
+        if not os.path.isdir(run_storage):
+            return
+        for f in os.listdir(run_storage):
+            src = os.path.join(run_storage, f)
+            dest = os.path.join(storage, f)
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            if os.path.isdir(src):
+                shutil.copytree(src, dest)
+            else:
+                shutil.copy2(src, dest)
+        log('Restored the storage files of the run from the CheckM result cache')
+
+
+    def _rename_entry(self, tmp_dir, entry_dir):
+        ''' moves tmp_dir to entry_dir, returns False if another job stored the entry in the meantime '''
+        if not os.path.isdir(os.path.dirname(entry_dir)):
+            try:
+                os.makedirs(os.path.dirname(entry_dir))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            os.rename(tmp_dir, entry_dir)
+            return True
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+
+    def _run_dir(self, bin_keys):
+        run_key = hashlib.sha256(''.join(b + '\t' + bin_keys[b] + '\n' for b in sorted(bin_keys)).encode('utf-8'))
+        return os.path.join(self.cache_dir, 'runs', run_key.hexdigest())
+
+
+    def _read_rows(self, path):
+        ''' returns bin id -> list of the rest of each row (without the bin id) '''
+        rows = {}
+        if not os.path.isfile(path):
+            return rows
+        with open(path) as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                bin_id, _, rest = line.partition('\t')
+                rows.setdefault(bin_id, []).append(rest.rstrip('\n'))
+        return rows
+
+
+    def _read_header(self, path):
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            first = f.readline()
+        return first if first.startswith('#') else None
+
+
+    def _replace_rows(self, path, rows, keep_header=False):
+        lines = []
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    if keep_header and line.startswith('#'):
+                        lines.append(line)
+                    elif line.strip() and line.partition('\t')[0] not in rows:
+                        lines.append(line)
+        for bin_id in sorted(rows):
+            for rest in rows[bin_id]:
+                lines.append(bin_id + '\t' + rest + '\n')
+        with open(path, 'w') as f:
+            f.writelines(lines)
@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+
+from kb_Msuite.Utils.FilePlacement import link_or_copy
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# storage tables of a lineage_wf run that hold one or more rows per bin, and so can be merged
+# by concatenation
+MERGEABLE_STORAGE_TABLES = ['bin_stats_ext.tsv',
+                            'bin_stats.analyze.tsv',
+                            'bin_stats.tree.tsv',
+                            'marker_gene_stats.tsv']
+
+# folders of a lineage_wf run that have one subfolder per bin
+PER_BIN_FOLDERS = ['bins', os.path.join('storage', 'aai_qa')]
+
+
+def split_bin_folder(bin_folder, shard_root, n_shards, extension='fna'):
+    '''
+    Splits the bins in bin_folder into at most n_shards folders under shard_root, balancing
+    the shards by file size.  Bins are hard linked into the shard folders.
+
+    returns the list of shard folders, eg [shard_root/shard_0/bins, shard_root/shard_1/bins]
+    '''
+    bins = []
+    for f in os.listdir(bin_folder):
+        path = os.path.join(bin_folder, f)
+        if os.path.isfile(path) and f.endswith('.' + extension):
+            bins.append((os.path.getsize(path), f))
+    if not bins:
+        raise ValueError('No bins with extension .' + extension + ' found in ' + bin_folder)
+
+    n_shards = max(1, min(int(n_shards), len(bins)))
+    shards = [{'size': 0, 'bins': []} for _ in range(n_shards)]
+    # largest bins first, always to the smallest shard
+    for size, f in sorted(bins, reverse=True):
+        shard = min(shards, key=lambda s: s['size'])
+        shard['size'] += size
+        shard['bins'].append(f)
+
+    shard_folders = []
+    for i, shard in enumerate(shards):
+        shard_folder = os.path.join(shard_root, 'shard_' + str(i), 'bins')
+        os.makedirs(shard_folder)
+        for f in shard['bins']:
+            link_or_copy(os.path.join(bin_folder, f), os.path.join(shard_folder, f))
+        shard_folders.append(shard_folder)
+    return shard_folders
+
+
+def page_bin_folder(bin_folder, page_root, page_size, extension='fna'):
+    '''
+    Splits the bins in bin_folder, in order of their names, into folders of page_size bins under
+    page_root.  Bins are hard linked into the page folders.
+
+    returns a list of (page folder, bin ids) for every page, eg [(page_root/page_1/bins, [..]), ..]
+    '''
+    bins = sorted(f for f in os.listdir(bin_folder)
+                  if f.endswith('.' + extension) and os.path.isfile(os.path.join(bin_folder, f)))
+    if not bins:
+        raise ValueError('No bins with extension .' + extension + ' found in ' + bin_folder)
+
+    page_size = max(1, int(page_size))
+    pages = []
+    for start in range(0, len(bins), page_size):
+        page_folder = os.path.join(page_root, 'page_' + str(len(pages) + 1), 'bins')
+        os.makedirs(page_folder)
+        for f in bins[start:start + page_size]:
+            link_or_copy(os.path.join(bin_folder, f), os.path.join(page_folder, f))
+        pages.append((page_folder, [f[:-len(extension) - 1] for f in bins[start:start + page_size]]))
+    return pages
+
+
+NAMESPACE_SEPARATOR = '__'
+
+
+def namespace_bin_folder(bin_folder, dest_folder, namespace, extension='fna'):
+    '''
+    Copies the bins of bin_folder into dest_folder with namespace prefixed to the bin ids and to
+    every contig id, eg bin.001.fna with contig_1 becomes <namespace>__bin.001.fna with
+    <namespace>__contig_1, so the bins of several inputs can be put through checkm together.
+
+    returns the list of namespaced bin ids
+    '''
+    prefix = namespace + NAMESPACE_SEPARATOR
+    if not os.path.isdir(dest_folder):
+        os.makedirs(dest_folder)
+    bin_ids = []
+    for f in sorted(os.listdir(bin_folder)):
+        src = os.path.join(bin_folder, f)
+        if not os.path.isfile(src) or not f.endswith('.' + extension):
+            continue
+        with open(src) as fin, open(os.path.join(dest_folder, prefix + f), 'w') as fout:
+            for line in fin:
+                fout.write('>' + prefix + line[1:] if line.startswith('>') else line)
+        bin_ids.append(prefix + f[:-len(extension) - 1])
+    return bin_ids
+
+
+def merge_lineage_wf_outputs(shard_out_folders, out_folder):
+    '''
+    Merges the output folders of lineage_wf runs over disjoint sets of bins into out_folder,
+    so that it can be read by bin_qa_plot, dist_plot and OutputBuilder as if it had been
+    produced by a single run.  Files are moved out of the shard output folders.
+
+    The reference tree of each shard is kept under storage/tree/shard_<i>, since trees of
+    different runs cannot be merged.  Other storage files are taken from the first shard.
+    '''
+    storage = os.path.join(out_folder, 'storage')
+    os.makedirs(storage)
+
+    # row based tables are concatenated
+    for table in MERGEABLE_STORAGE_TABLES:
+        _concat_files([os.path.join(s, 'storage', table) for s in shard_out_folders],
+                      os.path.join(storage, table))
+
+    # the marker file has a single header line followed by a line per bin
+    _concat_files([os.path.join(s, 'lineage.ms') for s in shard_out_folders],
+                  os.path.join(out_folder, 'lineage.ms'), keep_header=True)
+
+    # per bin folders are moved over
+    for per_bin_folder in PER_BIN_FOLDERS:
+        dest_folder = os.path.join(out_folder, per_bin_folder)
+        for s in shard_out_folders:
+            src_folder = os.path.join(s, per_bin_folder)
+            if not os.path.isdir(src_folder):
+                continue
+            if not os.path.isdir(dest_folder):
+                os.makedirs(dest_folder)
+            for bin_id in os.listdir(src_folder):
+                os.rename(os.path.join(src_folder, bin_id), os.path.join(dest_folder, bin_id))
+
+    for i, s in enumerate(shard_out_folders):
+        tree = os.path.join(s, 'storage', 'tree')
+        if os.path.isdir(tree):
+            if not os.path.isdir(os.path.join(storage, 'tree')):
+                os.makedirs(os.path.join(storage, 'tree'))
+            os.rename(tree, os.path.join(storage, 'tree', 'shard_' + str(i)))
+
+        shard_storage = os.path.join(s, 'storage')
+        if not os.path.isdir(shard_storage):
+            continue
+        for f in os.listdir(shard_storage):
+            src = os.path.join(shard_storage, f)
+            dest = os.path.join(storage, f)
+            if os.path.isfile(src) and not os.path.exists(dest):
+                os.rename(src, dest)
+
+    log('Merged output of ' + str(len(shard_out_folders)) + ' lineage_wf shards into ' + out_folder)
+
+
+def _concat_files(src_files, dest_file, keep_header=False):
+    found = False
+    with open(dest_file, 'w') as out:
+        for src in src_files:
+            if not os.path.isfile(src):
+                continue
+            skip_header = keep_header and found
+            found = True
+            with open(src) as f:
+                for line_number, line in enumerate(f):
+                    if skip_header and line_number == 0:
+                        continue
+                    out.write(line if line.endswith('\n') else line + '\n')
+    if not found:
+        os.remove(dest_file)
@@ -0,0 +1,236 @@
+import ast
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+
+def parse_stats_value(text):
+    '''
+    Parses the python dict literal that checkm writes after the bin id in its storage tables.
+    checkm only writes numbers, strings without quotes and lists and dicts of those in practice,
+    which are valid JSON once the single quotes are swapped for double quotes; anything else
+    (eg a string with a quote in it, a tuple or nan) goes through ast.literal_eval.
+    '''
+    if '"' not in text and '\\' not in text:
+        try:
+            return json.loads(text.replace("'", '"'))
+        except ValueError:
+            pass
+    return ast.literal_eval(text)
+
+
+# a number, a string without quotes or escapes, or a constant, as written by repr()
+_SCALAR = re.compile(r"(-?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?|'[^'\\]*'|None|True|False)(?=[,}])")
+_CONSTANTS = {'None': None, 'True': True, 'False': False}
+
+
+def _scalar(token):
+    if token.startswith("'"):
+        return token[1:-1]
+    if token in _CONSTANTS:
+        return _CONSTANTS[token]
+    try:
+        return int(token)
+    except ValueError:
+        return float(token)
+
+
+def _extract_fields(text, fields):
+    '''
+    Picks the scalar values of fields out of a dict literal without parsing the rest of it (eg the
+    long marker lists of bin_stats_ext.tsv).  Returns None if one of the fields has a value that
+    is not a scalar, the whole dict must be parsed then.
+    '''
+    row = {}
+    for field in fields:
+        key = "'" + field + "': "
+        pos = text.find(key)
+        if pos < 0:
+            continue
+        match = _SCALAR.match(text, pos + len(key))
+        if not match:
+            return None
+        row[field] = _scalar(match.group(1))
+    return row
+
+
+# exact types, bool is a subclass of int but not a number here
+_INT_TYPES = set([int] + ([long] if sys.version_info[0] == 2 else []))  # noqa: F821
+_NUMBER_TYPES = _INT_TYPES | set([float])
+
+
+class BinStatsTable(object):
+    '''
+    Columnar in-memory table of the rows of a checkm storage table (eg bin_stats_ext.tsv): one
+    entry per bin in bin_ids, and a column per key of the row dicts.  Columns whose values are all
+    numbers are numpy float arrays (nan where a bin has no value), the others are lists (None where
+    a bin has no value).
+
+        ex:
+
+            table = read_stats_table('output/storage/bin_stats_ext.tsv')
+            table.column('Completeness')                # numpy array
+            good = table.filter(table.column('Completeness') > 90).sort_by('Contamination')
+            good.value('marker lineage', 0)
+    '''
+
+    def __init__(self, bin_ids, columns, int_columns=None):
+        self.bin_ids = list(bin_ids)
+        self.columns = columns
+        # numeric columns that only hold integers, returned as int by value() and row()
+        self.int_columns = set(int_columns or [])
+        self._positions = None
+
+
+    @classmethod
+    def from_rows(cls, bin_ids, rows, fields=None):
+        ''' builds the table from a list of row dicts, keeping only fields if given '''
+        if fields is None:
+            fields = []
+            seen = set()
+            for row in rows:
+                for key in row:
+                    if key not in seen:
+                        seen.add(key)
+                        fields.append(key)
+
+        columns = {}
+        int_columns = []
+        for field in fields:
+            values = [row.get(field) for row in rows]
+            types = set(type(v) for v in values)
+            types.discard(type(None))
+            if types and types <= _NUMBER_TYPES:
+                columns[field] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+                if types <= _INT_TYPES:
+                    int_columns.append(field)
+            else:
+                columns[field] = values
+        return cls(bin_ids, columns, int_columns)
+
+
+    def __len__(self):
+        return len(self.bin_ids)
+
+
+    def fields(self):
+        return list(self.columns)
+
+
+    def column(self, field):
+        return self.columns[field]
+
+
+    def index_of(self, bin_id):
+        if self._positions is None:
+            self._positions = dict((b, i) for i, b in enumerate(self.bin_ids))
+        return self._positions[bin_id]
+
+
+    def value(self, field, i):
+        ''' the value of field for the bin at position i, or None if that bin has none '''
+        if field not in self.columns:
+            return None
+        column = self.columns[field]
+        if isinstance(column, np.ndarray):
+            if np.isnan(column[i]):
+                return None
+            return int(column[i]) if field in self.int_columns else float(column[i])
+        return column[i]
+
+
+    def row(self, i):
+        ''' the values of the bin at position i as a dict, without the fields it has no value for '''
+        row = {}
+        for field in self.columns:
+            value = self.value(field, i)
+            if value is not None:
+                row[field] = value
+        return row
+
+
+    def take(self, positions):
+        ''' a new table with the bins at positions, in that order '''
+        positions = np.asarray(positions, dtype=np.intp)
+        columns = {}
+        for field, column in self.columns.items():
+            if isinstance(column, np.ndarray):
+                columns[field] = column[positions]
+            else:
+                columns[field] = [column[i] for i in positions]
+        return BinStatsTable([self.bin_ids[i] for i in positions], columns, self.int_columns)
+
+
+    def filter(self, mask):
+        ''' a new table with the bins where mask (a boolean array over the bins) is true '''
+        return self.take(np.flatnonzero(np.asarray(mask, dtype=bool)))
+
+
+    def select(self, bin_ids):
+        ''' a new table with the given bins that are in this table, in table order '''
+        wanted = set(bin_ids)
+        return self.take([i for i, b in enumerate(self.bin_ids) if b in wanted])
+
+
+    def sort_by(self, field, reverse=False):
+        '''
+        a new table sorted on field (bins without a value last); the sort is stable, so ties keep
+        their current order
+        '''
+        column = self.columns.get(field)
+        if column is None:
+            return self.take(range(len(self)))
+        if isinstance(column, np.ndarray):
+            missing = np.isnan(column)
+            keys = -column if reverse else column
+            order = np.lexsort((np.where(missing, 0, keys), missing))
+        else:
+            present = sorted([i for i, v in enumerate(column) if v is not None],
+                             key=lambda i: column[i], reverse=reverse)
+            order = present + [i for i, v in enumerate(column) if v is None]
+        return self.take(order)
+
+
+def _read_rows(path, fields=None):
+    ''' bin ids and row dicts of a storage table, with only the given fields if fields is set '''
+    bin_ids = []
+    values = []
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                bin_id, _, value = line.rstrip('\n').partition('\t')
+                row = _extract_fields(value, fields) if fields else None
+                bin_ids.append(bin_id)
+                values.append(row if row is not None else parse_stats_value(value))
+    return bin_ids, values
+
+
+def read_stats_table(path, fields=None):
+    '''
+    Reads a checkm storage table with a row of 'bin id<tab>{python dict}' per bin, such as
+    bin_stats_ext.tsv, bin_stats.analyze.tsv or bin_stats.tree.tsv, into a BinStatsTable.
+    Returns an empty table if the file does not exist.
+
+    Giving the fields that are needed is much faster on bin_stats_ext.tsv, since their values can
+    then be picked out of each row without parsing the long marker lists.
+    '''
+    bin_ids, rows = _read_rows(path, fields)
+    return BinStatsTable.from_rows(bin_ids, rows, fields)
+
+
+def read_marker_gene_stats(path):
+    '''
+    Reads storage/marker_gene_stats.tsv, which has a row of 'bin id<tab>{gene id: {marker id:
+    [hit positions]}}' per bin, into a BinStatsTable with the columns 'genes' (the dict of each bin),
+    '# marker genes' (genes with a marker hit) and '# marker hits'.
+    '''
+    bin_ids, genes = _read_rows(path)
+    rows = [{'genes': g,
+             '# marker genes': len(g),
+             '# marker hits': sum(len(markers) for markers in g.values())} for g in genes]
+    return BinStatsTable.from_rows(bin_ids, rows, ['genes', '# marker genes', '# marker hits'])
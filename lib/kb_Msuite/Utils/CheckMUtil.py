@@ -2,13 +2,31 @@
 import time
 import os
 import uuid
-import subprocess
+import json
 import sys
+import threading
+import shutil
+import hashlib
+import tempfile
+
+from multiprocessing.pool import ThreadPool
 
 from KBaseReport.KBaseReportClient import KBaseReport
 
 from kb_Msuite.Utils.DataStagingUtils import DataStagingUtils
-from kb_Msuite.Utils.OutputBuilder import OutputBuilder
+from kb_Msuite.Utils.OutputBuilder import OutputBuilder, QA_PLOT_PAGES_FILE
+from kb_Msuite.Utils.StageGraph import StageGraph
+from kb_Msuite.Utils.Checkpoints import Checkpoints
+from kb_Msuite.Utils.BinShards import split_bin_folder, page_bin_folder, merge_lineage_wf_outputs, namespace_bin_folder
+from kb_Msuite.Utils.FilePlacement import link_or_copy
+from kb_Msuite.Utils.BinResultCache import BinResultCache, checkm_data_version
+from kb_Msuite.Utils.TetraProfiler import compute_tetra_profile
+from kb_Msuite.Utils.FastaConcat import VirtualFasta, fasta_index_path, read_fasta_index
+from kb_Msuite.Utils.ResourceRecorder import ResourceRecorder
+from kb_Msuite.Utils.MemoryAdmission import choose_reduced_tree, tree_placement_failed
+from kb_Msuite.Utils.ProcessSupervisor import CheckMProgress, parse_timeouts, run_supervised
+from kb_Msuite.Utils.ScratchManager import ScratchManager
+from kb_Msuite.Utils.WorkerPool import shared_worker_pool
 
 
 def log(message, prefix_newline=False):
@@ -17,14 +35,86 @@ def log(message, prefix_newline=False):
     sys.stdout.flush()
 
 
+# number of inputs of a batch run that are downloaded at the same time
+MAX_CONCURRENT_STAGING = 4
+
+# options of the plotting commands, used when not given; checkm itself plots at 600 dpi, which takes
+# much longer and for many bins makes bin_qa_plot (a row per bin) run out of memory
+DEFAULT_PLOT_OPTIONS = {'dpi': 150, 'image_type': 'png', 'font_size': 8, 'width': 6.5, 'row_height': 0.3}
+PLOT_OPTIONS = {'bin_qa_plot': ['image_type', 'dpi', 'font_size', 'width', 'row_height'],
+                'dist_plot': ['image_type', 'dpi', 'font_size', 'width']}
+IMAGE_TYPES = ['eps', 'pdf', 'png', 'ps', 'svg']
+# image types that can be shown in the html report
+REPORT_IMAGE_TYPES = ['png', 'svg']
+
+
+class CheckMCommandError(ValueError):
+    ''' a checkm command exited with a non zero exit code '''
+
+    def __init__(self, message, exit_code):
+        super(CheckMCommandError, self).__init__(message)
+        self.exit_code = exit_code
+
+
+class CheckMTimeoutError(CheckMCommandError):
+    ''' a checkm command ran longer than one of the checkm_timeouts and was killed '''
+
+
 class CheckMUtil:
 
     def __init__(self, config):
         self.config = config
         self.callback_url = config['SDK_CALLBACK_URL']
         self.scratch = config['scratch']
+        # the lineage_wf runs in a folder of its own under scratch/jobs, see _start_job
+        self.scratch_root = config['scratch']
         self.threads = config['threads']
+        # 0 or 1, or 'auto' to pick the full tree when there is enough memory for it
         self.reduced_tree = config['reduced_tree']
+        self.full_tree_memory_gb = float(config.get('full_tree_memory_gb', 40))
+        self.reduced_tree_memory_gb = float(config.get('reduced_tree_memory_gb', 16))
+        # set when a checkm run was killed with the full tree and was retried with the reduced tree
+        self.reduced_tree_fallback = False
+        # total number of cpus the stages of a single lineage_wf run may use at the same time; by
+        # default two stages of threads cpus each, so that tetra can run next to lineage_wf
+        self.cpu_budget = int(config.get('cpu_budget', 2 * int(self.threads)))
+        # if more than 1, lineage_wf is run as this many checkm processes over subsets of the bins
+        self.lineage_wf_shards = int(config.get('lineage_wf_shards', 1))
+        # number of checkm dist_plot processes plotting subsets of the bins at the same time
+        self.dist_plot_processes = int(config.get('dist_plot_processes', self.threads))
+        # bin_qa_plot draws a row per bin; above this many bins it is drawn as pages of this many bins
+        self.bin_qa_plot_page_size = int(config.get('bin_qa_plot_page_size', 100))
+        # if set to 1, completed stages of run_checkM_lineage_wf are checkpointed and skipped when
+        # the same input is run again on the same scratch area (eg a restarted async job)
+        self.resume_lineage_wf = str(config.get('resume_lineage_wf', 0)) == '1'
+        # 'native' computes the tetranucleotide signatures in process, 'checkm' runs checkm tetra
+        self.tetra_engine = config.get('tetra_engine', 'native')
+        # 'table', 'paginated' or 'auto', see OutputBuilder
+        self.html_report_mode = config.get('html_report_mode', 'auto')
+        # the full output package keeps the prodigal, HMMER and pplacer intermediates unless set to 0
+        self.package_intermediates = str(config.get('package_intermediates', 1)) == '1'
+        # deflate level (0-9) of the text files of the zipped output packages, plots are always stored
+        self.zip_level = int(config.get('zip_level', 6))
+        # wall time, cpu time and peak memory of every stage and checkm subprocess of this run
+        self.recorder = ResourceRecorder()
+        # step, command or 'total' timeouts of checkm subprocesses, eg 'tree_placement=43200,total=86400'
+        self.step_timeouts = parse_timeouts(config.get('checkm_timeouts', ''))
+        # space the job folders may take up together, and what a new job is expected to need; the bin and
+        # staging caches are not job folders and are not counted, even when they are under scratch
+        self.scratch_manager = ScratchManager(self.scratch_root,
+                                              quota_bytes=float(config.get('scratch_quota_gb', 0)) * 1024 ** 3,
+                                              job_reserve_bytes=float(config.get('scratch_job_reserve_gb', 0)) * 1024 ** 3,
+                                              wait_timeout=float(config.get('scratch_wait_minutes', 60)) * 60,
+                                              max_age=float(config.get('scratch_max_age_hours', 0)) * 3600,
+                                              max_jobs=int(config.get('max_concurrent_jobs', 0)))
+        # if set to 1, the job folders are kept after the job (eg for debugging)
+        self.keep_job_scratch = str(config.get('keep_job_scratch', 0)) == '1'
+        # the JobLog of the running job, see _run_job
+        self.job_log = None
+        # processes that the stages computing in python (native tetra and the plot previews) of all the
+        # jobs of this process share; started here, before the job takes its locks, see shared_worker_pool
+        self.worker_pool = shared_worker_pool(self.threads)
+        self._progress_lock = threading.Lock()
 
 
     def run_checkM_lineage_wf(self, params):
@@ -38,10 +128,31 @@ class CheckMUtil:
         if 'workspace_name' not in params:
             raise ValueError('workspace_name field was not set in params for run_checkM_lineage_wf')
 
+        plot_options = self._plot_options(params, report=True)
+
 
-        # 1) stage input data
-        dsu = DataStagingUtils(self.config)
-        staged_input = dsu.stage_input(params['input_ref'], 'fna')
+        # 1) stage input data; with resume_lineage_wf the job folders are named after the input
+        #    and options instead of the time, so that a restarted job finds the stages that completed
+        if self.resume_lineage_wf:
+            suffix = self._resumable_folder_suffix(DataStagingUtils(self.config).resolve_ref(params['input_ref']),
+                                                   plot_options)
+        else:
+            suffix = self._unique_folder_suffix()
+        return self._run_job(suffix, lambda job: self._run_lineage_wf_job(job, params, plot_options, suffix))
+
+
+    def _run_lineage_wf_job(self, job, params, plot_options, suffix):
+        ''' runs the lineage_wf app in the scratch folder of job, see run_checkM_lineage_wf '''
+        dsu = DataStagingUtils(dict(self.config, scratch=self.scratch))
+        checkpoints = None
+        if self.resume_lineage_wf:
+            checkpoints = Checkpoints(os.path.join(self.scratch, 'checkpoints_' + suffix))
+            log('Checkpoints of this run are kept in ' + checkpoints.checkpoint_dir)
+
+        self.reduced_tree = self._resolve_reduced_tree(checkpoints)
+
+        stage = lambda: dsu.stage_input(params['input_ref'], 'fna', folder_suffix=suffix)
+        staged_input = checkpoints.run('stage_input', stage) if checkpoints else stage()
         input_dir = staged_input['input_dir']
         suffix = staged_input['folder_suffix']
         all_seq_fasta_file = staged_input['all_seq_fasta']
@@ -54,32 +165,428 @@ class CheckMUtil:
         log('Staged input directory: ' + input_dir)
 
 
-        # 2) run the lineage workflow
-        lineage_wf_options = {'bin_folder': input_dir,
+        # 2) run the lineage workflow, plots, packaging and report as a graph of stages so that
+        #    independent steps (eg tetra and lineage_wf) can run at the same time
+        outputBuilder = self._output_builder(output_dir, plots_dir, plot_options)
+
+        graph = StageGraph(self.cpu_budget, checkpoints=checkpoints, recorder=self.recorder)
+        self._add_lineage_stages(graph, job, input_dir, output_dir, suffix)
+        graph.add_stage('tetra', lambda: self.run_tetra(all_seq_fasta_file, tetra_file),
+                        inputs=['all_seq_fasta'], outputs=['tetra_file'], cpus=self.threads, checkpoint=True)
+        graph.add_stage('bin_qa_plot',
+                        lambda: self.run_bin_qa_plot(input_dir, output_dir, plots_dir, plot_options=plot_options),
+                        inputs=['bin_folder', 'checkm_output'], outputs=['bin_qa_plot'], cpus=self.threads,
+                        checkpoint=True)
+        graph.add_stage('dist_plot',
+                        lambda: self.run_dist_plot(input_dir, output_dir, plots_dir, tetra_file,
+                                                   plot_options=plot_options),
+                        inputs=['bin_folder', 'checkm_output', 'tetra_file'], outputs=['dist_plots'],
+                        cpus=self.dist_plot_processes, checkpoint=True)
+        self._add_package_stages(graph, params, outputBuilder, input_dir, ['bin_qa_plot', 'dist_plots'])
+        graph.add_stage('html_report',
+                        lambda: self._build_html_report(outputBuilder, html_dir, params['input_ref']),
+                        inputs=['checkm_output', 'bin_qa_plot', 'dist_plots'], outputs=['html_report'],
+                        cpus=self.threads)
+        graph.add_stage('save_report',
+                        lambda: self._save_report(params, graph.results['package_output'] +
+                                                  graph.results['package_plots'], graph.results['html_report'],
+                                                  message=outputBuilder.files.summary()),
+                        inputs=['output_package', 'plots_package', 'html_report'], outputs=['report'])
+        # a resumed job may skip staging, but builds the lineage stages from the bins
+        self._add_release_stages(graph, job, all_seq_fasta_file, tetra_file, ['bin_qa_plot', 'dist_plots'],
+                                 bin_folders=[] if checkpoints else [input_dir])
+
+        try:
+            return graph.run()['save_report']
+        finally:
+            self._write_timings(suffix)
+
+
+    def run_checkM_lineage_wf_batch(self, params):
+        '''
+        Runs the lineage_wf over a list of Assembly or BinnedContigs objects as a single CheckM run.
+        The bins and contigs of every input are prefixed with a namespace (input1, input2, ..) so
+        that they cannot clash.  A report is saved for every input, and a combined report with the
+        summary of all bins and the output packages is returned along with them.
+        '''
+
+        # 0) validate basic parameters
+        if not params.get('input_refs'):
+            raise ValueError('input_refs field was not set in params for run_checkM_lineage_wf_batch')
+        if 'workspace_name' not in params:
+            raise ValueError('workspace_name field was not set in params for run_checkM_lineage_wf_batch')
+        input_refs = list(params['input_refs'])
+        plot_options = self._plot_options(params, report=True)
+
+
+        # 1) stage all inputs at the same time, then link their namespaced bins into one folder
+        if self.resume_lineage_wf:
+            dsu = DataStagingUtils(self.config)
+            suffix = self._resumable_folder_suffix(','.join([dsu.resolve_ref(r) for r in input_refs]), plot_options)
+        else:
+            suffix = self._unique_folder_suffix()
+        return self._run_job(suffix, lambda job: self._run_lineage_wf_batch_job(job, params, input_refs,
+                                                                                plot_options, suffix))
+
+
+    def _run_lineage_wf_batch_job(self, job, params, input_refs, plot_options, suffix):
+        ''' runs the lineage_wf over input_refs in the scratch folder of job, see run_checkM_lineage_wf_batch '''
+        dsu = DataStagingUtils(dict(self.config, scratch=self.scratch))
+        checkpoints = None
+        if self.resume_lineage_wf:
+            checkpoints = Checkpoints(os.path.join(self.scratch, 'checkpoints_' + suffix))
+            log('Checkpoints of this run are kept in ' + checkpoints.checkpoint_dir)
+        self.reduced_tree = self._resolve_reduced_tree(checkpoints)
+
+        def stage(i):
+            namespace = 'input' + str(i + 1)
+            input_suffix = suffix + '_' + namespace
+
+            def stage_namespaced():
+                staged_input = dsu.stage_input(input_refs[i], 'fna', folder_suffix=input_suffix)
+                bin_folder = os.path.join(self.scratch, 'bins_ns_' + input_suffix)
+                shutil.rmtree(bin_folder, ignore_errors=True)
+                bin_ids = namespace_bin_folder(staged_input['input_dir'], bin_folder, namespace, 'fna')
+                # only the namespaced bins are read from here on
+                job.release(staged_input['input_dir'], *self._fasta_files(staged_input['all_seq_fasta']))
+                return {'input_ref': input_refs[i],
+                        'namespace': namespace,
+                        'bin_folder': bin_folder,
+                        'bin_ids': bin_ids}
+
+            name = 'stage_input_' + namespace
+            return checkpoints.run(name, stage_namespaced) if checkpoints else stage_namespaced()
+
+        pool = ThreadPool(min(len(input_refs), MAX_CONCURRENT_STAGING))
+        try:
+            staged_inputs = pool.map(stage, range(len(input_refs)))
+        finally:
+            pool.close()
+            pool.join()
+
+        input_dir = os.path.join(self.scratch, 'bins_' + suffix)
+        shutil.rmtree(input_dir, ignore_errors=True)
+        os.makedirs(input_dir)
+        for staged_input in staged_inputs:
+            for f in os.listdir(staged_input['bin_folder']):
+                link_or_copy(os.path.join(staged_input['bin_folder'], f), os.path.join(input_dir, f))
+        all_seq_fasta_file = os.path.join(self.scratch, 'all_sequences_' + suffix + '.fna')
+        dsu.virtual_cat_fasta_files(input_dir, 'fna', all_seq_fasta_file)
+        log('Staged ' + str(len(staged_inputs)) + ' inputs into ' + input_dir)
+
+        output_dir = os.path.join(self.scratch, 'output_' + suffix)
+        plots_dir = os.path.join(self.scratch, 'plot_' + suffix)
+        html_dir = os.path.join(self.scratch, 'html_' + suffix)
+        tetra_file = os.path.join(self.scratch, 'tetra_' + suffix + '.tsv')
+
+
+        # 2) a single lineage workflow and tetra run over all bins, then plots and a report per input
+        graph = StageGraph(self.cpu_budget, checkpoints=checkpoints, recorder=self.recorder)
+        self._add_lineage_stages(graph, job, input_dir, output_dir, suffix)
+        graph.add_stage('tetra', lambda: self.run_tetra(all_seq_fasta_file, tetra_file),
+                        inputs=['all_seq_fasta'], outputs=['tetra_file'], cpus=self.threads, checkpoint=True)
+        for staged_input in staged_inputs:
+            self._add_batch_input_stages(graph, params, staged_input, output_dir,
+                                         os.path.join(plots_dir, staged_input['namespace']),
+                                         os.path.join(html_dir, staged_input['namespace']), tetra_file)
+
+        namespaces = [staged_input['namespace'] for staged_input in staged_inputs]
+        outputBuilder = self._output_builder(output_dir, plots_dir, plot_options)
+
+        def combined_html_report():
+            combined_html_dir = os.path.join(html_dir, 'combined')
+            shutil.rmtree(combined_html_dir, ignore_errors=True)
+            os.makedirs(combined_html_dir)
+            self.recorder.write_json(os.path.join(combined_html_dir, 'timings.json'))
+            inputs = []
+            for staged_input in staged_inputs:
+                report = graph.results['save_report_' + staged_input['namespace']]
+                inputs.append(dict(staged_input, report_name=report['report_name']))
+            return outputBuilder.build_html_output_for_lineage_wf_batch(combined_html_dir, inputs,
+                                                                        timings=self.recorder.to_dict())
+
+        self._add_package_stages(graph, params, outputBuilder, input_dir,
+                                 ['dist_plots_' + ns for ns in namespaces] + ['bin_qa_plot_' + ns for ns in namespaces])
+        graph.add_stage('html_report', combined_html_report,
+                        inputs=['checkm_output'] + ['report_' + ns for ns in namespaces], outputs=['html_report'])
+        graph.add_stage('save_report',
+                        lambda: self._save_report(params, graph.results['package_output'] +
+                                                  graph.results['package_plots'], graph.results['html_report'],
+                                                  message=outputBuilder.files.summary()),
+                        inputs=['output_package', 'plots_package', 'html_report'], outputs=['report'])
+        # the bins are linked together again from the namespaced bins when a job is resumed
+        self._add_release_stages(graph, job, all_seq_fasta_file, tetra_file,
+                                 ['dist_plots_' + ns for ns in namespaces] + ['bin_qa_plot_' + ns for ns in namespaces])
+
+        try:
+            result = graph.run()['save_report']
+        finally:
+            self._write_timings(suffix)
+
+        result['input_reports'] = []
+        for staged_input in staged_inputs:
+            report = graph.results['save_report_' + staged_input['namespace']]
+            result['input_reports'].append({'input_ref': staged_input['input_ref'],
+                                            'report_name': report['report_name'],
+                                            'report_ref': report['report_ref']})
+        return result
+
+
+    def _unique_folder_suffix(self):
+        ''' names the folders of a job that is not resumable, unique among the jobs running at the same time '''
+        return str(int(time.time() * 1000)) + '_' + uuid.uuid4().hex[:8]
+
+
+    def _resolve_reduced_tree(self, checkpoints=None):
+        '''
+        Returns the reduced_tree option of the job: 'auto' is decided once the job holds its job
+        slot, on its share of the memory with the jobs that may take the other slots.  The choice
+        is saved with the checkpoints, so that a resumed job goes on with the tree it started with.
+        '''
+        if str(self.reduced_tree) != 'auto':
+            return self.reduced_tree
+        choose = lambda: choose_reduced_tree(self.full_tree_memory_gb, self.reduced_tree_memory_gb,
+                                             n_trees=self.lineage_wf_shards,
+                                             n_jobs=max(1, self.scratch_manager.max_jobs))
+        return checkpoints.run('choose_reduced_tree', choose) if checkpoints else choose()
+
+
+    def _run_job(self, job_id, run):
+        '''
+        Calls run(job) in a scratch folder of its own and with a log of its own (see ScratchManager),
+        once one of the max_concurrent_jobs job slots is free and there is scratch space for it.  A
+        resumed job gets the folder of the earlier run.  The folder is removed afterwards, unless the
+        job failed and can be resumed, or keep_job_scratch is set.
+        '''
+        job = self.scratch_manager.start_job(job_id)
+        self.scratch = job.path
+        self.job_log = job.job_log
+        job.log('Scratch folder of this job: ' + job.path + ', log: ' + job.job_log.path)
+        succeeded = False
+        try:
+            result = run(job)
+            succeeded = True
+        finally:
+            job.finish(keep=self.keep_job_scratch or (not succeeded and self.resume_lineage_wf))
+            self.scratch = self.scratch_root
+            self.job_log = None
+        return result
+
+
+    def _write_timings(self, suffix):
+        '''
+        writes the timings of the stages and checkm subprocesses to the scratch folder of the job,
+        which is removed with it unless the folder is kept (see _run_job)
+        '''
+        timings_file = os.path.join(self.scratch, 'timings_' + suffix + '.json')
+        self.recorder.write_json(timings_file)
+        log('Stage timings written to ' + timings_file)
+        return timings_file
+
+
+    def _add_release_stages(self, graph, job, all_seq_fasta_file, tetra_file, plot_outputs, bin_folders=None):
+        '''
+        Adds the stages that remove intermediates from the scratch folder of the job as soon as the
+        stages reading them are done, rather than when the job ends: the concatenated contigs once
+        tetra ran, the tetra file and bin_folders once the plot_outputs are drawn.
+        '''
+        graph.add_stage('release_all_seq_fasta', lambda: job.release(*self._fasta_files(all_seq_fasta_file)),
+                        inputs=['tetra_file'], cpus=0)
+        graph.add_stage('release_plot_inputs', lambda: job.release(tetra_file, *(bin_folders or [])),
+                        inputs=plot_outputs, cpus=0)
+
+
+    def _fasta_files(self, fasta_file):
+        ''' fasta_file with its index and VirtualFasta manifest, see DataStagingUtils.stage_input '''
+        return [fasta_file, fasta_index_path(fasta_file), VirtualFasta.manifest_path(fasta_file)]
+
+
+    def _add_batch_input_stages(self, graph, params, staged_input, output_dir, plots_dir, html_dir, tetra_file):
+        ''' adds the plots and the report of one input of a batch run, named after its namespace '''
+        ns = staged_input['namespace']
+        bin_folder = staged_input['bin_folder']
+        plot_options = self._plot_options(params, report=True)
+        outputBuilder = self._output_builder(output_dir, plots_dir, plot_options)
+
+        graph.add_stage('bin_qa_plot_' + ns,
+                        lambda: self.run_bin_qa_plot(bin_folder, output_dir, plots_dir, plot_options=plot_options),
+                        inputs=['checkm_output'], outputs=['bin_qa_plot_' + ns], cpus=self.threads, checkpoint=True)
+        graph.add_stage('dist_plot_' + ns,
+                        lambda: self.run_dist_plot(bin_folder, output_dir, plots_dir, tetra_file,
+                                                   plot_options=plot_options),
+                        inputs=['checkm_output', 'tetra_file'], outputs=['dist_plots_' + ns],
+                        cpus=self.dist_plot_processes, checkpoint=True)
+        graph.add_stage('html_report_' + ns,
+                        lambda: self._build_html_report(outputBuilder, html_dir, staged_input['input_ref'],
+                                                        bin_ids=staged_input['bin_ids']),
+                        inputs=['bin_qa_plot_' + ns, 'dist_plots_' + ns], outputs=['html_report_' + ns],
+                        cpus=self.threads)
+        graph.add_stage('save_report_' + ns,
+                        lambda: self._save_report(params, [], graph.results['html_report_' + ns],
+                                                  message=outputBuilder.files.summary()),
+                        inputs=['html_report_' + ns], outputs=['report_' + ns])
+
+
+    def _add_lineage_stages(self, graph, job, bin_folder, output_dir, suffix):
+        '''
+        Adds the stages that leave the lineage_wf output of the bins of bin_folder in output_dir, the
+        last of which produces 'checkm_output'.  Bins found in the result cache are restored from it,
+        only the others are sent to checkm, from a folder of the job that is released afterwards.
+        '''
+        bin_cache = self._get_bin_cache()
+        lineage_bin_folder = bin_folder
+        bin_keys, cached_bins = {}, []
+        if bin_cache:
+            lineage_bin_folder = os.path.join(self.scratch, 'bins_uncached_' + suffix)
+            bin_keys, cached_bins = bin_cache.split_cached_bins(bin_folder, lineage_bin_folder, 'fna')
+
+        lineage_wf_options = {'bin_folder': lineage_bin_folder,
                               'out_folder': output_dir,
                               'thread': self.threads,
-                              'reduced_tree': self.reduced_tree
+                              'reduced_tree': self.reduced_tree,
+                              'shards': self.lineage_wf_shards
                               }
-        self.run_checkM('lineage_wf', lineage_wf_options)
+        lineage_output = 'checkm_new_output' if bin_cache else 'checkm_output'
+        if bin_cache and len(cached_bins) == len(bin_keys):
+            log('All bins were found in the CheckM result cache, not running lineage_wf')
+            lineage_output = None
+        elif self.lineage_wf_shards > 1 or not self.resume_lineage_wf:
+            # its steps only run as stages of their own when a restarted job can skip the completed ones
+            graph.add_stage('lineage_wf', lambda: self.run_checkM('lineage_wf', lineage_wf_options),
+                            inputs=['bin_folder'], outputs=[lineage_output], cpus=self.threads, checkpoint=True)
+        else:
+            self._add_lineage_wf_stages(graph, lineage_wf_options, lineage_output)
+        if bin_cache:
+            graph.add_stage('bin_cache',
+                            lambda: self._update_bin_cache(bin_cache, output_dir, bin_keys, cached_bins),
+                            inputs=[lineage_output] if lineage_output else [], outputs=['checkm_output'],
+                            checkpoint=True)
+            graph.add_stage('release_uncached_bins', lambda: job.release(lineage_bin_folder),
+                            inputs=['checkm_output'], cpus=0)
+
+
+    def _add_lineage_wf_stages(self, graph, options, output_name='checkm_output'):
+        '''
+        Adds the steps that lineage_wf runs internally (tree, lineage_set, analyze and qa) to the
+        graph as separate checkpointed stages, the last of which produces output_name
+        '''
+        bin_folder = options['bin_folder']
+        out_folder = options['out_folder']
+        marker_file = os.path.join(out_folder, 'lineage.ms')
 
+        def tree():
+            # a killed tree run leaves a partial output folder behind, always start from scratch
+            shutil.rmtree(out_folder, ignore_errors=True)
+            self.run_checkM('tree', {'bin_folder': bin_folder,
+                                     'out_folder': out_folder,
+                                     'thread': options.get('thread'),
+                                     'reduced_tree': options.get('reduced_tree')})
 
-        # 3) make the plots:
-        self.build_checkM_lineage_wf_plots(input_dir, output_dir, plots_dir, all_seq_fasta_file, tetra_file)
+        graph.add_stage('tree', tree, inputs=['bin_folder'], outputs=['checkm_tree'],
+                        cpus=self.threads, checkpoint=True)
+        graph.add_stage('lineage_set',
+                        lambda: self.run_checkM('lineage_set', {'out_folder': out_folder,
+                                                                'marker_file': marker_file}),
+                        inputs=['checkm_tree'], outputs=['marker_file'], checkpoint=True)
+        graph.add_stage('analyze',
+                        lambda: self.run_checkM('analyze', {'bin_folder': bin_folder,
+                                                            'out_folder': out_folder,
+                                                            'marker_file': marker_file,
+                                                            'thread': options.get('thread')}),
+                        inputs=['bin_folder', 'marker_file'], outputs=['checkm_analyze'],
+                        cpus=self.threads, checkpoint=True)
+        graph.add_stage('qa',
+                        lambda: self.run_checkM('qa', {'out_folder': out_folder,
+                                                       'marker_file': marker_file,
+                                                       'thread': options.get('thread')}),
+                        inputs=['checkm_analyze'], outputs=[output_name],
+                        cpus=self.threads, checkpoint=True)
 
 
-        # 4) Package results
-        outputBuilder = OutputBuilder(output_dir, plots_dir, self.scratch, self.callback_url)
-        output_packages = self._build_output_packages(params, outputBuilder, input_dir)
+    def _get_bin_cache(self):
+        ''' returns the BinResultCache configured with bin_cache_dir, or None if there is none '''
+        cache_dir = self.config.get('bin_cache_dir')
+        if not cache_dir:
+            return None
+        data_version = checkm_data_version(self.config.get('checkm_data_dir', '/data/checkm_data'))
+        if not data_version:
+            log('Warning! CheckM data version could not be determined, not using the result cache')
+            return None
+        return BinResultCache(cache_dir, data_version, {'reduced_tree': self.reduced_tree})
 
 
-        # 5) build the HTML report
+    def _update_bin_cache(self, bin_cache, output_dir, bin_keys, cached_bins):
+        ''' stores the newly computed bins in the cache, then adds the cached bins to output_dir '''
+        uncached_keys = dict((b, k) for b, k in bin_keys.items() if b not in cached_bins)
+        if uncached_keys and self.reduced_tree_fallback:
+            log('Not storing results in the CheckM result cache, they were computed with the reduced tree ' +
+                'after the full tree run was killed')
+        elif uncached_keys:
+            bin_cache.store(output_dir, uncached_keys)
+        else:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        bin_cache.restore(output_dir, bin_keys, cached_bins)
+
+
+    def _resumable_folder_suffix(self, resolved_ref, plot_options=None):
+        '''
+        folder suffix that only depends on the input object version and the options of the run; the
+        configured reduced_tree, as 'auto' is only resolved in the job (see _resolve_reduced_tree)
+        '''
+        key = '|'.join([resolved_ref, str(self.config['reduced_tree']), str(self.lineage_wf_shards)])
+        if plot_options:
+            key += '|' + json.dumps(plot_options, sort_keys=True)
+        return 'wf_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+    def _output_builder(self, output_dir, plots_dir, plot_options=None):
+        image_type = (plot_options or {}).get('image_type', DEFAULT_PLOT_OPTIONS['image_type'])
+        return OutputBuilder(output_dir, plots_dir, self.scratch, self.callback_url,
+                             report_mode=self.html_report_mode, image_processes=self.threads,
+                             image_type=image_type, zip_level=self.zip_level, image_pool=self.worker_pool)
+
+
+    def _plot_options(self, params, report=False):
+        '''
+        The plot options (dpi, image_type, font_size, width, row_height) set in params, checked.
+        With report set, image_type must be one that the html report can show.
+        '''
+        plot_options = {}
+        for name in DEFAULT_PLOT_OPTIONS:
+            value = params.get(name)
+            if value is None or str(value).strip() == '':
+                continue
+            if name == 'image_type':
+                value = str(value).strip().lower()
+                image_types = REPORT_IMAGE_TYPES if report else IMAGE_TYPES
+                if value not in image_types:
+                    raise ValueError('Invalid image_type "' + value + '", expected one of ' + ', '.join(image_types))
+            else:
+                try:
+                    value = int(value) if name in ('dpi', 'font_size') else float(value)
+                except ValueError:
+                    raise ValueError('Invalid ' + name + ' "' + str(value) + '", expected a number')
+                if value <= 0:
+                    raise ValueError('Invalid ' + name + ' "' + str(value) + '", expected a positive number')
+            plot_options[name] = value
+        return plot_options
+
+
+    def _build_html_report(self, outputBuilder, html_dir, object_name, bin_ids=None):
+        shutil.rmtree(html_dir, ignore_errors=True)
         os.makedirs(html_dir)
-        outputBuilder.build_html_output_for_lineage_wf(html_dir, params['input_ref'])
-        html_zipped = outputBuilder.package_folder(html_dir, 'report.html', 'Summarized report from CheckM')
+        # the timings of the stages finished so far, packaging and saving the report are still running
+        self.recorder.write_json(os.path.join(html_dir, 'timings.json'))
+        return outputBuilder.build_html_output_for_lineage_wf(html_dir, object_name,
+                                                              timings=self.recorder.to_dict(), bin_ids=bin_ids)
 
 
-        # 6) save report
-        report_params = {'message': '',
+    def _save_report(self, params, output_packages, html_zipped, message=''):
+        if self.reduced_tree_fallback:
+            note = ('The full reference tree did not fit in memory, the bins were placed in the reduced ' +
+                    'reference tree instead')
+            message = note + ('\n' + message if message else '')
+        report_params = {'message': message,
                          'direct_html_link_index': 0,
                          'html_links': [html_zipped],
                          'file_links': output_packages,
@@ -94,18 +601,48 @@ class CheckMUtil:
                 'report_ref': report_output['ref']}
 
 
-    def build_checkM_lineage_wf_plots(self, bin_folder, out_folder, plots_folder, all_seq_fasta_file, tetra_file):
+    def build_checkM_lineage_wf_plots(self, bin_folder, out_folder, plots_folder, all_seq_fasta_file, tetra_file,
+                                      plot_options=None):
 
         # first build generic plot for entire dataset
+        self.run_bin_qa_plot(bin_folder, out_folder, plots_folder, plot_options=plot_options)
+
+        # compute tetranucleotide frequencies based on the concatenated fasta file
+        self.run_tetra(all_seq_fasta_file, tetra_file)
+
+        # plot distributions for each bin
+        self.run_dist_plot(bin_folder, out_folder, plots_folder, tetra_file, plot_options=plot_options)
+
+
+    def run_bin_qa_plot(self, bin_folder, out_folder, plots_folder, plot_options=None):
         log('Creating basic QA plot (checkm bin_qa_plot) ...')
         bin_qa_plot_options = {'bin_folder': bin_folder,
                                'out_folder': out_folder,
-                               'plots_folder': plots_folder
+                               'plots_folder': plots_folder,
+                               'page_size': self.bin_qa_plot_page_size
                                }
+        bin_qa_plot_options.update(plot_options or {})
         self.run_checkM('bin_qa_plot', bin_qa_plot_options, dropOutput=True)
 
-        # compute tetranucleotide frequencies based on the concatenated fasta file
+
+    def run_tetra(self, all_seq_fasta_file, tetra_file):
         log('Computing tetranucleotide distributions...')
+        # all_seq_fasta_file may only exist as a VirtualFasta, see DataStagingUtils.stage_input
+        view = VirtualFasta(all_seq_fasta_file) if VirtualFasta.exists(all_seq_fasta_file) else None
+        if self.tetra_engine == 'native':
+            if view:
+                compute_tetra_profile(all_seq_fasta_file, tetra_file, threads=self.threads,
+                                      file_records=view.file_records(), pool=self.worker_pool)
+                return
+            records = None
+            index_file = fasta_index_path(all_seq_fasta_file)
+            if os.path.isfile(index_file):
+                records = [(r['contig_id'], r['seq_start'], r['seq_end']) for r in read_fasta_index(index_file)]
+            compute_tetra_profile(all_seq_fasta_file, tetra_file, threads=self.threads, records=records,
+                                  pool=self.worker_pool)
+            return
+        if view:
+            view.materialize()
         tetra_options = {'seq_file': all_seq_fasta_file,
                          'tetra_file': tetra_file,
                          'thread': self.threads,
@@ -113,54 +650,276 @@ class CheckMUtil:
                          }
         self.run_checkM('tetra', tetra_options, dropOutput=True)
 
-        # plot distributions for each bin
+
+    def run_dist_plot(self, bin_folder, out_folder, plots_folder, tetra_file, plot_options=None):
         log('Creating distribution plots per bin...')
         dist_plot_options = {'bin_folder': bin_folder,
                              'out_folder': out_folder,
                              'plots_folder': plots_folder,
                              'tetra_file': tetra_file,
                              'dist_value': 95,
-                             'quiet': 1
+                             'quiet': 1,
+                             'chunks': self.dist_plot_processes
                              }
+        dist_plot_options.update(plot_options or {})
         self.run_checkM('dist_plot', dist_plot_options, dropOutput=True)
 
 
     def run_checkM(self, subcommand, options, dropOutput=False):
         '''
-            subcommand is the checkm subcommand (eg lineage_wf, tetra, bin_qa_plot)
+            subcommand is the checkm subcommand (eg lineage_wf, tetra, bin_qa_plot, or one of
+            the steps of lineage_wf: tree, lineage_set, analyze, qa)
             options indicate, depending on the subcommand:
                 bin_folder
                 out_folder
                 plots_folder
                 seq_file
                 tetra_file
+                marker_file
 
                 reduced_tree
                 thread
                 dist_value
+                shards (lineage_wf only, see _run_lineage_wf_sharded)
+                chunks (dist_plot only, see _run_dist_plot_chunked)
+                page_size (bin_qa_plot only, see _run_bin_qa_plot_paged)
+
+            tree and lineage_wf return the reduced_tree option the bins were placed with, which is 1
+            when the full tree run failed and was retried with the reduced tree
         '''
+        if subcommand == 'lineage_wf' and int(options.get('shards', 1)) > 1:
+            return self._run_lineage_wf_sharded(options)
+        if subcommand == 'dist_plot' and int(options.get('chunks', 1)) > 1:
+            return self._run_dist_plot_chunked(options)
+        if subcommand == 'bin_qa_plot' and int(options.get('page_size') or 0) > 0:
+            return self._run_bin_qa_plot_paged(options)
+
         command = self._build_command(subcommand, options)
+        if subcommand not in ['tree', 'lineage_wf']:
+            self._run_command(subcommand, command, dropOutput)
+            return
+
+        # pplacer needs a lot of memory for the full tree.  checkm ignores its exit status, so a
+        # pplacer killed by the OOM killer only shows as a missing placement, and checkm carries on
+        error = None
+        try:
+            self._run_command(subcommand, command, dropOutput)
+        except CheckMTimeoutError:
+            raise
+        except CheckMCommandError as e:
+            error = e
+        if not tree_placement_failed(options['out_folder']):
+            if error:
+                raise error
+            return options.get('reduced_tree')
+        if str(options.get('reduced_tree')) == '1':
+            raise CheckMCommandError('pplacer did not place the bins in the reduced reference tree of checkm ' +
+                                     subcommand + ', it may have run out of memory: ' + ' '.join(command),
+                                     error.exit_code if error else 0)
+        log('pplacer did not place the bins in the full reference tree of checkm ' + subcommand +
+            ', most likely it ran out of memory; retrying with the reduced tree')
+        self.reduced_tree_fallback = True
+        shutil.rmtree(options['out_folder'], ignore_errors=True)
+        retry_options = dict(options)
+        retry_options['reduced_tree'] = 1
+        return self.run_checkM(subcommand, retry_options, dropOutput=dropOutput)
+
+
+    def _run_command(self, subcommand, command, dropOutput=False):
         log('Running: ' + ' '.join(command))
 
         log_output_file = None
-        if dropOutput:
+        output_file = None
+        if self.job_log:
+            # the output of every command goes to the log of the job, so that the output of jobs
+            # running at the same time is not mixed; dropped output is not shown in ours
+            self.job_log.message('Running: ' + ' '.join(command))
+            output_file = self.job_log.stream(echo=not dropOutput)
+        elif dropOutput:
             # necessary because the checkM --quiet flag doesn't work on the tetra subcommand,
-            # and that produces a line per contig
-            log_output_file = open(os.path.join(self.scratch, subcommand + '.out'), 'w')
-            p = subprocess.Popen(command, cwd=self.scratch, shell=False, stdout=log_output_file, stderr=subprocess.STDOUT)
-        else:
-            p = subprocess.Popen(command, cwd=self.scratch, shell=False)
-        exitCode = p.wait()
-
-        if log_output_file:
-            log_output_file.close()
+            # and that produces a line per contig.  Every run gets a file of its own, the chunks and
+            # pages of a plot subcommand run at the same time
+            log_output_file = output_file = tempfile.NamedTemporaryFile(mode='w', prefix=subcommand + '_',
+                                                                        suffix='.out', dir=self.scratch,
+                                                                        delete=False)
+        start = time.time()
+        try:
+            result = run_supervised(command, CheckMProgress(subcommand), cwd=self.scratch,
+                                    output_file=output_file, timeouts=self.step_timeouts,
+                                    on_event=self._progress_event)
+        finally:
+            if log_output_file:
+                log_output_file.close()
+        exitCode = result['exit_code']
+        if self.job_log:
+            self.job_log.message('Exit code of checkm ' + subcommand + ': ' + str(exitCode))
+        self.recorder.add_subprocess(subcommand, command, time.time() - start, result['rusage'], exitCode)
 
+        if result['timed_out']:
+            raise CheckMTimeoutError('Command timed out in ' + result['timed_out'] + ': ' + ' '.join(command) +
+                                     '\n' + 'Exit Code: ' + str(exitCode), exitCode)
         if (exitCode == 0):
             log('Executed command: ' + ' '.join(command) + '\n' +
                 'Exit Code: ' + str(exitCode))
         else:
-            raise ValueError('Error running command: ' + ' '.join(command) + '\n' +
-                             'Exit Code: ' + str(exitCode))
+            raise CheckMCommandError('Error running command: ' + ' '.join(command) + '\n' +
+                                     'Exit Code: ' + str(exitCode), exitCode)
+
+
+    def _progress_event(self, event):
+        ''' logs a progress event of a checkm subprocess and appends it to checkm_progress.jsonl in scratch '''
+        step_percent = '' if event['step_percent'] is None else ', ' + str(event['step_percent']) + '% of the step'
+        message = ('checkm ' + event['subcommand'] + ' progress: ' + str(event['percent']) + '% - ' +
+                   str(event['stage']) + ' / ' + str(event['step']) + step_percent +
+                   ' (' + str(int(event['elapsed'])) + 's)')
+        log(message)
+        if self.job_log:
+            self.job_log.message(message)
+        with self._progress_lock:
+            with open(os.path.join(self.scratch, 'checkm_progress.jsonl'), 'a') as f:
+                f.write(json.dumps(event) + '\n')
+
+
+    def _run_lineage_wf_sharded(self, options):
+        '''
+        Splits the bin folder into 'shards' subsets, runs a separate checkm lineage_wf over each
+        subset at the same time, dividing the 'thread' option between them, then merges the
+        shard outputs into out_folder.
+        '''
+        self._validate_options(options, checkBin=True, checkOut=True, subcommand='lineage_wf')
+        shard_root = options['out_folder'].rstrip(os.sep) + '_shards'
+        # start from scratch if a previous, killed run left anything behind
+        shutil.rmtree(shard_root, ignore_errors=True)
+        shutil.rmtree(options['out_folder'], ignore_errors=True)
+        shard_bin_folders = split_bin_folder(options['bin_folder'], shard_root, options['shards'])
+        n_shards = len(shard_bin_folders)
+        shard_threads = max(1, int(options.get('thread') or 1) // n_shards)
+        log('Running lineage_wf as ' + str(n_shards) + ' shards with ' + str(shard_threads) + ' threads each')
+
+        shard_options = []
+        for shard_bin_folder in shard_bin_folders:
+            opts = dict(options)
+            opts.pop('shards')
+            opts['bin_folder'] = shard_bin_folder
+            opts['out_folder'] = os.path.join(os.path.dirname(shard_bin_folder), 'output')
+            opts['thread'] = shard_threads
+            shard_options.append(opts)
+
+        pool = ThreadPool(n_shards)
+        try:
+            used_trees = pool.map(lambda opts: self.run_checkM('lineage_wf', opts), shard_options)
+        finally:
+            pool.close()
+            pool.join()
+
+        # the bins of every shard must be placed in the same tree, or the merged results would mix
+        # full tree and reduced tree placements
+        full_tree_shards = [opts for opts, used in zip(shard_options, used_trees) if str(used) != '1']
+        if full_tree_shards and len(full_tree_shards) < n_shards:
+            log('A shard fell back to the reduced tree, running the ' + str(len(full_tree_shards)) +
+                ' shards placed in the full tree again with the reduced tree')
+            for opts in full_tree_shards:
+                shutil.rmtree(opts['out_folder'], ignore_errors=True)
+                opts['reduced_tree'] = 1
+            pool = ThreadPool(len(full_tree_shards))
+            try:
+                pool.map(lambda opts: self.run_checkM('lineage_wf', opts), full_tree_shards)
+            finally:
+                pool.close()
+                pool.join()
+
+        merge_lineage_wf_outputs([opts['out_folder'] for opts in shard_options], options['out_folder'])
+        shutil.rmtree(shard_root, ignore_errors=True)
+        return 1 if len(full_tree_shards) < n_shards else options.get('reduced_tree')
+
+
+    def _run_dist_plot_chunked(self, options):
+        '''
+        Splits the bin folder into 'chunks' subsets and runs a separate checkm dist_plot over each
+        subset at the same time, against the same output folder and tetra file, then moves the
+        plots of every chunk into plots_folder.
+        '''
+        self._validate_options(options, checkBin=True, checkPlots=True, subcommand='dist_plot')
+        chunk_root = options['plots_folder'].rstrip(os.sep) + '_chunks'
+        # start from scratch if a previous, killed run left anything behind
+        shutil.rmtree(chunk_root, ignore_errors=True)
+        chunk_bin_folders = split_bin_folder(options['bin_folder'], chunk_root, options['chunks'])
+        log('Running dist_plot as ' + str(len(chunk_bin_folders)) + ' processes')
+
+        chunk_options = []
+        for chunk_bin_folder in chunk_bin_folders:
+            opts = dict(options)
+            opts.pop('chunks')
+            opts['bin_folder'] = chunk_bin_folder
+            opts['plots_folder'] = os.path.join(os.path.dirname(chunk_bin_folder), 'plots')
+            os.makedirs(opts['plots_folder'])
+            chunk_options.append(opts)
+
+        pool = ThreadPool(len(chunk_options))
+        try:
+            pool.map(lambda opts: self.run_checkM('dist_plot', opts, dropOutput=True), chunk_options)
+        finally:
+            pool.close()
+            pool.join()
+
+        if not os.path.isdir(options['plots_folder']):
+            os.makedirs(options['plots_folder'])
+        for opts in chunk_options:
+            for plot in os.listdir(opts['plots_folder']):
+                os.rename(os.path.join(opts['plots_folder'], plot), os.path.join(options['plots_folder'], plot))
+        shutil.rmtree(chunk_root, ignore_errors=True)
+
+
+    def _run_bin_qa_plot_paged(self, options):
+        '''
+        bin_qa_plot draws a single figure with a row per bin, which for many bins gets too large to
+        render.  If there are more than 'page_size' bins, they are split in order of their names into
+        pages of page_size bins, and a bin_qa_plot is drawn for every page at the same time (up to
+        threads at once).  The plots are saved in plots_folder as bin_qa_plot_page_<n>.<image type>,
+        listed with the bins on them in QA_PLOT_PAGES_FILE.
+        '''
+        self._validate_options(options, checkBin=True, checkPlots=True, subcommand='bin_qa_plot')
+        page_size = int(options['page_size'])
+        options = dict(options)
+        options.pop('page_size')
+        n_bins = len([f for f in os.listdir(options['bin_folder']) if f.endswith('.fna')])
+        if n_bins <= page_size:
+            return self.run_checkM('bin_qa_plot', options, dropOutput=True)
+
+        page_root = options['plots_folder'].rstrip(os.sep) + '_pages'
+        # start from scratch if a previous, killed run left anything behind
+        shutil.rmtree(page_root, ignore_errors=True)
+        pages = page_bin_folder(options['bin_folder'], page_root, page_size)
+        log('Running bin_qa_plot as ' + str(len(pages)) + ' pages of up to ' + str(page_size) + ' bins')
+
+        page_options = []
+        for page_bin_folder_path, _ in pages:
+            opts = dict(options)
+            opts['bin_folder'] = page_bin_folder_path
+            opts['plots_folder'] = os.path.join(os.path.dirname(page_bin_folder_path), 'plots')
+            os.makedirs(opts['plots_folder'])
+            page_options.append(opts)
+
+        pool = ThreadPool(max(1, min(len(page_options), int(self.threads))))
+        try:
+            pool.map(lambda opts: self.run_checkM('bin_qa_plot', opts, dropOutput=True), page_options)
+        finally:
+            pool.close()
+            pool.join()
+
+        if not os.path.isdir(options['plots_folder']):
+            os.makedirs(options['plots_folder'])
+        manifest = []
+        for n, (opts, (_, bin_ids)) in enumerate(zip(page_options, pages)):
+            for plot in os.listdir(opts['plots_folder']):
+                if not plot.startswith('bin_qa_plot.'):
+                    continue
+                page_plot = 'bin_qa_plot_page_' + str(n + 1) + os.path.splitext(plot)[1]
+                os.rename(os.path.join(opts['plots_folder'], plot), os.path.join(options['plots_folder'], page_plot))
+                manifest.append({'plot': page_plot, 'bins': bin_ids})
+        with open(os.path.join(options['plots_folder'], QA_PLOT_PAGES_FILE), 'w') as f:
+            json.dump({'pages': manifest}, f)
+        shutil.rmtree(page_root, ignore_errors=True)
 
 
     def _process_universal_options(self, command_list, options):
@@ -172,11 +931,20 @@ class CheckMUtil:
             command_list.append('--quiet')
 
 
+    def _process_plot_options(self, command_list, options, subcommand):
+        plot_options = dict(DEFAULT_PLOT_OPTIONS)
+        plot_options.update(self._plot_options(options))
+        for name in PLOT_OPTIONS[subcommand]:
+            command_list.append('--' + name)
+            command_list.append(str(plot_options[name]))
+
+
     def _validate_options(self, options,
                           checkBin=False,
                           checkOut=False,
                           checkPlots=False,
                           checkTetraFile=False,
+                          checkMarkerFile=False,
                           subcommand=''):
         # Note: we can, maybe should, add additional checks on the contents of the folders here
         if checkBin and 'bin_folder' not in options:
@@ -187,6 +955,8 @@ class CheckMUtil:
             raise ValueError('cannot run checkm ' + subcommand + ' without plots_folder option set')
         if checkTetraFile and 'tetra_file' not in options:
             raise ValueError('cannot run checkm ' + subcommand + ' without tetra_file option set')
+        if checkMarkerFile and 'marker_file' not in options:
+            raise ValueError('cannot run checkm ' + subcommand + ' without marker_file option set')
 
 
     def _build_command(self, subcommand, options):
@@ -201,8 +971,33 @@ class CheckMUtil:
             command.append(options['bin_folder'])
             command.append(options['out_folder'])
 
+        elif subcommand == 'tree':
+            self._validate_options(options, checkBin=True, checkOut=True, subcommand='tree')
+            if 'reduced_tree' in options and str(options['reduced_tree']) == '1':
+                command.append('--reduced_tree')
+            command.append(options['bin_folder'])
+            command.append(options['out_folder'])
+
+        elif subcommand == 'lineage_set':
+            self._validate_options(options, checkOut=True, checkMarkerFile=True, subcommand='lineage_set')
+            command.append(options['out_folder'])
+            command.append(options['marker_file'])
+
+        elif subcommand == 'analyze':
+            self._validate_options(options, checkBin=True, checkOut=True, checkMarkerFile=True,
+                                   subcommand='analyze')
+            command.append(options['marker_file'])
+            command.append(options['bin_folder'])
+            command.append(options['out_folder'])
+
+        elif subcommand == 'qa':
+            self._validate_options(options, checkOut=True, checkMarkerFile=True, subcommand='qa')
+            command.append(options['marker_file'])
+            command.append(options['out_folder'])
+
         elif subcommand == 'bin_qa_plot':
             self._validate_options(options, checkBin=True, checkOut=True, checkPlots=True, subcommand='bin_qa_plot')
+            self._process_plot_options(command, options, subcommand)
             command.append(options['out_folder'])
             command.append(options['bin_folder'])
             command.append(options['plots_folder'])
@@ -217,6 +1012,7 @@ class CheckMUtil:
         elif subcommand == 'dist_plot':
             self._validate_options(options, checkBin=True, checkOut=True, checkPlots=True, checkTetraFile=True,
                                    subcommand='dist_plot')
+            self._process_plot_options(command, options, subcommand)
             command.append(options['out_folder'])
             command.append(options['bin_folder'])
             command.append(options['plots_folder'])
@@ -231,23 +1027,54 @@ class CheckMUtil:
         return command
 
 
+    def _add_package_stages(self, graph, params, outputBuilder, input_dir, plot_outputs):
+        '''
+        Adds the stages that package and upload the output and the plots, each as soon as its folder
+        is final (the output once lineage_wf is done, the plots once the plot_outputs are produced), so
+        that the uploads run while the other stages and each other are still running.  Uploading only
+        waits on I/O, so these stages do not take cpus from the budget.
+        '''
+        graph.add_stage('package_output',
+                        lambda: self._build_output_packages(params, outputBuilder, input_dir),
+                        inputs=['checkm_output'], outputs=['output_package'], cpus=0)
+        graph.add_stage('package_plots',
+                        lambda: self._build_plots_packages(params, outputBuilder),
+                        inputs=plot_outputs, outputs=['plots_package'], cpus=0)
+
+
     def _build_output_packages(self, params, outputBuilder, input_dir):
 
         output_packages = []
 
         if 'save_output_dir' in params and str(params['save_output_dir']) == '1':
-            log('packaging full output directory')
-            zipped_output_file = outputBuilder.package_folder(outputBuilder.output_dir, 'full_output.zip',
+            if self.package_intermediates:
+                log('packaging full output directory')
+                full_out_dir = outputBuilder.output_dir
+            else:
+                log('packaging full output directory, without the intermediate files')
+                full_out_dir = os.path.join(self.scratch, 'full_output_' + os.path.basename(input_dir))
+                # a resumed run may have left a partial folder behind
+                shutil.rmtree(full_out_dir, ignore_errors=True)
+                outputBuilder.build_full_output(full_out_dir)
+            zipped_output_file = outputBuilder.package_folder(full_out_dir, 'full_output.zip',
                                                               'Full output of CheckM')
             output_packages.append(zipped_output_file)
         else:
             log('not packaging full output directory, selecting specific files')
             crit_out_dir = os.path.join(self.scratch, 'critical_output_' + os.path.basename(input_dir))
+            shutil.rmtree(crit_out_dir, ignore_errors=True)
             os.makedirs(crit_out_dir)
-            zipped_output_file = outputBuilder.package_folder(outputBuilder.output_dir, 'selected_output.zip',
+            outputBuilder.build_critical_output(crit_out_dir)
+            zipped_output_file = outputBuilder.package_folder(crit_out_dir, 'selected_output.zip',
                                                               'Selected output from the CheckM analysis')
             output_packages.append(zipped_output_file)
 
+        return output_packages
+
+
+    def _build_plots_packages(self, params, outputBuilder):
+
+        output_packages = []
 
         if 'save_plots_dir' in params and str(params['save_plots_dir']) == '1':
             log('packaging output plots directory')
@@ -0,0 +1,65 @@
+import errno
+import json
+import os
+import sys
+import time
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+class Checkpoints(object):
+    '''
+    Keeps a marker file per completed stage in checkpoint_dir, so that a job restarted on the same
+    scratch area can skip the stages that already finished.  The marker holds the (json serializable)
+    value returned by the stage, which is handed back instead of running the stage again.
+
+        ex:
+
+            checkpoints = Checkpoints('/kb/module/work/tmp/checkpoints_xyz')
+            staged_input = checkpoints.run('stage_input', lambda: dsu.stage_input(ref, 'fna'))
+    '''
+
+    MARKER_EXT = '.done'
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        try:
+            os.makedirs(checkpoint_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+    def is_done(self, name):
+        return os.path.isfile(self._marker_file(name))
+
+
+    def result(self, name):
+        with open(self._marker_file(name)) as f:
+            return json.load(f).get('result')
+
+
+    def mark_done(self, name, result=None):
+        # write then rename, so a job killed while writing never leaves a half written marker
+        marker_file = self._marker_file(name)
+        with open(marker_file + '.tmp', 'w') as f:
+            json.dump({'stage': name, 'finished': time.time(), 'result': result}, f)
+        os.rename(marker_file + '.tmp', marker_file)
+
+
+    def run(self, name, func):
+        ''' returns the saved result of stage name if it already completed, otherwise runs func '''
+        if self.is_done(name):
+            log('Checkpoint found for stage ' + name + ', skipping it')
+            return self.result(name)
+        result = func()
+        self.mark_done(name, result)
+        return result
+
+
+    def _marker_file(self, name):
+        return os.path.join(self.checkpoint_dir, name + self.MARKER_EXT)
@@ -1,12 +1,16 @@
 import os
 import time
 import glob
-import subprocess
+import shutil
+import uuid
 
 from Workspace.WorkspaceClient import Workspace
 from AssemblyUtil.AssemblyUtilClient import AssemblyUtil
 from MetagenomeUtils.MetagenomeUtilsClient import MetagenomeUtils
 
+from kb_Msuite.Utils.StagingCache import StagingCache
+from kb_Msuite.Utils.FastaConcat import VirtualFasta, fasta_index_path
+
 
 class DataStagingUtils(object):
 
@@ -14,9 +18,23 @@ class DataStagingUtils(object):
         self.scratch = os.path.abspath(config['scratch'])
         self.ws_url = config['workspace-url']
         self.callback_url = config['SDK_CALLBACK_URL']
+        self.staging_cache = None
+        if config.get('staging_cache_dir'):
+            max_bytes = float(config.get('staging_cache_max_gb', 50)) * 1024 ** 3
+            self.staging_cache = StagingCache(config['staging_cache_dir'], max_bytes)
+
+
+    def resolve_ref(self, input_ref):
+        '''
+        Resolves input_ref (which may refer to an object by name or omit the version) to the
+        absolute wsid/objid/ver reference of the object it currently points to
+        '''
+        ws = Workspace(self.ws_url)
+        input_info = ws.get_object_info3({'objects': [{'ref': input_ref}]})['infos'][0]
+        return '/'.join([str(input_info[6]), str(input_info[0]), str(input_info[4])])
 
 
-    def stage_input(self, input_ref, fasta_file_extension):
+    def stage_input(self, input_ref, fasta_file_extension, folder_suffix=None):
         '''
         Stage input based on an input data reference for CheckM
 
@@ -30,12 +48,21 @@ class DataStagingUtils(object):
             staged_input = stage_input('124/15/1', 'fna')
 
             staged_input
-            {"input_dir": '...'}
+            {"input_dir": '...', "folder_suffix": '...', "all_seq_fasta": '...', "all_seq_index": '...'}
+
+        folder_suffix is generated from the current time and a random part if not given, so that
+        jobs started at the same time do not share folders.  If it is given, anything left over in
+        the staging folders with that suffix (eg by a killed job) is removed first.
         '''
         # generate a folder in scratch to hold the input
-        suffix = str(int(time.time() * 1000))
+        suffix = folder_suffix if folder_suffix else str(int(time.time() * 1000)) + '_' + uuid.uuid4().hex[:8]
         input_dir = os.path.join(self.scratch, 'bins_' + suffix)
         all_seq_fasta = os.path.join(self.scratch, 'all_sequences_' + suffix + '.' + fasta_file_extension)
+        if folder_suffix:
+            shutil.rmtree(input_dir, ignore_errors=True)
+            for f in [all_seq_fasta, fasta_index_path(all_seq_fasta), VirtualFasta.manifest_path(all_seq_fasta)]:
+                if os.path.isfile(f):
+                    os.remove(f)
 
 
         # 2) based on type, download the files
@@ -55,7 +82,16 @@ class DataStagingUtils(object):
         #     the object.
         obj_name = input_info[1]
         type_name = input_info[2].split('-')[0]
-        if type_name in ['KBaseGenomeAnnotations.Assembly', 'KBaseGenomes.ContigSet']:
+
+        # the same object version was staged before, reuse it instead of downloading again
+        cache_key = None
+        if self.staging_cache:
+            resolved_ref = '/'.join([str(input_info[6]), str(input_info[0]), str(input_info[4])])
+            cache_key = self.staging_cache.key(resolved_ref, input_info[8], fasta_file_extension)
+
+        if cache_key and self.staging_cache.fetch(cache_key, input_dir):
+            cache_key = None
+        elif type_name in ['KBaseGenomeAnnotations.Assembly', 'KBaseGenomes.ContigSet']:
             au = AssemblyUtil(self.callback_url)
             os.makedirs(input_dir)
             filename = os.path.join(input_dir, obj_name + '.' + fasta_file_extension)
@@ -74,11 +110,14 @@ class DataStagingUtils(object):
         else:
             raise ValueError('Cannot stage fasta file input directory from type: ' + type_name)
 
+        if cache_key:
+            self.staging_cache.store(cache_key, input_dir, description=input_ref + ' ' + type_name)
 
-        # create summary fasta file with all bins
-        self.cat_fasta_files(input_dir, fasta_file_extension, all_seq_fasta)
+        # index all bins as a single fasta file, written out only if a tool needs it
+        all_seq_index = self.virtual_cat_fasta_files(input_dir, fasta_file_extension, all_seq_fasta)
 
-        return {'input_dir': input_dir, 'folder_suffix': suffix, 'all_seq_fasta': all_seq_fasta}
+        return {'input_dir': input_dir, 'folder_suffix': suffix, 'all_seq_fasta': all_seq_fasta,
+                'all_seq_index': all_seq_index}
 
 
     def set_fasta_file_extensions(self, folder, new_extension):
@@ -101,18 +140,12 @@ class DataStagingUtils(object):
                           os.path.join(folder, filename + '.' + new_extension))
 
 
-    def cat_fasta_files(self, folder, extension, output_fasta_file):
+    def virtual_cat_fasta_files(self, folder, extension, output_fasta_file):
         '''
-        Given a folder of fasta files with the specified extension, cat them together
-        using 'cat' into the target new_fasta_file
+        Given a folder of fasta files with the specified extension, writes the manifest and contig
+        index of their concatenation next to output_fasta_file (see FastaConcat.VirtualFasta), the file
+        itself is only written when it is first needed.  Returns the path of the index.
         '''
-        files = glob.glob(os.path.join(folder, '*.' + extension))
-        cat_cmd = ['cat'] + files
-        fasta_file_handle = open(output_fasta_file, 'w')
-        p = subprocess.Popen(cat_cmd, cwd=self.scratch, stdout=fasta_file_handle, shell=False)
-        exitCode = p.wait()
-        fasta_file_handle.close()
-
-        if exitCode != 0:
-            raise ValueError('Error running command: ' + ' '.join(cat_cmd) + '\n' +
-                             'Exit Code: ' + str(exitCode))
+        files = sorted(glob.glob(os.path.join(folder, '*.' + extension)))
+        VirtualFasta.create(files, output_fasta_file)
+        return fasta_index_path(output_fasta_file)
@@ -0,0 +1,239 @@
+import json
+import mmap
+import os
+import sys
+import time
+
+import numpy as np
+
+from kb_Msuite.Utils.FilePlacement import copy_bytes
+from kb_Msuite.Utils.TetraProfiler import index_fasta
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+INDEX_COLUMNS = ['contig_id', 'bin_id', 'offset', 'seq_start', 'seq_end', 'length', 'gc', 'n']
+
+_GC_BYTES = [ord(b) for b in 'GCgc']
+_N_BYTES = [ord(b) for b in 'Nn']
+_NEWLINE_BYTES = [ord(b) for b in '\r\n']
+
+
+def fasta_index_path(fasta_file):
+    ''' the contig index written next to a FASTA file by concatenate_fasta '''
+    return fasta_file + '.idx'
+
+
+def _contig_stats(data, start, end):
+    ''' length, GC count and N count of the sequence between start and end of a memory mapped file '''
+    counts = np.bincount(np.frombuffer(data[start:end], dtype=np.uint8), minlength=256)
+    length = int(end - start - counts[_NEWLINE_BYTES].sum())
+    return length, int(counts[_GC_BYTES].sum()), int(counts[_N_BYTES].sum())
+
+
+def _scan_fasta_file(fasta_file, position):
+    '''
+    Index rows of the contigs of fasta_file, with offsets as if the file started at position of
+    a concatenated file.  Also returns the size of the file and whether it ends with a newline.
+    '''
+    size = os.path.getsize(fasta_file)
+    if size == 0:
+        return [], 0, True
+    bin_id = os.path.splitext(os.path.basename(fasta_file))[0]
+    rows = []
+    with open(fasta_file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for contig_id, seq_start, seq_end in index_fasta(data):
+                header_start = data.rfind(b'\n', 0, seq_start - 1) + 1
+                length, gc, n = _contig_stats(data, seq_start, seq_end)
+                rows.append([contig_id, bin_id, position + header_start,
+                             position + seq_start, position + seq_end, length, gc, n])
+            ends_with_newline = data[size - 1:size] == b'\n'
+        finally:
+            data.close()
+    return rows, size, ends_with_newline
+
+
+def concatenate_fasta(fasta_files, dest_file, index_file=None):
+    '''
+    Concatenates fasta_files into dest_file in process, copying the data in the kernel with
+    copy_file_range or sendfile when available.  A newline is added after a file that does not
+    end with one, so its last line cannot run into the next header.
+
+    In the same pass every file is scanned through a memory map (so it is read from disk once,
+    for both the copy and the scan) to build an index with a line per contig, written to
+    index_file (default: fasta_index_path(dest_file)):
+
+        contig_id  bin_id  offset  seq_start  seq_end  length  gc  n
+
+    offset is where the header of the contig starts in dest_file, seq_start and seq_end delimit its
+    sequence lines, length is the number of bases and gc and n the number of G/C and N bases.
+    bin_id is the name of the file the contig came from, without its extension.
+
+    returns the list of index rows
+    '''
+    index_file = index_file or fasta_index_path(dest_file)
+    rows = []
+    position = 0
+    dest_fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for fasta_file in fasta_files:
+            file_rows, size, ends_with_newline = _scan_fasta_file(fasta_file, position)
+            if size == 0:
+                continue
+            rows.extend(file_rows)
+            position += _append_file(fasta_file, size, ends_with_newline, dest_fd)
+    finally:
+        os.close(dest_fd)
+
+    write_fasta_index(index_file, rows)
+    log('Concatenated ' + str(len(fasta_files)) + ' FASTA files with ' + str(len(rows)) +
+        ' contigs into ' + dest_file)
+    return rows
+
+
+def _append_file(fasta_file, size, ends_with_newline, dest_fd):
+    ''' appends fasta_file to dest_fd, plus a newline if it has none, returns the number of bytes written '''
+    src_fd = os.open(fasta_file, os.O_RDONLY)
+    try:
+        copy_bytes(src_fd, dest_fd, size)
+    finally:
+        os.close(src_fd)
+    if ends_with_newline:
+        return size
+    os.write(dest_fd, b'\n')
+    return size + 1
+
+
+class VirtualFasta(object):
+    '''
+    A concatenation of FASTA files that is not written to disk: a manifest of the files (path, size
+    and offset in the concatenation) and a contig index like the one of concatenate_fasta, kept
+    next to where the concatenated file would be (path + '.manifest' and fasta_index_path(path)).
+
+    Contigs can be read from it as if it were the concatenated file, and it is only written out at
+    path by materialize(), for the tools that need a real file.
+
+        ex:
+
+            view = VirtualFasta.create(bin_files, 'all_sequences.fna')
+            view.read(offset, size)
+            view.file_records()   # to profile the contigs of each file in place
+            view.materialize()    # writes all_sequences.fna
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(self.manifest_path(path)) as f:
+            self.files = json.load(f)['files']
+        self.rows = read_fasta_index(fasta_index_path(path))
+        self.size = self.files[-1]['start'] + self.files[-1]['length'] if self.files else 0
+
+
+    @staticmethod
+    def manifest_path(path):
+        return path + '.manifest'
+
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(VirtualFasta.manifest_path(path))
+
+
+    @classmethod
+    def create(cls, fasta_files, path):
+        ''' scans fasta_files and writes the manifest and index of their concatenation at path '''
+        rows = []
+        files = []
+        position = 0
+        for fasta_file in fasta_files:
+            file_rows, size, ends_with_newline = _scan_fasta_file(fasta_file, position)
+            if size == 0:
+                continue
+            rows.extend(file_rows)
+            length = size + (0 if ends_with_newline else 1)
+            files.append({'path': os.path.abspath(fasta_file), 'start': position, 'size': size, 'length': length})
+            position += length
+
+        write_fasta_index(fasta_index_path(path), rows)
+        with open(cls.manifest_path(path), 'w') as f:
+            json.dump({'files': files}, f)
+        log('Indexed ' + str(len(rows)) + ' contigs of ' + str(len(files)) + ' FASTA files as ' + path)
+        return cls(path)
+
+
+    def read(self, offset, size):
+        ''' returns size bytes at offset of the concatenation, as if read from the concatenated file '''
+        end = min(offset + size, self.size)
+        chunks = []
+        for entry in self.files:
+            entry_end = entry['start'] + entry['length']
+            if entry_end <= offset or entry['start'] >= end:
+                continue
+            with open(entry['path'], 'rb') as f:
+                f.seek(max(offset, entry['start']) - entry['start'])
+                chunk = f.read(min(end, entry_end) - max(offset, entry['start']))
+            if len(chunk) < min(end, entry_end) - max(offset, entry['start']):
+                # the newline added after a file without one
+                chunk += b'\n'
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+    def file_records(self):
+        '''
+        The contigs grouped by the file they are in, as a list of (file path, [(contig id, sequence
+        start, sequence end)]) with offsets within that file
+        '''
+        file_records = []
+        rows = iter(sorted(self.rows, key=lambda r: r['offset']))
+        row = next(rows, None)
+        for entry in self.files:
+            records = []
+            while row is not None and row['offset'] < entry['start'] + entry['length']:
+                records.append((row['contig_id'], row['seq_start'] - entry['start'], row['seq_end'] - entry['start']))
+                row = next(rows, None)
+            file_records.append((entry['path'], records))
+        return file_records
+
+
+    def materialize(self):
+        ''' writes the concatenated file at path (unless it already is), returns path '''
+        if os.path.isfile(self.path) and os.path.getsize(self.path) == self.size:
+            return self.path
+        log('Writing ' + self.path + ' for a tool that needs the concatenated FASTA file')
+        tmp_path = self.path + '.tmp'
+        dest_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for entry in self.files:
+                _append_file(entry['path'], entry['size'], entry['size'] == entry['length'], dest_fd)
+        finally:
+            os.close(dest_fd)
+        os.rename(tmp_path, self.path)
+        return self.path
+
+
+def write_fasta_index(index_file, rows):
+    with open(index_file, 'w') as f:
+        f.write('#' + '\t'.join(INDEX_COLUMNS) + '\n')
+        for row in rows:
+            f.write('\t'.join(map(str, row)) + '\n')
+
+
+def read_fasta_index(index_file):
+    ''' returns the rows of an index written by concatenate_fasta, as dicts keyed on INDEX_COLUMNS '''
+    rows = []
+    with open(index_file) as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            values = line.rstrip('\n').split('\t')
+            row = dict(zip(INDEX_COLUMNS[:2], values[:2]))
+            row.update(zip(INDEX_COLUMNS[2:], map(int, values[2:])))
+            rows.append(row)
+    return rows
@@ -0,0 +1,149 @@
+import errno
+import os
+import shutil
+import sys
+import threading
+import time
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# errors meaning a zero-copy call is not supported for these files, try the next way of copying
+_UNSUPPORTED = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+                    getattr(errno, 'EOPNOTSUPP', errno.EINVAL), getattr(errno, 'ENOTSUP', errno.EINVAL)])
+
+# errors of os.link meaning the file has to be copied instead
+_NOT_LINKABLE = set([errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOSYS,
+                     getattr(errno, 'EOPNOTSUPP', errno.EINVAL), getattr(errno, 'ENOTSUP', errno.EINVAL)])
+
+# number of errors listed by FilePlacer.summary, the others are only counted
+MAX_REPORTED_ERRORS = 10
+
+
+def _copy_file_range(src_fd, dest_fd, offset, count):
+    return os.copy_file_range(src_fd, dest_fd, count, offset)
+
+
+def _sendfile(src_fd, dest_fd, offset, count):
+    return os.sendfile(dest_fd, src_fd, offset, count)
+
+
+def _read_write(src_fd, dest_fd, offset, count):
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    data = os.read(src_fd, min(count, 1 << 20))
+    written = 0
+    while written < len(data):
+        written += os.write(dest_fd, data[written:])
+    return len(data)
+
+
+# in order of preference; python 2 only has the read/write loop
+_COPY_FUNCTIONS = ([_copy_file_range] if hasattr(os, 'copy_file_range') else []) + \
+                  ([_sendfile] if hasattr(os, 'sendfile') else []) + [_read_write]
+
+
+def copy_bytes(src_fd, dest_fd, size):
+    ''' appends the first size bytes of src_fd to dest_fd, in the kernel where possible '''
+    offset = 0
+    for copy in _COPY_FUNCTIONS:
+        try:
+            while offset < size:
+                copied = copy(src_fd, dest_fd, offset, size - offset)
+                if copied == 0:
+                    raise IOError('Unexpected end of file while copying')
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or copy is _read_write:
+                raise
+
+
+def copy_file(src, dest):
+    ''' copies src to dest with its permissions, in the kernel (copy_file_range or sendfile) where possible '''
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            copy_bytes(src_fd, dest_fd, os.fstat(src_fd).st_size)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copymode(src, dest)
+
+
+def link_or_copy(src, dest):
+    '''
+    hard link src to dest, or copy it if they are not on the same filesystem (or the filesystem
+    cannot link), returns True if it was linked
+    '''
+    try:
+        os.link(src, dest)
+        return True
+    except OSError as e:
+        if e.errno not in _NOT_LINKABLE:
+            raise
+    copy_file(src, dest)
+    return False
+
+
+class FilePlacer(object):
+    '''
+    Places files into folders being assembled (eg a report or an output package) by hard linking
+    them, or copying them if they cannot be linked, creating the folders on the way.  Instead of
+    raising, a file that cannot be placed is recorded in errors, so that one missing file does not
+    fail a whole report; summary() describes them for the user.  Can be shared between threads.
+    '''
+
+    def __init__(self):
+        self.linked = 0
+        self.copied = 0
+        # list of (src, dest, error message)
+        self.errors = []
+        self._lock = threading.Lock()
+
+
+    def place(self, src, dest):
+        ''' links or copies src to dest, replacing dest; returns False and records the error if it failed '''
+        try:
+            dest_folder = os.path.dirname(dest)
+            if dest_folder and not os.path.isdir(dest_folder):
+                try:
+                    os.makedirs(dest_folder)
+                except OSError as e:
+                    # another thread may have created it
+                    if e.errno != errno.EEXIST:
+                        raise
+            if os.path.lexists(dest):
+                os.remove(dest)
+            linked = link_or_copy(src, dest)
+        except (IOError, OSError) as e:
+            message = e.strerror if getattr(e, 'strerror', None) else str(e)
+            log('Could not place ' + src + ' at ' + dest + ': ' + message)
+            with self._lock:
+                self.errors.append((src, dest, message))
+            return False
+        with self._lock:
+            if linked:
+                self.linked += 1
+            else:
+                self.copied += 1
+        return True
+
+
+    def summary(self):
+        ''' a message listing the files that could not be placed, or '' if there were none '''
+        with self._lock:
+            errors = list(self.errors)
+        if not errors:
+            return ''
+        lines = ['Could not place ' + str(len(errors)) + ' files:']
+        for src, dest, message in errors[:MAX_REPORTED_ERRORS]:
+            lines.append('  ' + os.path.basename(src) + ': ' + message)
+        if len(errors) > MAX_REPORTED_ERRORS:
+            lines.append('  and ' + str(len(errors) - MAX_REPORTED_ERRORS) + ' more')
+        return '\n'.join(lines)
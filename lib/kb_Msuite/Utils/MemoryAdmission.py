@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+GB = 1024 ** 3
+
+# files checkm tree writes to <out_folder>/storage/tree: the concatenated marker alignment that is
+# placed, and the placement and tree that pplacer and guppy make of it
+TREE_FOLDER = os.path.join('storage', 'tree')
+CONCATENATED_ALIGNMENT = 'concatenated.fasta'
+PPLACER_JSON = 'concatenated.pplacer.json'
+PPLACER_TREE = 'concatenated.tre'
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except (IOError, OSError):
+        return None
+    if not value.isdigit():
+        # eg 'max' for an unlimited cgroup v2
+        return None
+    return int(value)
+
+
+def _meminfo_available():
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f if ':' in line)
+    except (IOError, OSError):
+        return None
+    for field in ['MemAvailable', 'MemFree']:
+        if field in meminfo:
+            return int(meminfo[field].split()[0]) * 1024
+    return None
+
+
+def _cgroup_available(cgroup_root='/sys/fs/cgroup'):
+    # cgroup v2
+    limit = _read_int(os.path.join(cgroup_root, 'memory.max'))
+    if limit is not None:
+        usage = _read_int(os.path.join(cgroup_root, 'memory.current')) or 0
+        return limit - usage
+    # cgroup v1, an unlimited group reports a huge number that the host value will undercut
+    limit = _read_int(os.path.join(cgroup_root, 'memory', 'memory.limit_in_bytes'))
+    if limit is not None:
+        usage = _read_int(os.path.join(cgroup_root, 'memory', 'memory.usage_in_bytes')) or 0
+        return limit - usage
+    return None
+
+
+def available_memory_bytes():
+    ''' memory available to this container: the smaller of the host's available memory and the cgroup headroom '''
+    values = [v for v in [_meminfo_available(), _cgroup_available()] if v is not None]
+    if not values:
+        return None
+    return max(0, min(values))
+
+
+def choose_reduced_tree(full_tree_gb=40, reduced_tree_gb=16, n_trees=1, n_jobs=1):
+    '''
+    Decides whether lineage_wf should use the reduced tree: returns '0' if n_trees copies of the
+    full reference tree fit in this job's share of the available memory, '1' otherwise.  n_trees is
+    the number of checkm processes placing bins at the same time (eg when lineage_wf is sharded),
+    n_jobs the number of jobs that may run at the same time, each of which gets an equal share.
+    '''
+    available = available_memory_bytes()
+    if available is None:
+        log('Could not determine the available memory, using the reduced tree')
+        return '1'
+    if n_jobs > 1:
+        log('Available memory: {0:.1f} GB, shared by up to {1} jobs'.format(available / float(GB), n_jobs))
+        available = available // n_jobs
+
+    needed_full = float(full_tree_gb) * GB * n_trees
+    needed_reduced = float(reduced_tree_gb) * GB * n_trees
+    log('Memory for this job: {0:.1f} GB, the full tree needs {1:.1f} GB and the reduced tree {2:.1f} GB'.format(
+        available / float(GB), needed_full / GB, needed_reduced / GB))
+    if available >= needed_full:
+        log('Using the full reference tree')
+        return '0'
+    if available < needed_reduced:
+        log('Warning! Even the reduced tree may not fit in the available memory')
+    log('Using the reduced reference tree')
+    return '1'
+
+
+def _is_empty(path):
+    return not os.path.isfile(path) or os.path.getsize(path) == 0
+
+
+def tree_placement_failed(out_folder):
+    '''
+    True if checkm tree (or lineage_wf) got as far as placing the bins in the reference tree, but
+    pplacer did not leave a placement behind, most likely because the OOM killer killed it.  checkm
+    1.0.7 runs pplacer with os.system and ignores its exit status, so this shows in its output, not
+    in its exit code.  Without bins that can be placed checkm does not run pplacer, and only copies
+    the reference tree.
+    '''
+    tree_folder = os.path.join(out_folder, TREE_FOLDER)
+    if _is_empty(os.path.join(tree_folder, CONCATENATED_ALIGNMENT)):
+        return False
+    return _is_empty(os.path.join(tree_folder, PPLACER_JSON)) or _is_empty(os.path.join(tree_folder, PPLACER_TREE))
@@ -1,11 +1,17 @@
+import fnmatch
+import glob
+import json
 import os
-import shutil
-import ast
 import sys
 import time
 
 from DataFileUtil.DataFileUtilClient import DataFileUtil
 
+from kb_Msuite.Utils.BinStatsTable import read_stats_table
+from kb_Msuite.Utils.FilePlacement import FilePlacer
+from kb_Msuite.Utils.PlotImages import build_plot_images, preview_name, thumbnail_name
+from kb_Msuite.Utils.ZipPacker import DEFAULT_LEVEL, pack_folder
+
 
 def log(message, prefix_newline=False):
     """Logging function, provides a hook to suppress or redirect log messages."""
@@ -13,56 +19,165 @@ def log(message, prefix_newline=False):
     sys.stdout.flush()
 
 
+# columns of the summary table, from storage/bin_stats_ext.tsv
+SUMMARY_FIELDS = [{'id': 'marker lineage', 'display': 'Marker Lineage'},
+                  {'id': '# genomes', 'display': '# Genomes'},
+                  {'id': '# markers', 'display': '# Markers'},
+                  {'id': '# marker sets', 'display': '# Marker Sets'},
+                  {'id': '0', 'display': '0'},
+                  {'id': '1', 'display': '1'},
+                  {'id': '2', 'display': '2'},
+                  {'id': '3', 'display': '3'},
+                  {'id': '4', 'display': '4'},
+                  {'id': '5+', 'display': '5+'},
+                  {'id': 'Completeness', 'display': 'Completeness', 'round': 3},
+                  {'id': 'Contamination', 'display': 'Contamination', 'round': 3}]
+
+# files of the lineage_wf output packaged as the selected output, relative to the output folder; a
+# sharded lineage_wf keeps the tree of every shard under storage/tree/shard_<i> (see merge_lineage_wf_outputs)
+CRITICAL_OUTPUT_FILES = ['lineage.ms',
+                         os.path.join('storage', 'bin_stats.analyze.tsv'),
+                         os.path.join('storage', 'bin_stats.tree.tsv'),
+                         os.path.join('storage', 'bin_stats_ext.tsv'),
+                         os.path.join('storage', 'marker_gene_stats.tsv'),
+                         os.path.join('storage', 'tree', 'concatenated.tre'),
+                         os.path.join('storage', 'tree', 'shard_*', 'concatenated.tre')]
+
+# large intermediate files of the lineage_wf output, relative to the output folder: the prodigal gene
+# calls, the HMMER hits and the pplacer inputs and placements.  Only the results derived from them are
+# needed to read the output, so they can be left out of the full output package (package_intermediates).
+INTERMEDIATE_OUTPUT_FILES = [os.path.join('bins', '*', 'genes.*'),
+                             os.path.join('bins', '*', 'hmmer.*'),
+                             os.path.join('storage', '*hmm_info.pkl.gz'),
+                             os.path.join('storage', 'aai_qa', '*'),
+                             os.path.join('storage', 'tree', '*.masked.faa'),
+                             os.path.join('storage', 'tree', 'concatenated.fasta'),
+                             os.path.join('storage', 'tree', '*.pplacer.json')]
+
+# static files of the paginated report, copied into the html folder
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+PAGINATED_REPORT_FILES = ['summary_table.js', 'summary_table.css', 'bin.html']
+
+# with report_mode 'auto', reports of at least this many bins are paginated
+PAGINATED_REPORT_MIN_BINS = 1000
+
+# lists the pages of a bin_qa_plot drawn in pages of bins (see CheckMUtil._run_bin_qa_plot_paged):
+# {"pages": [{"plot": "bin_qa_plot_page_1.png", "bins": ["bin.001", ..]}, ..]}
+QA_PLOT_PAGES_FILE = 'bin_qa_plot_pages.json'
+
+
 class OutputBuilder(object):
     '''
     Constructs the output HTML report and artifacts based on a CheckM lineage_wf
     run.  This includes running any necssary plotting utilities of CheckM.
+
+    report_mode selects how the summary table is written: 'table' writes it as an HTML table with
+    a page per bin, 'paginated' writes the values to summary.json, rendered in the browser as a
+    paginated table with a single page for all bins, and 'auto' uses 'paginated' for
+    PAGINATED_REPORT_MIN_BINS bins or more.
+
+    The report shows previews and thumbnails of the plots and links the full size images, which are
+    scaled in a pool of image_processes processes, or in image_pool if given.  image_type is the
+    format checkm wrote the plots in, png or svg.
+
+    Folders are zipped locally before they are uploaded: plots and other compressed files are
+    stored as they are, text files are deflated at zip_level.
+
+    Files are placed in the report and package folders by hard linking them; the ones that could
+    not be placed are collected in self.files (see FilePlacer.summary).
     '''
 
-    def __init__(self, output_dir, plots_dir, scratch_dir, callback_url):
+    def __init__(self, output_dir, plots_dir, scratch_dir, callback_url, report_mode='table', image_processes=1,
+                 image_type='png', zip_level=DEFAULT_LEVEL, image_pool=None):
         self.output_dir = output_dir
         self.plots_dir = plots_dir
         self.scratch = scratch_dir
         self.callback_url = callback_url
+        if report_mode not in ('table', 'paginated', 'auto'):
+            raise ValueError('Invalid report_mode "' + str(report_mode) + '", expected table, paginated or auto')
+        self.report_mode = report_mode
+        self.image_processes = image_processes
+        self.image_pool = image_pool
+        self.zip_level = zip_level
+        self.files = FilePlacer()
 
-        self.DIST_PLOT_EXT = '.ref_dist_plots.png'
+        self.QA_PLOT_NAME = 'bin_qa_plot.' + image_type
+        self.DIST_PLOT_EXT = '.ref_dist_plots.' + image_type
 
 
     def package_folder(self, folder_path, zip_file_name, zip_file_description):
         ''' Simple utility for packaging a folder and saving to shock '''
+        zip_file = folder_path.rstrip(os.sep) + '.zip'
+        pack_folder(folder_path, zip_file, level=self.zip_level)
         dfu = DataFileUtil(self.callback_url)
-        output = dfu.file_to_shock({'file_path': folder_path,
-                                    'make_handle': 0,
-                                    'pack': 'zip'})
+        try:
+            output = dfu.file_to_shock({'file_path': zip_file,
+                                        'make_handle': 0})
+        finally:
+            os.remove(zip_file)
         return {'shock_id': output['shock_id'],
                 'name': zip_file_name,
                 'description': zip_file_description}
 
 
-    def build_critical_output(self, critical_out_dir):
-        src = self.output_dir
-        dest = critical_out_dir
+    def build_critical_output(self, critical_out_dir, manifest=CRITICAL_OUTPUT_FILES):
+        '''
+        Links the files of the manifest (paths relative to the output folder) into critical_out_dir,
+        for packaging only the results of a run.  The paths may have wildcards (see glob), files
+        missing from the output are skipped.
 
-        self._copy_file_ignore_errors('lineage.ms', src, dest)
+        returns the list of files placed in critical_out_dir
+        '''
+        placed = []
+        for pattern in manifest:
+            for filename in sorted(os.path.relpath(path, self.output_dir)
+                                   for path in glob.glob(os.path.join(self.output_dir, pattern))):
+                if self.files.place(os.path.join(self.output_dir, filename),
+                                    os.path.join(critical_out_dir, filename)):
+                    placed.append(filename)
+        return placed
 
-        os.makedirs(os.path.join(dest, 'storage'))
 
-        self._copy_file_ignore_errors(os.path.join('storage', 'bin_stats.analyze.tsv'), src, dest)
-        self._copy_file_ignore_errors(os.path.join('storage', 'bin_stats.tree.tsv'), src, dest)
-        self._copy_file_ignore_errors(os.path.join('storage', 'bin_stats_ext.tsv'), src, dest)
-        self._copy_file_ignore_errors(os.path.join('storage', 'marker_gene_stats.tsv'), src, dest)
-        self._copy_file_ignore_errors(os.path.join('storage', 'tree', 'concatenated.tre'), src, dest)
+    def build_full_output(self, full_out_dir, exclude=INTERMEDIATE_OUTPUT_FILES):
+        '''
+        Links every file of the output folder into full_out_dir except those matching a pattern of
+        exclude (relative to the output folder, see fnmatch), eg to leave out the large intermediates.
+
+        returns the number of files placed in full_out_dir
+        '''
+        placed = 0
+        skipped = 0
+        for root, _, files in os.walk(self.output_dir):
+            rel_root = os.path.relpath(root, self.output_dir)
+            for f in files:
+                filename = os.path.normpath(os.path.join(rel_root, f))
+                if any(fnmatch.fnmatch(filename, pattern) for pattern in exclude):
+                    skipped += 1
+                    continue
+                if self.files.place(os.path.join(root, f), os.path.join(full_out_dir, filename)):
+                    placed += 1
+        log('Linked ' + str(placed) + ' files of the output into ' + full_out_dir + ', left out ' +
+            str(skipped) + ' intermediate files')
+        return placed
 
 
-    def build_html_output_for_lineage_wf(self, html_dir, object_name):
+    def build_html_output_for_lineage_wf(self, html_dir, object_name, timings=None, bin_ids=None):
         '''
         Based on the output of CheckM lineage_wf, build an HTML report
+
+        timings is the output of ResourceRecorder.to_dict(), shown in a performance section if given
+        bin_ids limits the summary table to these bins (eg the bins of one input of a batch run)
         '''
 
-        # move plots we need into the html directory
-        plot_name = 'bin_qa_plot.png'
-        shutil.copy(os.path.join(self.plots_dir, plot_name), os.path.join(html_dir, plot_name))
-        self._copy_ref_dist_plots(self.plots_dir, html_dir)
+        # move plots we need into the html directory, with their previews and thumbnails
+        plot_name = self.QA_PLOT_NAME
+        qa_plot_pages = self._qa_plot_pages(self.plots_dir)
+        if qa_plot_pages:
+            qa_plot_files = [os.path.join(self.plots_dir, page['plot']) for page in qa_plot_pages]
+        else:
+            qa_plot_files = [os.path.join(self.plots_dir, plot_name)]
+        plot_files = qa_plot_files + self._ref_dist_plot_files(self.plots_dir)
+        build_plot_images(plot_files, html_dir, processes=self.image_processes, pool=self.image_pool)
 
         # write the html report to file
         html = open(os.path.join(html_dir, 'report.html'), 'w')
@@ -71,12 +186,18 @@ class OutputBuilder(object):
         self._write_html_header(html, object_name)
         html.write('<body>\n')
 
-        # include the single main summary figure
-        html.write('<img src="' + plot_name + '" width="90%" />\n')
+        # include the main summary figure, or a thumbnail of each of its pages, linked to the full resolution image
+        if qa_plot_pages:
+            self._write_qa_plot_pages(html, qa_plot_pages)
+        else:
+            html.write('<a href="' + plot_name + '"><img src="' + preview_name(plot_name) + '" width="90%" /></a>\n')
         html.write('<br><br><br>\n')
 
         # print out the info table
-        self.build_summary_table(html, html_dir)
+        self._write_summary(html, html_dir, bin_ids=bin_ids)
+
+        if timings:
+            self._write_performance_section(html, timings)
 
         html.write('</body>\n</html>\n')
         html.close()
@@ -84,60 +205,76 @@ class OutputBuilder(object):
         return self.package_folder(html_dir, 'report.html', 'Assembled report from CheckM')
 
 
-    def build_summary_table(self, html, html_dir):
+    def build_html_output_for_lineage_wf_batch(self, html_dir, inputs, timings=None):
+        '''
+        Builds the combined HTML summary of a batch lineage_wf run: a table of the inputs with the
+        name of the report of each, linking to a section per input with the summary table of its bins
 
-        stats_file = os.path.join(self.output_dir, 'storage', 'bin_stats_ext.tsv')
-        if not os.path.isfile(stats_file):
-            log('Warning! no stats file found (looking at: ' + stats_file + ')')
-            return
+        inputs is a list of {'input_ref': ..., 'bin_ids': [...], 'report_name': ...}
+        '''
+        html = open(os.path.join(html_dir, 'report.html'), 'w')
 
-        bin_stats = []
-        with open(stats_file) as lf:
-            for line in lf:
-                if not line:
-                    continue
-                if line.startswith('#'):
-                    continue
-                col = line.split('\t')
-                bin_id = col[0]
-                data = ast.literal_eval(col[1])
-                bin_stats.append({'bid': bin_id, 'data': data})
+        self._write_html_header(html, 'a batch of ' + str(len(inputs)) + ' inputs')
+        html.write('<body>\n')
 
+        html.write('<table>\n')
+        html.write('  <tr><th>Input</th><th>Bins</th><th>Report</th></tr>\n')
+        for n, i in enumerate(inputs):
+            html.write('  <tr><td><a href="#input_' + str(n + 1) + '">' + i['input_ref'] + '</a></td><td>' +
+                       str(len(i['bin_ids'])) + '</td><td>' + i['report_name'] + '</td></tr>\n')
+        html.write('</table>\n')
+        html.write('<br><br><br>\n')
 
-        fields = [{'id': 'marker lineage', 'display': 'Marker Lineage'},
-                  {'id': '# genomes', 'display': '# Genomes'},
-                  {'id': '# markers', 'display': '# Markers'},
-                  {'id': '# marker sets', 'display': '# Marker Sets'},
-                  {'id': '0', 'display': '0'},
-                  {'id': '1', 'display': '1'},
-                  {'id': '2', 'display': '2'},
-                  {'id': '3', 'display': '3'},
-                  {'id': '4', 'display': '4'},
-                  {'id': '5+', 'display': '5+'},
-                  {'id': 'Completeness', 'display': 'Completeness', 'round': 3},
-                  {'id': 'Contamination', 'display': 'Contamination', 'round': 3}]
+        paginated = False
+        for n, i in enumerate(inputs):
+            html.write('<h3 id="input_' + str(n + 1) + '">' + i['input_ref'] + '</h3>\n')
+            if self._write_summary(html, html_dir, bin_ids=i['bin_ids'],
+                                   data_file='summary_input_' + str(n + 1) + '.json'):
+                paginated = True
+            html.write('<br><br>\n')
+        if paginated:
+            # the page of a bin (bin.html) reads its statistics from the summary of all bins
+            self.build_summary_data(html_dir)
+
+        if timings:
+            self._write_performance_section(html, timings)
+
+        html.write('</body>\n</html>\n')
+        html.close()
+
+        return self.package_folder(html_dir, 'report.html', 'Combined report from CheckM')
+
+
+    def build_summary_table(self, html, html_dir, bin_ids=None):
+
+        table = self._read_summary_stats(bin_ids)
+        if table is None:
+            return
+        fields = SUMMARY_FIELDS
 
         html.write('<table>\n')
         html.write('  <tr>\n')
         html.write('    <th><b>Bin Name</b></th>\n')
+        html.write('    <th>Plots</th>\n')
         for f in fields:
             html.write('    <th>' + f['display'] + '</th>\n')
         html.write('  </tr>\n')
 
-        for b in bin_stats:
+        for i, bin_id in enumerate(table.bin_ids):
             html.write('  <tr>\n')
-            dist_plot_file = os.path.join(html_dir, str(b['bid']) + self.DIST_PLOT_EXT)
+            dist_plot_file = os.path.join(html_dir, str(bin_id) + self.DIST_PLOT_EXT)
             if os.path.isfile(dist_plot_file):
-                self._write_dist_html_page(html_dir, b['bid'])
-                html.write('    <td><a href="' + b['bid'] + '.html">' + b['bid'] + '</td>\n')
+                self._write_dist_html_page(html_dir, bin_id)
+                html.write('    <td><a href="' + bin_id + '.html">' + bin_id + '</td>\n')
+                html.write('    <td><a href="' + bin_id + '.html"><img src="' + thumbnail_name(bin_id + self.DIST_PLOT_EXT) +
+                           '" height="60" loading="lazy" /></a></td>\n')
             else:
-                html.write('    <td>' + b['bid'] + '</td>\n')
+                html.write('    <td>' + bin_id + '</td>\n')
+                html.write('    <td></td>\n')
             for f in fields:
-                if f['id'] in b['data']:
-                    value = str(b['data'][f['id']])
-                    if f.get('round'):
-                        value = str(round(b['data'][f['id']], f['round']))
-                    html.write('    <td>' + value + '</td>\n')
+                value = self._summary_value(table, f, i)
+                if value is not None:
+                    html.write('    <td>' + str(value) + '</td>\n')
                 else:
                     html.write('    <td></td>\n')
             html.write('  </tr>\n')
@@ -145,6 +282,129 @@ class OutputBuilder(object):
         html.write('</table>\n')
 
 
+    def build_summary_data(self, html_dir, bin_ids=None, data_file='summary.json'):
+        '''
+        Writes the summary table to html_dir/data_file, for the paginated report:
+
+            {"fields": [{"id": .., "display": ..}, ..], "plot_ext": ".ref_dist_plots.png",
+             "preview_ext": ".ref_dist_plots.preview.png", "thumbnail_ext": ".ref_dist_plots.thumb.png",
+             "rows": [[bin id, 1 if it has a dist plot else 0, value of each field, ..], ..]}
+
+        returns the number of bins, or None if there is no stats file
+        '''
+        table = self._read_summary_stats(bin_ids)
+        if table is None:
+            return None
+
+        rows = []
+        for i, bin_id in enumerate(table.bin_ids):
+            has_plot = os.path.isfile(os.path.join(html_dir, str(bin_id) + self.DIST_PLOT_EXT))
+            rows.append([bin_id, 1 if has_plot else 0] + [self._summary_value(table, f, i) for f in SUMMARY_FIELDS])
+
+        fields = [{'id': f['id'], 'display': f['display']} for f in SUMMARY_FIELDS]
+        with open(os.path.join(html_dir, data_file), 'w') as out:
+            json.dump({'fields': fields,
+                       'plot_ext': self.DIST_PLOT_EXT,
+                       'preview_ext': preview_name(self.DIST_PLOT_EXT),
+                       'thumbnail_ext': thumbnail_name(self.DIST_PLOT_EXT),
+                       'rows': rows}, out, separators=(',', ':'))
+        return len(rows)
+
+
+    def _write_summary(self, html, html_dir, bin_ids=None, data_file='summary.json'):
+        '''
+        writes the summary table as selected by report_mode, the paginated one reading its rows
+        from html_dir/data_file.  Returns True if the table is paginated.
+        '''
+        paginated = self.report_mode == 'paginated'
+        if self.report_mode == 'auto':
+            paginated = self._count_summary_bins(bin_ids) >= PAGINATED_REPORT_MIN_BINS
+        if not paginated:
+            self.build_summary_table(html, html_dir, bin_ids=bin_ids)
+            return False
+
+        n_bins = self.build_summary_data(html_dir, bin_ids=bin_ids, data_file=data_file)
+        if n_bins is None:
+            return False
+        for template in PAGINATED_REPORT_FILES:
+            self.files.place(os.path.join(TEMPLATES_DIR, template), os.path.join(html_dir, template))
+        log('Wrote the paginated summary of ' + str(n_bins) + ' bins')
+        html.write('<link rel="stylesheet" href="summary_table.css">\n')
+        html.write('<div class="summary-table-data" data-src="' + data_file + '"></div>\n')
+        html.write('<script src="summary_table.js"></script>\n')
+        return True
+
+
+    def _read_summary_stats(self, bin_ids=None):
+        ''' the BinStatsTable of the summary fields, limited to bin_ids if given, or None if there are no stats '''
+        stats_file = os.path.join(self.output_dir, 'storage', 'bin_stats_ext.tsv')
+        if not os.path.isfile(stats_file):
+            log('Warning! no stats file found (looking at: ' + stats_file + ')')
+            return None
+        table = read_stats_table(stats_file, fields=[f['id'] for f in SUMMARY_FIELDS])
+        if bin_ids is not None:
+            table = table.select(bin_ids)
+        return table
+
+
+    def _count_summary_bins(self, bin_ids=None):
+        ''' number of bins in the summary table, without parsing the stats '''
+        if bin_ids is not None:
+            return len(bin_ids)
+        stats_file = os.path.join(self.output_dir, 'storage', 'bin_stats_ext.tsv')
+        if not os.path.isfile(stats_file):
+            return 0
+        with open(stats_file) as f:
+            return sum(1 for line in f if line.strip() and not line.startswith('#'))
+
+
+    def _summary_value(self, table, field, i):
+        value = table.value(field['id'], i)
+        if value is not None and field.get('round'):
+            value = round(value, field['round'])
+        return value
+
+
+    def _write_qa_plot_pages(self, html, pages):
+
+        html.write('<h3>Bin QA Plot</h3>\n')
+        html.write('<p>' + str(sum(len(page['bins']) for page in pages)) + ' bins, plotted in ' + str(len(pages)) +
+                   ' pages</p>\n')
+        for page in pages:
+            caption = ' &ndash; '.join(sorted(set([page['bins'][0], page['bins'][-1]]))) if page['bins'] else ''
+            html.write('<div style="display: inline-block; margin: 0 8px 16px 0; text-align: center;">')
+            html.write('<a href="' + page['plot'] + '"><img src="' + thumbnail_name(page['plot']) +
+                       '" loading="lazy" /></a><br>' + caption + '</div>\n')
+
+
+    def _write_performance_section(self, html, timings):
+
+        def fmt(value, digits=1):
+            return '' if value is None else str(round(value, digits))
+
+        html.write('<br><br><h3>Performance</h3>\n')
+        html.write('<p>Total time so far: ' + fmt(timings['total_wall_time']) + ' s</p>\n')
+
+        html.write('<table>\n')
+        html.write('  <tr><th>Stage</th><th>Wall Time (s)</th><th>CPU Time (s)</th>' +
+                   '<th>Subprocess CPU Time (s)</th><th>Peak RSS (MB)</th><th>Status</th></tr>\n')
+        for s in timings['stages']:
+            peak_rss = s['peak_rss_kb'] / 1024.0 if s['peak_rss_kb'] is not None else None
+            html.write('  <tr><td>' + s['name'] + '</td><td>' + fmt(s['wall_time']) + '</td><td>' +
+                       fmt(s['cpu_time']) + '</td><td>' + fmt(s['child_cpu_time']) + '</td><td>' +
+                       fmt(peak_rss) + '</td><td>' + s['status'] + '</td></tr>\n')
+        html.write('</table>\n')
+
+        html.write('<br>\n<table>\n')
+        html.write('  <tr><th>Command</th><th>Wall Time (s)</th><th>CPU Time (s)</th>' +
+                   '<th>Peak RSS (MB)</th><th>Exit Code</th></tr>\n')
+        for p in timings['subprocesses']:
+            html.write('  <tr><td>' + p['command'] + '</td><td>' + fmt(p['wall_time']) + '</td><td>' +
+                       fmt(p['cpu_time']) + '</td><td>' + fmt(p['peak_rss_kb'] / 1024.0) + '</td><td>' +
+                       str(p['exit_code']) + '</td></tr>\n')
+        html.write('</table>\n')
+
+
     def _write_html_header(self, html, object_name):
 
         html.write('<html>\n')
@@ -184,16 +444,6 @@ class OutputBuilder(object):
         html.write(style)
         html.write('</head>\n')
 
-    def _copy_file_ignore_errors(self, filename, src_folder, dest_folder):
-        src = os.path.join(src_folder, filename)
-        dest = os.path.join(dest_folder, filename)
-        log('copying ' + src + ' to ' + dest)
-        try:
-            shutil.copy(src, dest)
-        except:
-            # TODO: add error message reporting
-            log('copy failed')
-
 
     def _write_dist_html_page(self, html_dir, bin_id):
 
@@ -207,19 +457,24 @@ class OutputBuilder(object):
         html.write('<body>\n')
         html.write('<br><a href="report.html">Back to summary</a><br>\n')
         html.write('<center><h2>Bin: ' + bin_id + '</h2></center>\n')
-        html.write('<img src="' + bin_id + self.DIST_PLOT_EXT + '" width="90%" />\n')
+        html.write('<a href="' + bin_id + self.DIST_PLOT_EXT + '"><img src="' +
+                   preview_name(bin_id + self.DIST_PLOT_EXT) + '" width="90%" /></a>\n')
+        html.write('<br><a href="' + bin_id + self.DIST_PLOT_EXT + '">Full resolution</a>\n')
         html.write('<br><br><br>\n')
         html.write('</body>\n</html>\n')
         html.close()
 
 
-    def _copy_ref_dist_plots(self, plots_dir, dest_folder):
-        for plotfile in os.listdir(plots_dir):
-            plot_file_path = os.path.join(plots_dir, plotfile)
-            if os.path.isfile(plot_file_path) and plotfile.endswith(self.DIST_PLOT_EXT):
-                try:
-                    shutil.copy(os.path.join(plots_dir, plotfile),
-                                os.path.join(dest_folder, plotfile))
-                except:
-                    # TODO: add error message reporting
-                    log('copy of ' + plot_file_path + ' to html directory failed')
+    def _qa_plot_pages(self, plots_dir):
+        ''' the pages of a paged bin_qa_plot, from QA_PLOT_PAGES_FILE, or [] if it was drawn as a single plot '''
+        pages_file = os.path.join(plots_dir, QA_PLOT_PAGES_FILE)
+        if not os.path.isfile(pages_file):
+            return []
+        with open(pages_file) as f:
+            pages = json.load(f)['pages']
+        return [page for page in pages if os.path.isfile(os.path.join(plots_dir, page['plot']))]
+
+
+    def _ref_dist_plot_files(self, plots_dir):
+        return sorted(os.path.join(plots_dir, f) for f in os.listdir(plots_dir)
+                      if f.endswith(self.DIST_PLOT_EXT) and os.path.isfile(os.path.join(plots_dir, f)))
@@ -0,0 +1,125 @@
+import os
+import struct
+import sys
+import time
+
+from multiprocessing import Pool
+
+from kb_Msuite.Utils.FilePlacement import link_or_copy
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# widths in pixels of the smaller versions of every plot, checkm plots at 600 dpi are several thousand wide
+PREVIEW_WIDTH = 1200
+THUMBNAIL_WIDTH = 240
+
+PREVIEW_SUFFIX = '.preview'
+THUMBNAIL_SUFFIX = '.thumb'
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def preview_name(plot_name):
+    ''' name of the medium resolution version of a plot, eg bin_qa_plot.png -> bin_qa_plot.preview.png '''
+    root, ext = os.path.splitext(plot_name)
+    return root + PREVIEW_SUFFIX + ext
+
+
+def thumbnail_name(plot_name):
+    ''' name of the thumbnail of a plot, eg bin_qa_plot.png -> bin_qa_plot.thumb.png '''
+    root, ext = os.path.splitext(plot_name)
+    return root + THUMBNAIL_SUFFIX + ext
+
+
+def png_size(path):
+    ''' (width, height) of a PNG image, read from its header '''
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    if len(header) < 24 or header[:8] != _PNG_SIGNATURE or header[12:16] != b'IHDR':
+        raise ValueError('Not a PNG image: ' + path)
+    return struct.unpack('>II', header[16:24])
+
+
+def _resize(src, dest, width):
+    '''
+    Writes src scaled down to width pixels wide to dest, or links it if it is not wider or not a
+    PNG (eg an svg plot).  Uses matplotlib, which checkm plots with; without it the full image is
+    linked.
+    '''
+    if os.path.exists(dest):
+        os.remove(dest)
+    if not src.lower().endswith('.png'):
+        link_or_copy(src, dest)
+        return False
+    src_width = png_size(src)[0]
+    if src_width <= width:
+        link_or_copy(src, dest)
+        return False
+    try:
+        from matplotlib import image
+    except ImportError:
+        link_or_copy(src, dest)
+        return False
+    image.thumbnail(src, dest, scale=float(width) / src_width, interpolation='bilinear')
+    return True
+
+
+def _build_plot_images(task):
+    '''
+    Places the full plot in dest_folder and writes its preview and thumbnail there.  The thumbnail
+    is scaled from the preview, which is quicker and aliases less than scaling the full image.
+    '''
+    plot_file, dest_folder = task
+    plot_name = os.path.basename(plot_file)
+    full = os.path.join(dest_folder, plot_name)
+    preview = os.path.join(dest_folder, preview_name(plot_name))
+    thumbnail = os.path.join(dest_folder, thumbnail_name(plot_name))
+    if not os.path.exists(full):
+        link_or_copy(plot_file, full)
+    resized = _resize(full, preview, PREVIEW_WIDTH)
+    _resize(preview, thumbnail, THUMBNAIL_WIDTH)
+    return {'full': plot_name,
+            'preview': os.path.basename(preview),
+            'thumbnail': os.path.basename(thumbnail),
+            'resized': resized}
+
+
+def build_plot_images(plot_files, dest_folder, processes=1, pool=None):
+    '''
+    Places every plot of plot_files in dest_folder together with a preview (PREVIEW_WIDTH wide)
+    and a thumbnail (THUMBNAIL_WIDTH wide), so that a report can show the small versions and only
+    link the full resolution image.  The images are scaled in a pool of processes, or in pool, a
+    multiprocessing Pool started beforehand (eg the shared_worker_pool, see WorkerPool).
+
+    returns a dict of plot name -> {'full': .., 'preview': .., 'thumbnail': .., 'resized': ..}
+    with the file names in dest_folder; resized is False if the preview is the full image
+    '''
+    tasks = [(plot_file, dest_folder) for plot_file in plot_files]
+    if not tasks:
+        return {}
+
+    start = time.time()
+    processes = max(1, min(int(processes), len(tasks)))
+    if processes == 1:
+        results = [_build_plot_images(task) for task in tasks]
+    elif pool:
+        results = pool.map(_build_plot_images, tasks)
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_build_plot_images, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    if not any(r['resized'] for r in results) and \
+            any(f.lower().endswith('.png') and png_size(f)[0] > PREVIEW_WIDTH for f in plot_files):
+        log('Warning! matplotlib is not available, the report links the full size plots')
+    log('Built previews and thumbnails of ' + str(len(results)) + ' plots with ' + str(processes) +
+        ' processes in ' + '{0:.1f}'.format(time.time() - start) + 's')
+    return dict((r['full'], r) for r in results)
@@ -0,0 +1,263 @@
+import errno
+import os
+import re
+import select
+import signal
+import sys
+import time
+
+try:
+    # the python 3 subprocess module backported to python 2: it starts the child without running
+    # python code between fork and exec, which is not safe in a process with other threads
+    import subprocess32 as subprocess
+except ImportError:
+    import subprocess
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# the banner checkm prints when one of its commands starts, eg ' [CheckM - tree] Placing bins in ...'
+BANNER_PATTERN = re.compile(r'\[CheckM - (\w+)\]')
+PERCENT_PATTERN = re.compile(r'\((\d+(?:\.\d+)?)%\)')
+
+# steps of the checkm commands, recognized from the lines they print
+STEP_PATTERNS = [('tree_placement', re.compile(r'pplacer')),
+                 ('gene_calling', re.compile(r'Identifying marker genes')),
+                 ('genome_statistics', re.compile(r'Calculating genome statistics')),
+                 ('marker_alignment', re.compile(r'Parsing HMM hits|Extracting|Aligning|Concatenating alignments')),
+                 ('marker_sets', re.compile(r'Determining marker sets|Inferring lineage-specific marker sets')),
+                 ('aai', re.compile(r'Calculating AAI')),
+                 ('tabulation', re.compile(r'Tabulating|Reading HMM info|Parsing marker gene')),
+                 ('plotting', re.compile(r'Plotting|plot'))]
+
+# expected steps of each command and its share of a lineage_wf run, used for the percent complete
+BANNER_STEPS = {'tree': ['gene_calling', 'genome_statistics', 'marker_alignment', 'tree_placement'],
+                'lineage_set': ['marker_sets'],
+                'analyze': ['gene_calling', 'genome_statistics', 'aai'],
+                'qa': ['tabulation']}
+BANNER_WEIGHTS = {'tree': 55, 'lineage_set': 5, 'analyze': 35, 'qa': 5}
+SUBCOMMAND_BANNERS = {'lineage_wf': ['tree', 'lineage_set', 'analyze', 'qa']}
+
+
+def parse_timeouts(value):
+    '''
+    Parses timeouts given in the config as 'name=seconds' pairs separated by commas, where name is
+    a step (eg tree_placement), a checkm command (eg tree) or 'total'.  Returns a dict.
+    '''
+    timeouts = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        name, _, seconds = item.partition('=')
+        if not seconds.strip():
+            raise ValueError('Invalid timeout "' + item.strip() + '", expected name=seconds')
+        timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+
+class CheckMProgress(object):
+    '''
+    Follows the output of a checkm subcommand line by line and turns the stage banners and
+    progress lines into progress events:
+
+        {'subcommand': 'lineage_wf', 'stage': 'tree', 'step': 'tree_placement',
+         'step_percent': None, 'percent': 41.3, 'elapsed': 1203.4, 'step_elapsed': 60.2,
+         'message': 'Placing 4 bins into the genome tree with pplacer (be patient).'}
+
+    percent is an estimate of how much of the whole subcommand is done, from the share of its
+    commands and steps that have completed.  An event is produced when the stage or step changes
+    and every time the step progresses by another 10%.
+    '''
+
+    def __init__(self, subcommand):
+        self.subcommand = subcommand
+        self.banners = SUBCOMMAND_BANNERS.get(subcommand, [subcommand])
+        self.started = time.time()
+        self.stage = None
+        self.stage_started = self.started
+        self.step = None
+        self.step_started = self.started
+        self.step_percent = None
+        self._reported_bucket = None
+
+
+    def feed(self, line):
+        ''' returns a progress event if line changes the progress enough to report it, else None '''
+        now = time.time()
+        banner = BANNER_PATTERN.search(line)
+        if banner:
+            self.stage = banner.group(1)
+            self.stage_started = now
+            self._set_step(None, now)
+            return self.event(line)
+
+        for step, pattern in STEP_PATTERNS:
+            if pattern.search(line):
+                if step != self.step:
+                    self._set_step(step, now)
+                    return self.event(line)
+                break
+
+        percent = PERCENT_PATTERN.search(line)
+        if percent and self.step:
+            self.step_percent = float(percent.group(1))
+            bucket = int(self.step_percent // 10)
+            if bucket != self._reported_bucket:
+                self._reported_bucket = bucket
+                return self.event(line)
+        return None
+
+
+    def event(self, message=''):
+        now = time.time()
+        return {'subcommand': self.subcommand,
+                'stage': self.stage,
+                'step': self.step,
+                'step_percent': self.step_percent,
+                'percent': round(self.percent(), 1),
+                'elapsed': now - self.started,
+                'step_elapsed': now - self.step_started,
+                'message': message.strip()}
+
+
+    def percent(self):
+        stage = self.stage or self.banners[0]
+        if stage not in self.banners:
+            return 0.0
+        weights = [BANNER_WEIGHTS.get(b, 1) for b in self.banners]
+        index = self.banners.index(stage)
+        done = float(sum(weights[:index]))
+
+        steps = BANNER_STEPS.get(stage, [])
+        fraction = 0.0
+        if self.step in steps:
+            fraction = (steps.index(self.step) + (self.step_percent or 0) / 100.0) / len(steps)
+        return 100.0 * (done + weights[index] * fraction) / sum(weights)
+
+
+    def expired(self, timeouts):
+        ''' returns the name of the step, stage or 'total' that ran longer than its timeout, or None '''
+        now = time.time()
+        for name, started in [(self.step, self.step_started),
+                              (self.stage, self.stage_started),
+                              ('total', self.started)]:
+            if name and name in timeouts and now - started > timeouts[name]:
+                return name
+        return None
+
+
+    def _set_step(self, step, now):
+        self.step = step
+        self.step_started = now
+        self.step_percent = None
+        self._reported_bucket = None
+
+
+def _to_str(data):
+    return data.decode('utf-8', 'replace') if sys.version_info[0] > 2 else data
+
+
+def _kill_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def _setsid():
+    # all the child may do between fork and exec without start_new_session: no imports, locks or logging
+    os.setsid()
+
+
+if sys.version_info[0] >= 3 or subprocess.__name__ == 'subprocess32':
+    _NEW_SESSION = {'start_new_session': True}
+else:
+    _NEW_SESSION = {'preexec_fn': _setsid}
+
+
+def run_supervised(command, progress, cwd=None, output_file=None, timeouts=None,
+                   on_event=None, poll_interval=1.0, kill_grace=10):
+    '''
+    Runs command in its own process group and reads its stdout and stderr line by line as they
+    are written, without blocking on either.  Lines go to output_file if given, else to our stdout.
+    Every line is fed to progress (a CheckMProgress) and the progress events are passed to on_event.
+
+    If a step, stage or the whole run takes longer than given in timeouts (see parse_timeouts), the
+    process group is sent SIGTERM, then SIGKILL after kill_grace seconds.
+
+    returns {'exit_code': .., 'rusage': .., 'timed_out': name of the expired timeout or None}
+    '''
+    timeouts = timeouts or {}
+    # a new session, so that the tools checkm starts (prodigal, hmmer, pplacer) can be killed with it
+    p = subprocess.Popen(command, cwd=cwd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         close_fds=True, **_NEW_SESSION)
+    buffers = {p.stdout.fileno(): b'', p.stderr.fileno(): b''}
+    status = rusage = None
+    timed_out = None
+    kill_at = None
+
+    def handle_line(line):
+        line = _to_str(line)
+        if output_file:
+            output_file.write(line + '\n')
+        else:
+            sys.stdout.write(line + '\n')
+        event = progress.feed(line)
+        if event and on_event:
+            on_event(event)
+
+    while True:
+        readable = []
+        if buffers:
+            try:
+                readable = select.select(list(buffers), [], [], 0 if status is not None else poll_interval)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            for fd in readable:
+                data = os.read(fd, 65536)
+                if not data:
+                    if buffers[fd]:
+                        handle_line(buffers[fd])
+                    del buffers[fd]
+                    continue
+                # progress lines are rewritten in place with a carriage return
+                lines = re.split(b'[\r\n]', buffers[fd] + data)
+                buffers[fd] = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        handle_line(line)
+            sys.stdout.flush()
+        elif status is None:
+            time.sleep(poll_interval)
+
+        if status is None:
+            pid, wait_status, wait_rusage = os.wait4(p.pid, os.WNOHANG)
+            if pid:
+                status, rusage = wait_status, wait_rusage
+        # done once the process exited and its output is drained (or held open by an orphan)
+        if status is not None and (not buffers or not readable):
+            break
+
+        if status is None and timed_out is None:
+            timed_out = progress.expired(timeouts)
+            if timed_out:
+                log('checkm ' + progress.subcommand + ' exceeded the ' + timed_out + ' timeout of ' +
+                    str(timeouts[timed_out]) + 's, terminating its process group')
+                _kill_group(p.pid, signal.SIGTERM)
+                kill_at = time.time() + kill_grace
+        if status is None and kill_at and time.time() > kill_at:
+            log('checkm ' + progress.subcommand + ' did not terminate, killing its process group')
+            _kill_group(p.pid, signal.SIGKILL)
+            kill_at = None
+
+    for stream in [p.stdout, p.stderr]:
+        stream.close()
+    exit_code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    p.returncode = exit_code
+    return {'exit_code': exit_code, 'rusage': rusage, 'timed_out': timed_out}
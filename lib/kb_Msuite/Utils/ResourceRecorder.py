@@ -0,0 +1,103 @@
+import json
+import resource
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# per thread cpu time, stages run in their own thread (Linux only, the constant is missing in python 2)
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith('linux') else None)
+
+
+def _thread_cpu_time():
+    if RUSAGE_THREAD is None:
+        return None
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        return None
+    return usage.ru_utime + usage.ru_stime
+
+
+class ResourceRecorder(object):
+    '''
+    Collects wall time, cpu time and peak memory of the stages of a run and of every checkm
+    subprocess they start.  Subprocesses are attributed to the stage running in the same thread.
+
+        ex:
+
+            recorder = ResourceRecorder()
+            with recorder.stage('tetra'):
+                ...
+            recorder.add_subprocess('lineage_wf', command, wall_time, rusage, exit_code)
+            recorder.write_json('timings.json')
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.subprocesses = []
+        self._lock = threading.Lock()
+        self._current = threading.local()
+
+
+    @contextmanager
+    def stage(self, name):
+        record = {'name': name, 'start': time.time(), 'wall_time': None,
+                  'cpu_time': None, 'child_cpu_time': 0.0, 'peak_rss_kb': None, 'status': 'running'}
+        with self._lock:
+            self.stages.append(record)
+        self._current.stage = record
+        cpu_start = _thread_cpu_time()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except Exception:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['wall_time'] = time.time() - record['start']
+            cpu_end = _thread_cpu_time()
+            if cpu_start is not None and cpu_end is not None:
+                record['cpu_time'] = cpu_end - cpu_start
+            self._current.stage = None
+
+
+    def add_subprocess(self, name, command, wall_time, rusage, exit_code):
+        ''' rusage is the resource usage of the child, eg as returned by os.wait4 '''
+        stage = getattr(self._current, 'stage', None)
+        # ru_maxrss is in kilobytes on Linux
+        record = {'name': name,
+                  'stage': stage['name'] if stage else None,
+                  'command': ' '.join(command),
+                  'wall_time': wall_time,
+                  'cpu_time': rusage.ru_utime + rusage.ru_stime,
+                  'peak_rss_kb': rusage.ru_maxrss,
+                  'exit_code': exit_code}
+        with self._lock:
+            self.subprocesses.append(record)
+            if stage:
+                stage['child_cpu_time'] += record['cpu_time']
+                stage['peak_rss_kb'] = max(stage['peak_rss_kb'] or 0, record['peak_rss_kb'])
+        log('Resources of ' + name + ': wall {0:.1f}s, cpu {1:.1f}s, peak rss {2} MB'.format(
+            wall_time, record['cpu_time'], record['peak_rss_kb'] // 1024))
+
+
+    def to_dict(self):
+        with self._lock:
+            return {'total_wall_time': time.time() - self.started,
+                    'stages': [dict(s) for s in self.stages],
+                    'subprocesses': [dict(p) for p in self.subprocesses]}
+
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
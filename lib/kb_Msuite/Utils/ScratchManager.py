@@ -0,0 +1,355 @@
+import errno
+import fcntl
+import os
+import shutil
+import sys
+import threading
+import time
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+def folder_size(path):
+    ''' bytes used by the files under path (or by path if it is a file), hard links counted once '''
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+    size = 0
+    seen = set()
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                st = os.lstat(os.path.join(root, f))
+            except OSError:
+                # removed while walking, eg by a running job
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            size += st.st_size
+    return size
+
+
+def _modified_since(path, since):
+    ''' True if path or anything under it was modified after since '''
+    if os.path.getmtime(path) > since:
+        return True
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                if os.lstat(os.path.join(root, name)).st_mtime > since:
+                    return True
+            except OSError:
+                continue
+    return False
+
+
+def _try_lock(path, directory=False):
+    '''
+    takes an exclusive flock on path without waiting, returns the file descriptor holding it, or
+    None if someone else holds it.  flock locks belong to the open file, so they work between the
+    threads of a process as well as between processes, and are released if the process dies.
+    '''
+    fd = os.open(path, os.O_RDONLY if directory else os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return None
+        raise
+    return fd
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class ScratchQuotaError(ValueError):
+    ''' a job could not get the scratch space or the job slot it needs within the wait time '''
+
+
+class JobLog(object):
+    '''
+    The log file of a single job: the output of its checkm commands and its progress, which would
+    otherwise be mixed with those of the other jobs in the server output.  Can be shared between
+    threads, every write goes to the file as a whole.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+
+    def write(self, text):
+        with self._lock:
+            self._file.write(text)
+            self._file.flush()
+
+
+    def message(self, message):
+        ''' writes a timestamped line, like log '''
+        self.write('{0:.2f}'.format(time.time()) + ': ' + str(message) + '\n')
+
+
+    def stream(self, echo=False):
+        ''' a file-like object writing to this log, and to stdout as well if echo '''
+        return _LogStream(self, echo)
+
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class _LogStream(object):
+
+    def __init__(self, job_log, echo):
+        self.job_log = job_log
+        self.echo = echo
+
+
+    def write(self, text):
+        self.job_log.write(text)
+        if self.echo:
+            sys.stdout.write(text)
+
+
+class ScratchManager(object):
+    '''
+    Gives every job a folder of its own under scratch_root/jobs, so that everything it writes can be
+    accounted for and removed with it, and a log file under scratch_root/logs, which outlives it.
+    Keeps the space used by the jobs within quota_bytes, and the number of jobs running at the same
+    time, in any of the processes sharing scratch_root, within max_jobs:
+
+        ex:
+
+            manager = ScratchManager('/kb/module/work/tmp', quota_bytes=500 * 1024 ** 3)
+            job = manager.start_job('1592936571123')
+            ...
+            job.release(tetra_file)       # an intermediate no stage will read again
+            job.finish()
+
+    A job starts once one of the max_jobs job slots is free and the space used by all jobs plus
+    job_reserve_bytes (what a new job is expected to need) fits in the quota; until then it waits,
+    for up to wait_timeout seconds, for running jobs to finish, and then fails with a
+    ScratchQuotaError.  A max_jobs or quota of 0 turns that check off.  Only the job folders count
+    towards the quota, and only when a job starts: whatever else is kept under scratch_root (eg the
+    result and staging caches, which outlive the jobs) is not counted.  The slots and the folders of
+    running jobs are held with file locks, a job with the id of a running job (eg the same input
+    with resume_lineage_wf) waits for it.  Folders and logs of jobs that were not modified for
+    max_age seconds (eg jobs that were killed) are removed when a job starts; 0 keeps them.
+    '''
+
+    JOBS_FOLDER = 'jobs'
+    LOGS_FOLDER = 'logs'
+    SLOTS_FOLDER = 'job_slots'
+
+    def __init__(self, scratch_root, quota_bytes=0, job_reserve_bytes=0, wait_timeout=0, max_age=0,
+                 max_jobs=0, poll_interval=30):
+        self.scratch_root = scratch_root
+        self.jobs_root = os.path.join(scratch_root, self.JOBS_FOLDER)
+        self.logs_root = os.path.join(scratch_root, self.LOGS_FOLDER)
+        self.slots_root = os.path.join(scratch_root, self.SLOTS_FOLDER)
+        self.quota_bytes = quota_bytes
+        self.job_reserve_bytes = job_reserve_bytes
+        self.wait_timeout = wait_timeout
+        self.max_age = max_age
+        self.max_jobs = int(max_jobs)
+        self.poll_interval = poll_interval
+
+
+    def job_folder(self, job_id):
+        return os.path.join(self.jobs_root, job_id)
+
+
+    def log_file(self, job_id):
+        return os.path.join(self.logs_root, job_id + '.log')
+
+
+    def start_job(self, job_id):
+        '''
+        Creates the folder of job job_id, or keeps it if it exists (a restarted job resumes from it),
+        once it has a job slot and there is room for it.  Returns the ScratchJob, which holds the slot
+        and the folder until it is finished.
+        '''
+        deadline = time.time() + self.wait_timeout
+        locks = []
+        try:
+            if self.max_jobs > 0:
+                _makedirs(self.slots_root)
+                locks.append(self._wait('a job slot for job ' + job_id, deadline, self._acquire_slot))
+            self.remove_stale_jobs(keep=[job_id])
+            if self.quota_bytes:
+                self._wait('scratch space for job ' + job_id, deadline, lambda: self._has_space(job_id))
+            path = self.job_folder(job_id)
+            resumed = os.path.isdir(path)
+            locks.append(self._wait('the running job ' + job_id + ' to finish', deadline,
+                                    lambda: self._lock_folder(path)))
+            _makedirs(self.logs_root)
+            job_log = JobLog(self.log_file(job_id))
+        except Exception:
+            for fd in locks:
+                os.close(fd)
+            raise
+        if resumed:
+            log('Resuming in the existing scratch folder ' + path)
+        # the time the job was last active, see remove_stale_jobs
+        os.utime(path, None)
+        return ScratchJob(path, job_log=job_log, locks=locks)
+
+
+    def used_bytes(self, exclude=None):
+        ''' bytes used by the folders of all jobs, except the job exclude '''
+        if not os.path.isdir(self.jobs_root):
+            return 0
+        return sum(folder_size(os.path.join(self.jobs_root, j)) for j in os.listdir(self.jobs_root) if j != exclude)
+
+
+    def remove_stale_jobs(self, keep=None):
+        '''
+        removes the folders and logs of the jobs that were not modified for max_age seconds, except
+        those in keep and those still running
+        '''
+        if not self.max_age:
+            return
+        since = time.time() - self.max_age
+        if os.path.isdir(self.jobs_root):
+            for job_id in os.listdir(self.jobs_root):
+                path = os.path.join(self.jobs_root, job_id)
+                if job_id in (keep or []) or not os.path.isdir(path) or _modified_since(path, since):
+                    continue
+                fd = _try_lock(path, directory=True)
+                if fd is None:
+                    continue
+                try:
+                    log('Removing the scratch folder of stale job ' + job_id + ' (' + str(folder_size(path)) +
+                        ' bytes)')
+                    shutil.rmtree(path, ignore_errors=True)
+                finally:
+                    os.close(fd)
+        if os.path.isdir(self.logs_root):
+            for name in os.listdir(self.logs_root):
+                path = os.path.join(self.logs_root, name)
+                if not os.path.isdir(os.path.join(self.jobs_root, name[:-len('.log')])) and \
+                        os.path.getmtime(path) <= since:
+                    os.remove(path)
+
+
+    def _wait(self, what, deadline, acquire):
+        ''' calls acquire until it returns something, for up to deadline, then raises a ScratchQuotaError '''
+        while True:
+            result = acquire()
+            if result:
+                return result
+            if time.time() >= deadline:
+                raise ScratchQuotaError('Gave up waiting for ' + what + ' after ' + str(int(self.wait_timeout)) +
+                                        's; try again later')
+            log('Waiting for ' + what)
+            time.sleep(self.poll_interval)
+
+
+    def _acquire_slot(self):
+        for slot in range(self.max_jobs):
+            fd = _try_lock(os.path.join(self.slots_root, 'slot_' + str(slot) + '.lock'))
+            if fd is not None:
+                return fd
+        return None
+
+
+    def _has_space(self, job_id):
+        # a resumed job already holds the space of its folder
+        used = self.used_bytes(exclude=job_id)
+        if used + self.job_reserve_bytes <= self.quota_bytes:
+            return True
+        log('Scratch quota reached: jobs use ' + str(used) + ' of ' + str(self.quota_bytes) +
+            ' bytes and a job needs ' + str(self.job_reserve_bytes) + ' bytes')
+        return False
+
+
+    def _lock_folder(self, path):
+        ''' creates the folder path if needed and locks it, None if another job holds it '''
+        _makedirs(path)
+        fd = _try_lock(path, directory=True)
+        if fd is None:
+            return None
+        # remove_stale_jobs may have removed the folder between makedirs and the lock
+        if not os.path.isdir(path) or os.stat(path).st_ino != os.fstat(fd).st_ino:
+            os.close(fd)
+            return self._lock_folder(path)
+        return fd
+
+
+class ScratchJob(object):
+    '''
+    The scratch folder and the JobLog of a single job, see ScratchManager.  release removes
+    intermediates as soon as the stages reading them are done, finish removes the folder once its
+    results are saved and frees the job slot.
+    '''
+
+    def __init__(self, path, job_log=None, locks=None):
+        self.path = path
+        self.job_id = os.path.basename(path)
+        self.job_log = job_log
+        self.released_bytes = 0
+        # file descriptors holding the job slot and the folder, see ScratchManager.start_job
+        self._locks = list(locks or [])
+
+
+    def log(self, message):
+        ''' logs message, to the JobLog as well '''
+        log(message)
+        if self.job_log:
+            self.job_log.message(message)
+
+
+    def release(self, *paths):
+        ''' removes files or folders of the job that are not needed any more, returns the bytes freed '''
+        freed = 0
+        released = []
+        for path in paths:
+            if not os.path.lexists(path):
+                continue
+            released.append(os.path.basename(path))
+            freed += folder_size(path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        self.released_bytes += freed
+        if freed:
+            self.log('Released ' + str(freed) + ' bytes of scratch: ' + ', '.join(released))
+        return freed
+
+
+    def used_bytes(self):
+        return folder_size(self.path)
+
+
+    def finish(self, keep=False):
+        '''
+        logs the space the job used and removes its folder, unless keep (eg to resume a failed job),
+        then closes its log and frees its job slot
+        '''
+        try:
+            self.log('Job scratch folder ' + self.path + ' holds ' + str(self.used_bytes()) + ' bytes, ' +
+                     str(self.released_bytes) + ' bytes were released while it ran')
+            if keep:
+                self.log('Keeping ' + self.path)
+            else:
+                shutil.rmtree(self.path, ignore_errors=True)
+        finally:
+            if self.job_log:
+                self.job_log.close()
+            for fd in self._locks:
+                os.close(fd)
+            self._locks = []
@@ -0,0 +1,171 @@
+import sys
+import threading
+import time
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# raises an exception again with the traceback of where it was first raised, which python 2 only
+# keeps with its three argument raise statement
+if sys.version_info[0] >= 3:
+    def _reraise(tp, value, tb):
+        raise value.with_traceback(tb)
+else:
+    exec('def _reraise(tp, value, tb):\n    raise tp, value, tb\n')
+
+
+class Stage(object):
+    '''
+    A single step of a pipeline.  inputs and outputs are symbolic names (eg 'tetra_file');
+    a stage depends on every other stage that lists one of its inputs as an output.
+    '''
+
+    def __init__(self, name, func, inputs=None, outputs=None, cpus=1, checkpoint=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.cpus = max(0, int(cpus))
+        self.checkpoint = checkpoint
+        self.depends_on = set()
+
+
+class StageGraph(object):
+    '''
+    Small dependency-graph executor.  Stages are declared with their inputs and outputs
+    and run in a thread as soon as everything they need has been produced, as long as
+    the sum of the cpus of the running stages stays within cpu_budget.  A stage asking
+    for more cpus than the budget is allowed to run, but only by itself.  Stages that only wait
+    on I/O (eg uploads) can be added with cpus=0, they run as soon as their inputs are ready.
+
+        ex:
+
+            graph = StageGraph(cpu_budget=8)
+            graph.add_stage('tetra', run_tetra, inputs=['all_seq_fasta'], outputs=['tetra_file'], cpus=4)
+            graph.add_stage('dist_plot', run_dist_plot, inputs=['checkm_output', 'tetra_file'])
+            results = graph.run()
+
+    Stage functions take no arguments; the value a stage returns is available to the stages
+    depending on it through graph.results[stage_name].
+
+    If a Checkpoints object is given, stages added with checkpoint=True are skipped when a
+    previous run already completed them, and their saved result is used instead.  If a
+    ResourceRecorder is given, the time and resources used by every stage are recorded.
+    '''
+
+    def __init__(self, cpu_budget=1, checkpoints=None, recorder=None):
+        self.cpu_budget = max(1, int(cpu_budget))
+        self.checkpoints = checkpoints
+        self.recorder = recorder
+        self.stages = []
+        # filled in as stages finish, so a stage function can read the result of a stage it depends on
+        self.results = {}
+
+
+    def add_stage(self, name, func, inputs=None, outputs=None, cpus=1, checkpoint=False):
+        for s in self.stages:
+            if s.name == name:
+                raise ValueError('Stage "' + name + '" was already added to the graph')
+        self.stages.append(Stage(name, func, inputs=inputs, outputs=outputs, cpus=cpus, checkpoint=checkpoint))
+
+
+    def run(self):
+        '''
+        Runs all stages, returns a dict of stage name to the value returned by the stage function.
+        If a stage fails, no further stages are started, the running ones are allowed to finish
+        and the first error is raised again.
+        '''
+        self._resolve_dependencies()
+
+        results = self.results
+        errors = []
+        pending = list(self.stages)
+        running = {}
+        done = set()
+        lock = threading.Condition()
+
+        def run_stage(stage):
+            start = time.time()
+            log('Starting stage: ' + stage.name)
+            try:
+                if self.recorder:
+                    with self.recorder.stage(stage.name):
+                        value = self._run_stage_func(stage)
+                else:
+                    value = self._run_stage_func(stage)
+            except Exception:
+                with lock:
+                    errors.append((stage.name, sys.exc_info()))
+                    del running[stage.name]
+                    lock.notify_all()
+                return
+            log('Finished stage: ' + stage.name + ' ({0:.2f}s)'.format(time.time() - start))
+            with lock:
+                results[stage.name] = value
+                done.add(stage.name)
+                del running[stage.name]
+                lock.notify_all()
+
+        with lock:
+            while pending or running:
+                if not errors:
+                    for stage in list(pending):
+                        if not stage.depends_on.issubset(done):
+                            continue
+                        if not self._fits(stage, running):
+                            continue
+                        pending.remove(stage)
+                        running[stage.name] = stage.cpus
+                        t = threading.Thread(target=run_stage, args=(stage,), name='stage-' + stage.name)
+                        t.daemon = True
+                        t.start()
+                elif not running:
+                    break
+                lock.wait()
+
+        if errors:
+            name, exc_info = errors[0]
+            log('Stage ' + name + ' failed, skipped stages: ' + str([s.name for s in pending]))
+            _reraise(*exc_info)
+
+        return results
+
+
+    def _run_stage_func(self, stage):
+        if stage.checkpoint and self.checkpoints:
+            return self.checkpoints.run(stage.name, stage.func)
+        return stage.func()
+
+
+    def _fits(self, stage, running):
+        if not running:
+            return True
+        return sum(running.values()) + min(stage.cpus, self.cpu_budget) <= self.cpu_budget
+
+
+    def _resolve_dependencies(self):
+        producers = {}
+        for s in self.stages:
+            for o in s.outputs:
+                if o in producers:
+                    raise ValueError('Output "' + o + '" is produced by both stage "' + producers[o] +
+                                     '" and stage "' + s.name + '"')
+                producers[o] = s.name
+
+        for s in self.stages:
+            s.depends_on = set(producers[i] for i in s.inputs if i in producers)
+
+        # make sure there is no cycle, otherwise run() would wait forever
+        ordered = set()
+        remaining = list(self.stages)
+        while remaining:
+            ready = [s for s in remaining if s.depends_on.issubset(ordered)]
+            if not ready:
+                raise ValueError('Cycle detected between stages: ' + str([s.name for s in remaining]))
+            for s in ready:
+                ordered.add(s.name)
+                remaining.remove(s)
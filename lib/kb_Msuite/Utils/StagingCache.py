@@ -0,0 +1,142 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+from kb_Msuite.Utils.FilePlacement import link_or_copy
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+class StagingCache(object):
+    '''
+    Local cache of staged input folders, so the same version of an Assembly or BinnedContigs
+    object is only downloaded once.  Entries are keyed on the resolved wsid/objid/ver reference,
+    the workspace checksum of the object and the fasta extension used for staging.
+
+    Files are hard linked in and out of the cache where possible.  When the cache grows over
+    max_bytes, the least recently used entries are evicted.
+    '''
+
+    ENTRY_INFO = 'entry.json'
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+    def key(self, resolved_ref, chsum, extension):
+        return hashlib.sha1('|'.join([resolved_ref, str(chsum), extension]).encode('utf-8')).hexdigest()
+
+
+    def fetch(self, key, dest_dir):
+        '''
+        Populates dest_dir (which must not exist) with the cached files of key.
+        Returns False if there is no such entry.
+        '''
+        entry_dir = os.path.join(self.cache_dir, key)
+        files_dir = os.path.join(entry_dir, 'files')
+        if not os.path.isdir(files_dir):
+            return False
+        try:
+            os.makedirs(dest_dir)
+            for f in os.listdir(files_dir):
+                link_or_copy(os.path.join(files_dir, f), os.path.join(dest_dir, f))
+            # the modification time of the entry is its last use, for the LRU eviction
+            os.utime(entry_dir, None)
+        except (IOError, OSError) as e:
+            # most likely evicted while we were reading it
+            log('Could not read staging cache entry ' + key + ': ' + str(e))
+            shutil.rmtree(dest_dir, ignore_errors=True)
+            return False
+        log('Staged input from the staging cache (' + key + ')')
+        return True
+
+
+    def store(self, key, src_dir, description=''):
+        ''' adds the files of src_dir to the cache under key, then evicts entries over the size cap '''
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return
+
+        tmp_dir = os.path.join(self.cache_dir, 'tmp_' + str(uuid.uuid4()))
+        os.makedirs(os.path.join(tmp_dir, 'files'))
+        size = 0
+        for f in os.listdir(src_dir):
+            src = os.path.join(src_dir, f)
+            if os.path.isfile(src):
+                link_or_copy(src, os.path.join(tmp_dir, 'files', f))
+                size += os.path.getsize(src)
+        if size > self.max_bytes:
+            log('Not caching staged input of ' + str(size) + ' bytes, the staging cache is capped at ' +
+                str(self.max_bytes) + ' bytes')
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with open(os.path.join(tmp_dir, self.ENTRY_INFO), 'w') as f:
+            json.dump({'size': size, 'description': description}, f)
+
+        with self._lock():
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # stored by another job in the meantime
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            self._evict(keep=key)
+
+
+    def _evict(self, keep=None):
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            info_file = os.path.join(entry_dir, self.ENTRY_INFO)
+            if not os.path.isfile(info_file):
+                continue
+            with open(info_file) as f:
+                size = json.load(f)['size']
+            entries.append((os.path.getmtime(entry_dir), key, size))
+            total += size
+
+        for last_used, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            log('Evicting ' + key + ' (' + str(size) + ' bytes) from the staging cache')
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= size
+
+
+    def _lock(self):
+        return _FileLock(os.path.join(self.cache_dir, '.lock'))
+
+
+class _FileLock(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a')
+        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
@@ -0,0 +1,192 @@
+import mmap
+import os
+import sys
+import time
+
+from multiprocessing import Pool
+
+import numpy as np
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+K = 4
+BASES = 'ACGT'
+INVALID = 4
+
+
+if sys.version_info[0] > 2:
+    _COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+else:
+    import string
+    _COMPLEMENT = string.maketrans('ACGT', 'TGCA')
+
+
+def _rev_comp(kmer):
+    return kmer[::-1].translate(_COMPLEMENT)
+
+
+def canonical_kmers():
+    '''
+    Returns the 136 canonical tetranucleotides in the column order used by 'checkm tetra'
+    (the lexicographically smallest of each kmer and its reverse complement, in order of first
+    appearance when enumerating AAAA..TTTT) and an array mapping each of the 256 kmer codes
+    (A=0, C=1, G=2, T=3, most significant base first) to its canonical column.
+    '''
+    columns = []
+    column_of = {}
+    code_to_column = np.zeros(4 ** K, dtype=np.intp)
+    for code in range(4 ** K):
+        kmer = ''.join(BASES[(code >> (2 * (K - 1 - i))) & 3] for i in range(K))
+        canonical = min(kmer, _rev_comp(kmer))
+        if canonical not in column_of:
+            column_of[canonical] = len(columns)
+            columns.append(canonical)
+        code_to_column[code] = column_of[canonical]
+    return columns, code_to_column
+
+
+KMER_COLUMNS, CODE_TO_COLUMN = canonical_kmers()
+
+# byte value -> base code, anything that is not ACGT (either case) is invalid
+BASE_CODE = np.full(256, INVALID, dtype=np.uint8)
+for _i, _b in enumerate(BASES):
+    BASE_CODE[ord(_b)] = _i
+    BASE_CODE[ord(_b.lower())] = _i
+
+
+def sequence_signature(codes):
+    '''
+    Normalized canonical tetranucleotide counts of a sequence given as an array of base codes.
+    Kmers containing anything other than ACGT are skipped, as checkm does; like checkm, a sequence
+    without any valid kmer gets a signature of nan (0 / 0).
+    '''
+    n = len(codes) - K + 1
+    if n <= 0:
+        return np.full(len(KMER_COLUMNS), np.nan)
+    kmer_codes = np.zeros(n, dtype=np.intp)
+    valid = np.ones(n, dtype=bool)
+    for i in range(K):
+        window = codes[i:i + n]
+        valid &= window != INVALID
+        kmer_codes = (kmer_codes << 2) | (window & 3)
+    counts = np.bincount(CODE_TO_COLUMN[kmer_codes[valid]], minlength=len(KMER_COLUMNS))
+    total = counts.sum()
+    if total == 0:
+        return np.full(len(KMER_COLUMNS), np.nan)
+    return counts / float(total)
+
+
+def format_signature(signature):
+    '''
+    The tab separated values of a signature as checkm writes them (str of numpy float64, which is
+    the shortest repr).  repr of a python float is the same on python 2 and 3, while its str on
+    python 2 rounds to 12 significant digits.
+    '''
+    return '\t'.join(repr(float(x)) for x in signature.tolist())
+
+
+def index_fasta(data):
+    '''
+    Finds the records of a memory mapped FASTA file.  Returns a list of
+    (sequence id, sequence start offset, sequence end offset).
+    '''
+    records = []
+    size = len(data)
+    pos = 0 if size and data[0:1] == b'>' else data.find(b'\n>')
+    if pos > 0:
+        pos += 1
+    while 0 <= pos < size:
+        header_end = data.find(b'\n', pos)
+        if header_end < 0:
+            header_end = size
+        header = data[pos + 1:header_end].strip()
+        if not isinstance(header, str):
+            header = header.decode('utf-8', 'replace')
+        next_record = data.find(b'\n>', header_end)
+        seq_end = size if next_record < 0 else next_record + 1
+        records.append((header.split(None, 1)[0] if header else '', header_end + 1, seq_end))
+        pos = next_record + 1 if next_record >= 0 else -1
+    return records
+
+
+def _profile_records(args):
+    ''' worker: returns the tetra file lines of a chunk of records of seq_file '''
+    seq_file, records = args
+    data = np.memmap(seq_file, dtype=np.uint8, mode='r')
+    lines = []
+    for seq_id, start, end in records:
+        raw = np.asarray(data[start:end])
+        raw = raw[(raw != ord('\n')) & (raw != ord('\r'))]
+        signature = sequence_signature(BASE_CODE[raw])
+        lines.append(seq_id + '\t' + format_signature(signature) + '\n')
+    del data
+    return lines
+
+
+def compute_tetra_profile(seq_file, tetra_file, threads=1, chunk_bases=8 * 1024 * 1024, records=None,
+                          file_records=None, pool=None):
+    '''
+    In-process replacement for 'checkm tetra': computes the canonical tetranucleotide signature
+    of every sequence in seq_file and writes it to tetra_file in the format read by dist_plot
+    (a 'Sequence Id' header with the 136 kmers, then one tab separated line per sequence).
+
+    Sequences are read through a memory map and split into chunks of about chunk_bases bases
+    that are profiled in a pool of threads processes.  records, as returned by index_fasta (eg
+    taken from a contig index of seq_file), saves parsing seq_file to find the sequences.
+    file_records, a list of (file, records), profiles the sequences of several files instead of
+    seq_file (eg VirtualFasta.file_records() of a concatenation that was not written out).
+    pool, a multiprocessing Pool, is used instead of starting one, eg the shared_worker_pool a job
+    started before its stages run in threads (see WorkerPool).
+    '''
+    threads = max(1, int(threads))
+    if file_records is None:
+        if records is None and os.path.getsize(seq_file) == 0:
+            records = []
+        elif records is None:
+            with open(seq_file, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    records = index_fasta(data)
+                finally:
+                    data.close()
+        file_records = [(seq_file, records)]
+
+    chunks = []
+    n_records = 0
+    for path, path_records in file_records:
+        n_records += len(path_records)
+        chunk = []
+        chunk_size = 0
+        for record in path_records:
+            chunk.append(record)
+            chunk_size += record[2] - record[1]
+            if chunk_size >= chunk_bases:
+                chunks.append((path, chunk))
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            chunks.append((path, chunk))
+
+    log('Computing tetranucleotide signatures of ' + str(n_records) + ' sequences in ' +
+        str(len(chunks)) + ' chunks with ' + str(threads) + ' processes')
+    with open(tetra_file, 'w') as out:
+        out.write('Sequence Id\t' + '\t'.join(KMER_COLUMNS) + '\n')
+        if threads == 1 or len(chunks) <= 1:
+            for c in chunks:
+                out.writelines(_profile_records(c))
+        elif pool:
+            for lines in pool.imap(_profile_records, chunks):
+                out.writelines(lines)
+        else:
+            pool = Pool(min(threads, len(chunks)))
+            try:
+                for lines in pool.imap(_profile_records, chunks):
+                    out.writelines(lines)
+            finally:
+                pool.close()
+                pool.join()
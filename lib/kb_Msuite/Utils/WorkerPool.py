@@ -0,0 +1,55 @@
+import atexit
+import os
+import sys
+import threading
+import time
+
+from multiprocessing import Pool
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# the pool of this process and the pid it was started in, see shared_worker_pool
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _terminate():
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.terminate()
+        _pool.join()
+    _pool = None
+
+
+atexit.register(_terminate)
+
+
+def shared_worker_pool(processes):
+    '''
+    Returns the multiprocessing Pool of this process, started with processes workers on the first
+    call, that the jobs of the process share for the stages computing in python (eg native tetra
+    and the plot previews); None if processes is 1 or less.
+
+    Call it before a job takes any lock and before its stages start threads: the workers are forked
+    with a copy of every open file descriptor, so a pool forked later would hold on to the job slot
+    and folder locks of the jobs running then, and a fork while other threads run may copy a lock
+    one of them holds.  A server running jobs in threads (eg uwsgi) still has threads of its own
+    running at the first call.  A process forked from this one (eg a uwsgi worker forked from the
+    master) starts a pool of its own, the one it inherited has no threads serving it.
+    '''
+    global _pool, _pool_pid
+    processes = int(processes)
+    if processes <= 1:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            log('Starting a pool of ' + str(processes) + ' worker processes')
+            _pool = Pool(processes)
+            _pool_pid = os.getpid()
+        return _pool
@@ -0,0 +1,104 @@
+import os
+import sys
+import threading
+import time
+import zipfile
+import zlib
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# files in these formats are already compressed, deflating them again costs time and saves nothing
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.gz', '.tgz', '.bz2', '.xz', '.zip', '.pdf')
+
+DEFAULT_LEVEL = 6
+
+
+class _LevelZlib(object):
+    '''
+    Stands in for zlib in the zipfile module before python 3.7, which always deflates at the default
+    level of zlib: the compressors it asks for deflate at the level of the archive that the thread
+    is writing (see pack_folder) instead.
+    '''
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(zlib, name)
+
+    def compressobj(self, level=zlib.Z_DEFAULT_COMPRESSION, *args):
+        if level == zlib.Z_DEFAULT_COMPRESSION:
+            level = getattr(self.local, 'level', level)
+        return zlib.compressobj(level, *args)
+
+
+if sys.version_info < (3, 7):
+    _level_zlib = _LevelZlib()
+    zipfile.zlib = _level_zlib
+else:
+    _level_zlib = None
+
+
+def is_compressed(filename):
+    ''' True if filename is in an already compressed format, see STORED_EXTENSIONS '''
+    return filename.lower().endswith(STORED_EXTENSIONS)
+
+
+def _open_zip_file(zip_file, level):
+    ''' opens zip_file for writing ZIP64 archives, deflating at level (0 stores) '''
+    if level == 0:
+        return zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    if sys.version_info >= (3, 7):
+        return zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=level)
+    # the level is applied by _LevelZlib
+    return zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+
+def pack_folder(folder, zip_file, level=DEFAULT_LEVEL):
+    '''
+    Writes the files under folder to the ZIP64 archive zip_file, named relative to folder.  Files
+    in already compressed formats (see STORED_EXTENSIONS) are stored as they are, the others (eg
+    TSV, tree and svg files) are deflated at level (0 stores everything).
+
+    returns the size of zip_file
+    '''
+    level = int(level)
+    if level < 0 or level > 9:
+        raise ValueError('Invalid zip compression level "' + str(level) + '", expected 0 to 9')
+    if not os.path.isdir(folder):
+        raise ValueError('Cannot pack ' + folder + ', it is not a folder')
+
+    start = time.time()
+    n_entries = 0
+    n_stored = 0
+    if _level_zlib:
+        _level_zlib.local.level = level
+    try:
+        with _open_zip_file(zip_file, level) as z:
+            for root, dirs, files in os.walk(folder):
+                dirs.sort()
+                rel_root = os.path.relpath(root, folder)
+                if rel_root != '.':
+                    z.write(root, rel_root)
+                    n_entries += 1
+                for f in sorted(files):
+                    name = f if rel_root == '.' else os.path.join(rel_root, f)
+                    if level == 0 or is_compressed(f):
+                        z.write(os.path.join(root, f), name, compress_type=zipfile.ZIP_STORED)
+                        n_stored += 1
+                    else:
+                        z.write(os.path.join(root, f), name)
+                    n_entries += 1
+    finally:
+        if _level_zlib:
+            del _level_zlib.local.level
+    size = os.path.getsize(zip_file)
+
+    log('Packed ' + str(n_entries) + ' entries of ' + folder + ' into ' + zip_file + ' (' + str(size) +
+        ' bytes, ' + str(n_stored) + ' files stored) in ' + '{0:.1f}'.format(time.time() - start) + 's')
+    return size
@@ -0,0 +1,247 @@
+/*
+    Paginated, sortable summary tables of a CheckM report, rendered in the browser into every
+    element of class summary-table-data from the file named by its data-src attribute (written by
+    OutputBuilder.build_summary_data, summary.json by default):
+
+        {"fields": [{"id": "Completeness", "display": "Completeness"}, ..],
+         "plot_ext": ".ref_dist_plots.png", "thumbnail_ext": ".ref_dist_plots.thumb.png",
+         "rows": [["bin.001", 1, value, value, ..], ..]}
+
+    where the second item of a row is 1 if the bin has a distribution plot, shown as a thumbnail.
+    Only the rows that are scrolled into view are in the document, so the page stays responsive
+    with any number of bins.
+*/
+(function () {
+    'use strict';
+
+    var ROW_HEIGHT = 34;
+    var OVERSCAN = 10;
+
+    function el(tag, className, text) {
+        var node = document.createElement(tag);
+        if (className) {
+            node.className = className;
+        }
+        if (text !== undefined && text !== null) {
+            node.textContent = String(text);
+        }
+        return node;
+    }
+
+    function compare(a, b) {
+        // missing values always sort last
+        if (a === null || a === undefined) {
+            return (b === null || b === undefined) ? 0 : 1;
+        }
+        if (b === null || b === undefined) {
+            return -1;
+        }
+        if (typeof a === 'number' && typeof b === 'number') {
+            return a - b;
+        }
+        return String(a) < String(b) ? -1 : (String(a) > String(b) ? 1 : 0);
+    }
+
+    function SummaryTable(container, data) {
+        this.container = container;
+        this.fields = data.fields;
+        this.rows = data.rows;
+        this.thumbnailExt = data.thumbnail_ext;
+        this.view = this.rows;
+        this.pageSize = parseInt(container.getAttribute('data-page-size'), 10) || 1000;
+        this.page = 0;
+        this.sortColumn = null;
+        this.sortDescending = false;
+        this.build();
+        this.update();
+    }
+
+    SummaryTable.prototype.build = function () {
+        var self = this;
+        var controls = el('div', 'summary-controls');
+        this.filterInput = el('input');
+        this.filterInput.type = 'search';
+        this.filterInput.placeholder = 'Filter bins';
+        this.filterInput.oninput = function () {
+            self.page = 0;
+            self.update();
+        };
+        this.prevButton = el('button', null, 'Previous');
+        this.prevButton.onclick = function () {
+            self.goTo(self.page - 1);
+        };
+        this.nextButton = el('button', null, 'Next');
+        this.nextButton.onclick = function () {
+            self.goTo(self.page + 1);
+        };
+        this.pageLabel = el('span', 'summary-page');
+        controls.appendChild(this.filterInput);
+        controls.appendChild(this.prevButton);
+        controls.appendChild(this.pageLabel);
+        controls.appendChild(this.nextButton);
+
+        this.scroller = el('div', 'summary-scroller');
+        this.scroller.onscroll = function () {
+            self.render();
+        };
+        var table = el('table', 'summary-table');
+        var thead = el('thead');
+        var header = el('tr');
+        this.headers = [];
+        var columns = [{display: 'Bin Name'}].concat(this.fields);
+        columns.forEach(function (field, column) {
+            var th = el('th', null, field.display);
+            th.onclick = function () {
+                self.sortBy(column);
+            };
+            header.appendChild(th);
+            self.headers.push(th);
+        });
+        thead.appendChild(header);
+        this.tbody = el('tbody');
+        table.appendChild(thead);
+        table.appendChild(this.tbody);
+        this.scroller.appendChild(table);
+
+        this.container.appendChild(controls);
+        this.container.appendChild(this.scroller);
+    };
+
+    // column 0 is the bin id, column i > 0 is fields[i - 1], stored at index i + 1 of a row
+    SummaryTable.prototype.cell = function (row, column) {
+        return column === 0 ? row[0] : row[column + 1];
+    };
+
+    SummaryTable.prototype.sortBy = function (column) {
+        if (this.sortColumn === column) {
+            this.sortDescending = !this.sortDescending;
+        } else {
+            this.sortColumn = column;
+            this.sortDescending = false;
+        }
+        this.headers.forEach(function (th, i) {
+            th.className = i === column ? (this.sortDescending ? 'sorted-desc' : 'sorted-asc') : '';
+        }, this);
+        this.page = 0;
+        this.update();
+    };
+
+    SummaryTable.prototype.goTo = function (page) {
+        var pages = Math.max(1, Math.ceil(this.view.length / this.pageSize));
+        this.page = Math.min(Math.max(page, 0), pages - 1);
+        this.scroller.scrollTop = 0;
+        this.render();
+    };
+
+    // filters and sorts the rows, then shows the current page
+    SummaryTable.prototype.update = function () {
+        var self = this;
+        var filter = this.filterInput.value.toLowerCase();
+        var view = filter ? this.rows.filter(function (row) {
+            return String(row[0]).toLowerCase().indexOf(filter) >= 0;
+        }) : this.rows.slice();
+        if (this.sortColumn !== null) {
+            var column = this.sortColumn;
+            var sign = this.sortDescending ? -1 : 1;
+            // decorate with the position to keep the sort stable
+            view = view.map(function (row, i) {
+                return [row, i];
+            }).sort(function (a, b) {
+                var va = self.cell(a[0], column);
+                var vb = self.cell(b[0], column);
+                var missing = (va === null || va === undefined) - (vb === null || vb === undefined);
+                return missing || sign * compare(va, vb) || a[1] - b[1];
+            }).map(function (pair) {
+                return pair[0];
+            });
+        }
+        this.view = view;
+        this.goTo(this.page);
+    };
+
+    // renders the rows of the current page that are scrolled into view, with spacers for the others
+    SummaryTable.prototype.render = function () {
+        var pages = Math.max(1, Math.ceil(this.view.length / this.pageSize));
+        var pageStart = this.page * this.pageSize;
+        var pageRows = Math.min(this.pageSize, this.view.length - pageStart);
+        this.pageLabel.textContent = 'Page ' + (this.page + 1) + ' of ' + pages + ' (' + this.view.length + ' bins)';
+        this.prevButton.disabled = this.page === 0;
+        this.nextButton.disabled = this.page >= pages - 1;
+
+        var visible = Math.ceil(this.scroller.clientHeight / ROW_HEIGHT) + 2 * OVERSCAN;
+        var first = Math.max(0, Math.floor(this.scroller.scrollTop / ROW_HEIGHT) - OVERSCAN);
+        var last = Math.min(pageRows, first + visible);
+
+        var tbody = el('tbody');
+        tbody.appendChild(this.spacer(first));
+        for (var i = first; i < last; i++) {
+            tbody.appendChild(this.renderRow(this.view[pageStart + i]));
+        }
+        tbody.appendChild(this.spacer(pageRows - last));
+        this.tbody.parentNode.replaceChild(tbody, this.tbody);
+        this.tbody = tbody;
+    };
+
+    SummaryTable.prototype.spacer = function (rows) {
+        var tr = el('tr', 'summary-spacer');
+        var td = el('td');
+        td.colSpan = this.fields.length + 1;
+        td.style.height = (rows * ROW_HEIGHT) + 'px';
+        tr.appendChild(td);
+        return tr;
+    };
+
+    SummaryTable.prototype.renderRow = function (row) {
+        var tr = el('tr');
+        var name = el('td');
+        if (row[1]) {
+            var href = 'bin.html#' + encodeURIComponent(row[0]);
+            var link = el('a', null, row[0]);
+            link.href = href;
+            if (this.thumbnailExt) {
+                var thumbnail = el('img', 'summary-thumb');
+                thumbnail.src = encodeURIComponent(row[0]) + this.thumbnailExt;
+                var thumbnailLink = el('a');
+                thumbnailLink.href = href;
+                thumbnailLink.appendChild(thumbnail);
+                name.appendChild(thumbnailLink);
+            }
+            name.appendChild(link);
+        } else {
+            name.textContent = row[0];
+        }
+        tr.appendChild(name);
+        for (var i = 2; i < row.length; i++) {
+            tr.appendChild(el('td', null, row[i]));
+        }
+        return tr;
+    };
+
+    function load(container) {
+        // a report with several tables includes this script once per table
+        if (container.getAttribute('data-loaded')) {
+            return;
+        }
+        container.setAttribute('data-loaded', '1');
+        var request = new XMLHttpRequest();
+        request.open('GET', container.getAttribute('data-src') || 'summary.json');
+        request.onload = function () {
+            if (request.status && request.status !== 200) {
+                container.textContent = 'Could not load the summary table (' + request.status + ')';
+                return;
+            }
+            new SummaryTable(container, JSON.parse(request.responseText));
+        };
+        request.onerror = function () {
+            container.textContent = 'Could not load the summary table';
+        };
+        request.send();
+    }
+
+    window.addEventListener('load', function () {
+        var containers = document.getElementsByClassName('summary-table-data');
+        for (var i = 0; i < containers.length; i++) {
+            load(containers[i]);
+        }
+    });
+})();
@@ -49,14 +49,21 @@ class kb_Msuite(object):
            reduced_tree - if set to 1, run checkM with the reduced_tree flag,
            which will keep memory limited to less than 16gb quiet - pass the
            --quite parameter to checkM, but doesn't seem to work for all
-           subcommands) -> structure: parameter "subcommand" of String,
-           parameter "bin_folder" of String, parameter "out_folder" of
-           String, parameter "plots_folder" of String, parameter "seq_file"
-           of String, parameter "tetra_file" of String, parameter
+           subcommands dpi, image_type, font_size, width, row_height -
+           options of the bin_qa_plot and dist_plot subcommands (row_height
+           only applies to bin_qa_plot); defaults are 150 dpi, png, font size
+           8, 6.5 inches wide and rows 0.3 inches high. image_type is one of
+           eps, pdf, png, ps or svg) -> structure: parameter "subcommand" of
+           String, parameter "bin_folder" of String, parameter "out_folder"
+           of String, parameter "plots_folder" of String, parameter
+           "seq_file" of String, parameter "tetra_file" of String, parameter
            "dist_value" of Long, parameter "thread" of Long, parameter
            "reduced_tree" of type "boolean" (A boolean - 0 for false, 1 for
            true. @range (0, 1)), parameter "quiet" of type "boolean" (A
-           boolean - 0 for false, 1 for true. @range (0, 1))
+           boolean - 0 for false, 1 for true. @range (0, 1)), parameter "dpi"
+           of Long, parameter "image_type" of String, parameter "font_size"
+           of Long, parameter "width" of Double, parameter "row_height" of
+           Double
         """
         return self._client.call_method(
             'kb_Msuite.run_checkM',
@@ -66,12 +73,16 @@ class kb_Msuite(object):
         """
         :param params: instance of type "CheckMLineageWfParams" (input_ref -
            reference to the input Assembly or BinnedContigs data (could be
-           expanded to include Genome objects as well)) -> structure:
+           expanded to include Genome objects as well) dpi, image_type,
+           font_size, width, row_height - options of the plots, as for
+           run_checkM; image_type is png (the default) or svg) -> structure:
            parameter "input_ref" of String, parameter "workspace_name" of
            String, parameter "save_output_dir" of type "boolean" (A boolean -
            0 for false, 1 for true. @range (0, 1)), parameter
            "save_plots_dir" of type "boolean" (A boolean - 0 for false, 1 for
-           true. @range (0, 1))
+           true. @range (0, 1)), parameter "dpi" of Long, parameter
+           "image_type" of String, parameter "font_size" of Long, parameter
+           "width" of Double, parameter "row_height" of Double
         :returns: instance of type "CheckMLineageWfResult" -> structure:
            parameter "report_name" of String, parameter "report_ref" of String
         """
@@ -79,6 +90,35 @@ class kb_Msuite(object):
             'kb_Msuite.run_checkM_lineage_wf',
             [params], self._service_ver, context)
 
+    def run_checkM_lineage_wf_batch(self, params, context=None):
+        """
+        :param params: instance of type "CheckMLineageWfBatchParams"
+           (input_refs - references to the input Assembly or BinnedContigs
+           data; CheckM is run once over the bins of all of them, with the
+           bin and contig ids of each input prefixed by input1__, input2__,
+           .. dpi, image_type, font_size, width, row_height - options of the
+           plots, as for run_checkM_lineage_wf) -> structure: parameter
+           "input_refs" of list of String, parameter "workspace_name" of
+           String, parameter "save_output_dir" of type "boolean" (A boolean -
+           0 for false, 1 for true. @range (0, 1)), parameter
+           "save_plots_dir" of type "boolean" (A boolean - 0 for false, 1 for
+           true. @range (0, 1)), parameter "dpi" of Long, parameter
+           "image_type" of String, parameter "font_size" of Long, parameter
+           "width" of Double, parameter "row_height" of Double
+        :returns: instance of type "CheckMLineageWfBatchResult" (report_name,
+           report_ref - the combined report, with the summary of all bins and
+           the output files input_reports - a report for every input, in the
+           order of input_refs) -> structure: parameter "report_name" of
+           String, parameter "report_ref" of String, parameter
+           "input_reports" of list of type "CheckMLineageWfInputReport"
+           (report of a single input of a batch run) -> structure: parameter
+           "input_ref" of String, parameter "report_name" of String,
+           parameter "report_ref" of String
+        """
+        return self._client.call_method(
+            'kb_Msuite.run_checkM_lineage_wf_batch',
+            [params], self._service_ver, context)
+
     def status(self, context=None):
         return self._client.call_method('kb_Msuite.status',
                                         [], self._service_ver, context)
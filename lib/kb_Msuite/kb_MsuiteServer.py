@@ -341,6 +341,10 @@ class Application(object):
                              name='kb_Msuite.run_checkM_lineage_wf',
                              types=[dict])
         self.method_authentication['kb_Msuite.run_checkM_lineage_wf'] = 'required'  # noqa
+        self.rpc_service.add(impl_kb_Msuite.run_checkM_lineage_wf_batch,
+                             name='kb_Msuite.run_checkM_lineage_wf_batch',
+                             types=[dict])
+        self.method_authentication['kb_Msuite.run_checkM_lineage_wf_batch'] = 'required'  # noqa
         self.rpc_service.add(impl_kb_Msuite.status,
                              name='kb_Msuite.status',
                              types=[dict])
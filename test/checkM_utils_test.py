@@ -0,0 +1,747 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import time
+import shutil
+import tempfile
+import sys
+import threading
+import traceback
+import zipfile
+import json
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # py3
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # py2
+    from SocketServer import ThreadingMixIn
+
+from kb_Msuite import baseclient
+from kb_Msuite.Utils.CheckMUtil import CheckMUtil
+from kb_Msuite.Utils.OutputBuilder import CRITICAL_OUTPUT_FILES, OutputBuilder
+from kb_Msuite.Utils.BinShards import merge_lineage_wf_outputs
+from kb_Msuite.Utils.StageGraph import StageGraph
+from kb_Msuite.Utils.Checkpoints import Checkpoints
+from kb_Msuite.Utils.MemoryAdmission import choose_reduced_tree, available_memory_bytes
+from kb_Msuite.Utils.ProcessSupervisor import CheckMProgress, parse_timeouts, run_supervised
+from kb_Msuite.Utils.TetraProfiler import compute_tetra_profile
+from kb_Msuite.Utils.ZipPacker import pack_folder
+from kb_Msuite.Utils.FilePlacement import FilePlacer, copy_file
+from kb_Msuite.Utils.ScratchManager import ScratchManager, ScratchQuotaError
+from kb_Msuite.Utils.WorkerPool import shared_worker_pool
+
+
+class CheckMUtilsTest(unittest.TestCase):
+    '''
+    Tests of the kb_Msuite modules that only need a scratch folder, no KBase services,
+    checkm or its reference data, so that they can run anywhere (see core_checkM_test for the rest)
+    '''
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='kb_Msuite_test_')
+        self.cfg = {'scratch': self.scratch,
+                    'SDK_CALLBACK_URL': 'http://localhost:5000',
+                    'threads': '2',
+                    'reduced_tree': '1'}
+        self.callback_url = self.cfg['SDK_CALLBACK_URL']
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_stage_graph")
+    def test_stage_graph(self):
+
+        finished = []
+        graph = StageGraph(cpu_budget=2)
+        graph.add_stage('lineage_wf', lambda: finished.append('lineage_wf') or 'out',
+                        inputs=['bin_folder'], outputs=['checkm_output'])
+        graph.add_stage('tetra', lambda: finished.append('tetra') or 'tetra.tsv',
+                        inputs=['all_seq_fasta'], outputs=['tetra_file'])
+        graph.add_stage('dist_plot', lambda: graph.results['lineage_wf'] + ':' + graph.results['tetra'],
+                        inputs=['checkm_output', 'tetra_file'], outputs=['dist_plots'])
+        results = graph.run()
+        self.assertEqual(results['dist_plot'], 'out:tetra.tsv')
+        self.assertEqual(sorted(finished), ['lineage_wf', 'tetra'])
+        # by default lineage_wf and tetra, which take threads cpus each, fit in the budget together
+        cmu = CheckMUtil(self.cfg)
+        self.assertEqual(cmu.cpu_budget, 2 * int(self.cfg['threads']))
+
+        # cycles are rejected before anything runs
+        graph = StageGraph()
+        graph.add_stage('a', lambda: None, inputs=['y'], outputs=['x'])
+        graph.add_stage('b', lambda: None, inputs=['x'], outputs=['y'])
+        with self.assertRaises(ValueError):
+            graph.run()
+
+        # the error of a failed stage is raised again with the traceback of the stage
+        def fail():
+            raise ValueError('stage failed')
+        graph = StageGraph()
+        graph.add_stage('fail', fail)
+        try:
+            graph.run()
+            self.fail('the error of the stage was not raised')
+        except ValueError:
+            self.assertEqual(traceback.extract_tb(sys.exc_info()[2])[-1][2], 'fail')
+
+        # uploads (cpus=0) run alongside a stage that takes the whole budget
+        uploaded = threading.Event()
+        graph = StageGraph(cpu_budget=2)
+        graph.add_stage('lineage_wf', lambda: 'out', outputs=['checkm_output'])
+        graph.add_stage('html_report', lambda: uploaded.wait(10), inputs=['checkm_output'], cpus=2)
+        graph.add_stage('package_output', uploaded.set, inputs=['checkm_output'], cpus=0)
+        self.assertTrue(graph.run()['html_report'])
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_checkpointed_stages")
+    def test_checkpointed_stages(self):
+
+        checkpoints = Checkpoints(os.path.join(self.scratch, 'checkpoints_1'))
+        runs = []
+
+        def build_graph():
+            graph = StageGraph(cpu_budget=2, checkpoints=checkpoints)
+            graph.add_stage('tree', lambda: runs.append('tree') or 'tree_done',
+                            outputs=['checkm_tree'], checkpoint=True)
+            graph.add_stage('qa', lambda: runs.append('qa') or graph.results['tree'],
+                            inputs=['checkm_tree'], checkpoint=True)
+            return graph
+
+        self.assertEqual(build_graph().run()['qa'], 'tree_done')
+        self.assertTrue(checkpoints.is_done('tree'))
+        self.assertTrue(checkpoints.is_done('qa'))
+
+        # a second run skips both stages but still returns their results
+        self.assertEqual(build_graph().run()['qa'], 'tree_done')
+        self.assertEqual(runs, ['tree', 'qa'])
+
+        cmu = CheckMUtil(self.cfg)
+        self.assertEqual(cmu._build_command('lineage_set', {'out_folder': 'out', 'marker_file': 'lineage.ms'}),
+                         ['checkm', 'lineage_set', 'out', 'lineage.ms'])
+        self.assertEqual(cmu._build_command('analyze', {'bin_folder': 'bins', 'out_folder': 'out',
+                                                        'marker_file': 'lineage.ms', 'thread': 4}),
+                         ['checkm', 'analyze', '-t', '4', 'lineage.ms', 'bins', 'out'])
+
+        # the steps of lineage_wf are only split into stages when the job can be resumed
+        for resume, stages in [('0', ['lineage_wf']), ('1', ['tree', 'lineage_set', 'analyze', 'qa'])]:
+            cmu = CheckMUtil(dict(self.cfg, resume_lineage_wf=resume))
+            graph = StageGraph()
+            cmu._add_lineage_stages(graph, None, 'bins', 'output', 'suffix')
+            self.assertEqual([stage.name for stage in graph.stages], stages)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_memory_admission")
+    def test_memory_admission(self):
+
+        self.assertTrue(available_memory_bytes() > 0)
+        # a tiny tree always fits, an absurdly large one never does
+        self.assertEqual(choose_reduced_tree(full_tree_gb=0.001, reduced_tree_gb=0.001), '0')
+        self.assertEqual(choose_reduced_tree(full_tree_gb=1000000, reduced_tree_gb=0.001), '1')
+        # every shard loads its own copy of the tree
+        available_gb = available_memory_bytes() / (1024.0 ** 3)
+        self.assertEqual(choose_reduced_tree(full_tree_gb=available_gb * 0.75, reduced_tree_gb=0.001, n_trees=2), '1')
+        # the memory is shared with the jobs that may run in the other job slots
+        self.assertEqual(choose_reduced_tree(full_tree_gb=available_gb * 0.4, reduced_tree_gb=0.001), '0')
+        self.assertEqual(choose_reduced_tree(full_tree_gb=available_gb * 0.4, reduced_tree_gb=0.001, n_jobs=3), '1')
+
+        # 'auto' is only decided in the job, on the share of its job slot
+        cmu = CheckMUtil(dict(self.cfg, reduced_tree='auto', full_tree_memory_gb=str(available_gb * 0.4),
+                              reduced_tree_memory_gb='0.001', max_concurrent_jobs='3'))
+        self.assertEqual(cmu.reduced_tree, 'auto')
+        self.assertEqual(cmu._resolve_reduced_tree(), '1')
+        self.assertEqual(CheckMUtil(dict(self.cfg, reduced_tree='0'))._resolve_reduced_tree(), '0')
+
+        # a resumed job keeps the tree it started with, whatever the memory is now, and its folders
+        # are named after the configured value
+        checkpoints = Checkpoints(os.path.join(self.scratch, 'checkpoints'))
+        checkpoints.mark_done('choose_reduced_tree', '0')
+        self.assertEqual(cmu._resolve_reduced_tree(checkpoints), '0')
+        suffix = cmu._resumable_folder_suffix('1/2/3')
+        cmu.reduced_tree = '1'
+        self.assertEqual(cmu._resumable_folder_suffix('1/2/3'), suffix)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_reduced_tree_fallback")
+    def test_reduced_tree_fallback(self):
+
+        # a checkm whose pplacer only fits in memory with the reduced tree: like checkm 1.0.7, it
+        # exits 0 when pplacer was killed, leaving the alignment but no placement behind
+        bin_dir = os.path.join(self.scratch, 'bin')
+        os.makedirs(bin_dir)
+        fake_checkm = os.path.join(bin_dir, 'checkm')
+        with open(fake_checkm, 'w') as f:
+            f.write('#!/bin/sh\n' +
+                    'for out_folder; do :; done\n' +
+                    'mkdir -p "$out_folder/storage/tree"\n' +
+                    'echo ">bin.1" > "$out_folder/storage/tree/concatenated.fasta"\n' +
+                    'case " $* " in *" --reduced_tree "*)\n' +
+                    '  echo "{}" > "$out_folder/storage/tree/concatenated.pplacer.json"\n' +
+                    '  echo "(bin.1);" > "$out_folder/storage/tree/concatenated.tre";;\n' +
+                    'esac\n' +
+                    'exit 0\n')
+        os.chmod(fake_checkm, 0o755)
+        bins = os.path.join(self.scratch, 'bins')
+        os.makedirs(bins)
+        out_folder = os.path.join(self.scratch, 'output')
+
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        try:
+            cmu = CheckMUtil(self.cfg)
+            cmu.run_checkM('tree', {'bin_folder': bins, 'out_folder': out_folder, 'reduced_tree': 0})
+            self.assertTrue(cmu.reduced_tree_fallback)
+            self.assertTrue(os.path.getsize(os.path.join(out_folder, 'storage', 'tree', 'concatenated.tre')) > 0)
+
+            # with the reduced tree already, there is nothing to fall back to
+            with open(fake_checkm, 'w') as f:
+                f.write('#!/bin/sh\nfor out_folder; do :; done\nmkdir -p "$out_folder/storage/tree"\n' +
+                        'echo ">bin.1" > "$out_folder/storage/tree/concatenated.fasta"\nexit 0\n')
+            shutil.rmtree(out_folder)
+            cmu = CheckMUtil(self.cfg)
+            with self.assertRaises(ValueError):
+                cmu.run_checkM('tree', {'bin_folder': bins, 'out_folder': out_folder, 'reduced_tree': 1})
+            self.assertFalse(cmu.reduced_tree_fallback)
+
+            # only the shard with the large bin runs out of memory with the full tree, but all the
+            # shards must end up placed in the same tree
+            with open(fake_checkm, 'w') as f:
+                f.write('#!/bin/sh\n' +
+                        'for out_folder; do bin_folder=$last; last=$out_folder; done\n' +
+                        'mkdir -p "$out_folder/storage/tree"\n' +
+                        'echo ">bin.1" > "$out_folder/storage/tree/concatenated.fasta"\n' +
+                        'case " $* " in *" --reduced_tree "*) tree=reduced;;\n' +
+                        '  *) if [ -e "$bin_folder/big.fna" ]; then exit 0; fi; tree=full;;\n' +
+                        'esac\n' +
+                        'echo "{}" > "$out_folder/storage/tree/concatenated.pplacer.json"\n' +
+                        'echo "($tree);" > "$out_folder/storage/tree/concatenated.tre"\n' +
+                        'exit 0\n')
+            with open(os.path.join(bins, 'big.fna'), 'w') as f:
+                f.write('>contig_1\n' + 'ACGT' * 100 + '\n')
+            with open(os.path.join(bins, 'small.fna'), 'w') as f:
+                f.write('>contig_1\nACGT\n')
+            shutil.rmtree(out_folder)
+            cmu = CheckMUtil(self.cfg)
+            self.assertEqual(cmu.run_checkM('lineage_wf', {'bin_folder': bins, 'out_folder': out_folder,
+                                                           'reduced_tree': 0, 'thread': 2, 'shards': 2}), 1)
+            self.assertTrue(cmu.reduced_tree_fallback)
+            for i in range(2):
+                with open(os.path.join(out_folder, 'storage', 'tree', 'shard_' + str(i), 'concatenated.tre')) as f:
+                    self.assertEqual(f.read(), '(reduced);\n')
+        finally:
+            os.environ['PATH'] = path
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_cached_run")
+    def test_cached_run(self):
+
+        # a checkm lineage_wf writing a row per bin, and a tree and hmm info of all the bins of the run
+        bin_dir = os.path.join(self.scratch, 'bin')
+        os.makedirs(bin_dir)
+        calls_file = os.path.join(self.scratch, 'checkm_calls')
+        fake_checkm = os.path.join(bin_dir, 'checkm')
+        with open(fake_checkm, 'w') as f:
+            f.write('#!/bin/sh\n' +
+                    'for out_folder; do bin_folder=$last; last=$out_folder; done\n' +
+                    'echo "$bin_folder" >> ' + calls_file + '\n' +
+                    'mkdir -p "$out_folder/storage/tree"\n' +
+                    'echo "# header" > "$out_folder/lineage.ms"\n' +
+                    'for bin in $(ls "$bin_folder" | sed "s/.fna$//"); do\n' +
+                    '  mkdir -p "$out_folder/bins/$bin"\n' +
+                    '  echo "$bin" > "$out_folder/bins/$bin/genes.faa"\n' +
+                    '  printf "%s\\t{}\\n" "$bin" >> "$out_folder/lineage.ms"\n' +
+                    '  for table in bin_stats_ext.tsv bin_stats.analyze.tsv bin_stats.tree.tsv marker_gene_stats.tsv; do\n' +
+                    '    printf "%s\\t{}\\n" "$bin" >> "$out_folder/storage/$table"\n' +
+                    '  done\n' +
+                    '  echo "$bin" >> "$out_folder/storage/tree/concatenated.tre"\n' +
+                    '  echo "$bin" >> "$out_folder/storage/checkm_hmm_info.pkl.gz"\n' +
+                    'done\n' +
+                    'exit 0\n')
+        os.chmod(fake_checkm, 0o755)
+        data_dir = os.path.join(self.scratch, 'checkm_data')
+        os.makedirs(data_dir)
+        with open(os.path.join(data_dir, '.dmanifest'), 'w') as f:
+            f.write('test data\n')
+        bins = os.path.join(self.scratch, 'bins')
+        os.makedirs(bins)
+        for i in range(3):
+            with open(os.path.join(bins, 'bin.' + str(i) + '.fna'), 'w') as f:
+                f.write('>contig_1\n' + 'ACGT' * (i + 1) + '\n')
+        cfg = dict(self.cfg)
+        cfg.update({'bin_cache_dir': os.path.join(self.scratch, 'bin_cache'), 'checkm_data_dir': data_dir})
+
+        def run_lineage_wf(output_dir):
+            def run(job):
+                graph = StageGraph(cpu_budget=2)
+                cmu._add_lineage_stages(graph, job, bins, output_dir, 'test')
+                graph.run()
+            cmu = CheckMUtil(cfg)
+            cmu._run_job(os.path.basename(output_dir), run)
+            with open(calls_file) as f:
+                n_calls = len(f.read().splitlines())
+            with open(os.path.join(output_dir, 'storage', 'bin_stats_ext.tsv')) as f:
+                self.assertEqual(sorted(line.split('\t')[0] for line in f), sorted(os.path.splitext(b)[0]
+                                                                                   for b in os.listdir(bins)))
+            for run_file in [os.path.join('tree', 'concatenated.tre'), 'checkm_hmm_info.pkl.gz']:
+                with open(os.path.join(output_dir, 'storage', run_file)) as f:
+                    self.assertEqual(sorted(f.read().split()), sorted(os.path.splitext(b)[0]
+                                                                      for b in os.listdir(bins)))
+            return n_calls
+
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        try:
+            self.assertEqual(run_lineage_wf(os.path.join(self.scratch, 'output_1')), 1)
+            # all bins cached: checkm is not run, the output has the storage files of the first run
+            self.assertEqual(run_lineage_wf(os.path.join(self.scratch, 'output_2')), 1)
+            self.assertTrue(os.path.isfile(os.path.join(self.scratch, 'output_2', 'bins', 'bin.0', 'genes.faa')))
+            # the cached bins of another set of bins come from runs with trees of other bins
+            os.remove(os.path.join(bins, 'bin.2.fna'))
+            self.assertEqual(run_lineage_wf(os.path.join(self.scratch, 'output_3')), 2)
+            self.assertEqual(run_lineage_wf(os.path.join(self.scratch, 'output_4')), 2)
+        finally:
+            os.environ['PATH'] = path
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_process_supervisor")
+    def test_process_supervisor(self):
+
+        script = ("echo ' [CheckM - tree] Placing bins in reference genome tree.'; " +
+                  "echo '  Identifying marker genes in 2 bins with 1 threads:'; " +
+                  "printf '\\r    Finished processing 1 of 2 (50.00%%) bins.'; " +
+                  "printf '\\r    Finished processing 2 of 2 (100.00%%) bins.\\n'; " +
+                  "echo '  Placing 2 bins into the genome tree with pplacer (be patient).' >&2; " +
+                  "sleep 60")
+        events = []
+        start = time.time()
+        result = run_supervised(['sh', '-c', script], CheckMProgress('lineage_wf'), cwd=self.scratch,
+                                timeouts=parse_timeouts('tree_placement=2'), on_event=events.append,
+                                poll_interval=0.2, kill_grace=1)
+
+        # the whole process group was killed once pplacer ran past its timeout
+        self.assertEqual(result['timed_out'], 'tree_placement')
+        self.assertNotEqual(result['exit_code'], 0)
+        self.assertTrue(time.time() - start < 30)
+        steps = [(e['stage'], e['step'], e['step_percent']) for e in events]
+        self.assertIn(('tree', 'gene_calling', 50.0), steps)
+        self.assertIn(('tree', 'gene_calling', 100.0), steps)
+        self.assertEqual(steps[-1], ('tree', 'tree_placement', None))
+        percents = [e['percent'] for e in events]
+        self.assertEqual(percents, sorted(percents))
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_tetra_profile_format")
+    def test_tetra_profile_format(self):
+
+        # contigs.checkm_tetra.tsv was written by checkm tetra (CheckM 1.0.7 on python 2.7), the
+        # contigs include soft masked and ambiguous bases and ones without any valid tetranucleotide
+        data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tetra')
+        tetra_file = os.path.join(self.scratch, 'tetra_format_1.tsv')
+        compute_tetra_profile(os.path.join(data_dir, 'contigs.fna'), tetra_file, threads=2, chunk_bases=3000)
+
+        def read_lines(tetra_file):
+            with open(tetra_file) as f:
+                return f.readline(), sorted(f.readlines())
+
+        # byte for byte, in any order of the sequences as checkm writes them as they are done
+        self.assertEqual(read_lines(tetra_file), read_lines(os.path.join(data_dir, 'contigs.checkm_tetra.tsv')))
+
+        # the same in the worker pool the jobs of this process share
+        cmu = CheckMUtil(self.cfg)
+        self.assertIs(cmu.worker_pool, shared_worker_pool(2))
+        pooled_file = os.path.join(self.scratch, 'tetra_format_2.tsv')
+        cmu._run_job('tetra_job', lambda job: compute_tetra_profile(os.path.join(data_dir, 'contigs.fna'), pooled_file,
+                                                                    threads=2, chunk_bases=3000, pool=cmu.worker_pool))
+        self.assertEqual(read_lines(pooled_file), read_lines(tetra_file))
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_plot_options")
+    def test_plot_options(self):
+
+        cmu = CheckMUtil(self.cfg)
+        options = {'bin_folder': 'bins', 'out_folder': 'out', 'plots_folder': 'plots'}
+        command = cmu._build_command('bin_qa_plot', options)
+        self.assertEqual(command[command.index('--dpi') + 1], '150')
+        self.assertEqual(command[command.index('--image_type') + 1], 'png')
+        self.assertEqual(command[command.index('--row_height') + 1], '0.3')
+        self.assertEqual(command[-3:], ['out', 'bins', 'plots'])
+
+        options.update({'tetra_file': 'tetra.tsv', 'dist_value': 95, 'dpi': '300', 'image_type': 'SVG', 'width': 8})
+        command = cmu._build_command('dist_plot', options)
+        self.assertEqual(command[command.index('--dpi') + 1], '300')
+        self.assertEqual(command[command.index('--image_type') + 1], 'svg')
+        self.assertEqual(command[command.index('--width') + 1], '8.0')
+        self.assertNotIn('--row_height', command)
+
+        self.assertEqual(cmu._plot_options({'input_ref': '1/2/3', 'dpi': 72, 'image_type': ''}), {'dpi': 72})
+        with self.assertRaises(ValueError):
+            cmu._plot_options({'dpi': 0})
+        with self.assertRaises(ValueError):
+            cmu._plot_options({'font_size': 'large'})
+        # the report can only show png and svg plots
+        self.assertEqual(cmu._plot_options({'image_type': 'pdf'}), {'image_type': 'pdf'})
+        with self.assertRaises(ValueError):
+            cmu._plot_options({'image_type': 'pdf'}, report=True)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_dropped_output")
+    def test_dropped_output(self):
+
+        # a checkm that prints a line per contig of the bins it draws, like dist_plot
+        bin_dir = os.path.join(self.scratch, 'bin')
+        os.makedirs(bin_dir)
+        fake_checkm = os.path.join(bin_dir, 'checkm')
+        with open(fake_checkm, 'w') as f:
+            f.write('#!/bin/sh\n' +
+                    'for arg; do for bin in "$arg"/*.fna; do [ -e "$bin" ] && bins=$arg; break; done; done\n' +
+                    'for bin in "$bins"/*.fna; do echo "$bin"; sleep 0.1; done\n' +
+                    'exit 0\n')
+        os.chmod(fake_checkm, 0o755)
+        bins = os.path.join(self.scratch, 'bins')
+        os.makedirs(bins)
+        for i in range(4):
+            with open(os.path.join(bins, 'bin.' + str(i) + '.fna'), 'w') as f:
+                f.write('>contig_1\nACGT\n')
+
+        def check_output_files(subcommand):
+            # the runs were at the same time, each wrote the output of its own bins to a file of its own
+            out_files = [f for f in os.listdir(self.scratch) if f.startswith(subcommand + '_') and f.endswith('.out')]
+            self.assertEqual(len(out_files), 2)
+            printed = []
+            for out_file in out_files:
+                with open(os.path.join(self.scratch, out_file)) as f:
+                    lines = f.read().splitlines()
+                self.assertEqual(len(lines), 2)
+                self.assertEqual(len(set(os.path.dirname(line) for line in lines)), 1)
+                printed += [os.path.basename(line) for line in lines]
+            self.assertEqual(sorted(printed), ['bin.' + str(i) + '.fna' for i in range(4)])
+
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        try:
+            cmu = CheckMUtil(self.cfg)
+            cmu.run_checkM('dist_plot', {'bin_folder': bins, 'out_folder': 'out', 'tetra_file': 'tetra.tsv',
+                                         'plots_folder': os.path.join(self.scratch, 'plots'),
+                                         'dist_value': 95, 'chunks': 2}, dropOutput=True)
+            check_output_files('dist_plot')
+            cmu.run_checkM('bin_qa_plot', {'bin_folder': bins, 'out_folder': 'out',
+                                           'plots_folder': os.path.join(self.scratch, 'qa_plots'),
+                                           'page_size': 2}, dropOutput=True)
+            check_output_files('bin_qa_plot')
+        finally:
+            os.environ['PATH'] = path
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_output_packages")
+    def test_output_packages(self):
+
+        # fake a lineage_wf output with results and intermediates
+        output_dir = os.path.join(self.scratch, 'output_packages_1')
+        critical_files = [f for f in CRITICAL_OUTPUT_FILES if 'shard_' not in f]
+        results = critical_files + ['checkm.log']
+        intermediates = [os.path.join('bins', 'NewBins.001', 'genes.faa'),
+                         os.path.join('bins', 'NewBins.001', 'hmmer.analyze.txt'),
+                         os.path.join('storage', 'tree', 'concatenated.pplacer.json')]
+        for filename in results + intermediates:
+            path = os.path.join(output_dir, filename)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(filename + '\n')
+        ob = OutputBuilder(output_dir, self.scratch, self.scratch, self.callback_url)
+
+        # only the manifest is placed in the critical output, hard linked
+        critical_out_dir = os.path.join(self.scratch, 'critical_output_packages_1')
+        self.assertEqual(ob.build_critical_output(critical_out_dir), critical_files)
+        lineage_ms = os.path.join(critical_out_dir, 'lineage.ms')
+        self.assertEqual(os.stat(lineage_ms).st_ino, os.stat(os.path.join(output_dir, 'lineage.ms')).st_ino)
+        self.assertFalse(os.path.exists(os.path.join(critical_out_dir, 'bins')))
+
+        # the full output leaves out the intermediates
+        full_out_dir = os.path.join(self.scratch, 'full_output_packages_1')
+        self.assertEqual(ob.build_full_output(full_out_dir), len(results))
+        for filename in results:
+            self.assertTrue(os.path.isfile(os.path.join(full_out_dir, filename)))
+        for filename in intermediates:
+            self.assertFalse(os.path.exists(os.path.join(full_out_dir, filename)))
+
+        # a sharded run has the tree of every shard instead, and they are all selected
+        shard_folders = []
+        for i in range(2):
+            shard_folder = os.path.join(self.scratch, 'output_packages_shard_' + str(i))
+            os.makedirs(os.path.join(shard_folder, 'storage', 'tree'))
+            for filename in ['lineage.ms', os.path.join('storage', 'bin_stats_ext.tsv'),
+                             os.path.join('storage', 'tree', 'concatenated.tre')]:
+                with open(os.path.join(shard_folder, filename), 'w') as f:
+                    f.write(filename + '\n')
+            shard_folders.append(shard_folder)
+        sharded_output_dir = os.path.join(self.scratch, 'output_packages_2')
+        merge_lineage_wf_outputs(shard_folders, sharded_output_dir)
+        ob = OutputBuilder(sharded_output_dir, self.scratch, self.scratch, self.callback_url)
+        self.assertEqual(ob.build_critical_output(os.path.join(self.scratch, 'critical_output_packages_2')),
+                         ['lineage.ms', os.path.join('storage', 'bin_stats_ext.tsv'),
+                          os.path.join('storage', 'tree', 'shard_0', 'concatenated.tre'),
+                          os.path.join('storage', 'tree', 'shard_1', 'concatenated.tre')])
+        self.assertEqual(ob.files.summary(), '')
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_zip_packer")
+    def test_zip_packer(self):
+
+        folder = os.path.join(self.scratch, 'zip_packer_1')
+        os.makedirs(os.path.join(folder, 'storage'))
+        with open(os.path.join(folder, 'storage', 'bin_stats_ext.tsv'), 'w') as f:
+            f.write('NewBins.001\t{"Completeness": 100.0}\n' * 1000)
+        with open(os.path.join(folder, 'NewBins.001.ref_dist_plots.png'), 'wb') as f:
+            f.write(os.urandom(10000))
+
+        zip_file = os.path.join(self.scratch, 'zip_packer_1.zip')
+        self.assertEqual(pack_folder(folder, zip_file, level=9), os.path.getsize(zip_file))
+        with zipfile.ZipFile(zip_file) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(sorted(z.namelist()),
+                             ['NewBins.001.ref_dist_plots.png', 'storage/', 'storage/bin_stats_ext.tsv'])
+            # plots are stored as they are, text is deflated
+            self.assertEqual(z.getinfo('NewBins.001.ref_dist_plots.png').compress_type, zipfile.ZIP_STORED)
+            tsv = z.getinfo('storage/bin_stats_ext.tsv')
+            self.assertEqual(tsv.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertLess(tsv.compress_size, tsv.file_size)
+            with open(os.path.join(folder, 'storage', 'bin_stats_ext.tsv'), 'rb') as f:
+                self.assertEqual(z.read('storage/bin_stats_ext.tsv'), f.read())
+
+        # the level is applied on every python version
+        with open(os.path.join(folder, 'storage', 'bin_stats.analyze.tsv'), 'w') as f:
+            for i in range(5000):
+                f.write('NewBins.' + str(i) + '\t' + str(i * 7919 % 10007) + '\t' + str(i * 104729 % 1299709) + '\n')
+        compress_sizes = []
+        for level in [1, 9]:
+            pack_folder(folder, zip_file, level=level)
+            with zipfile.ZipFile(zip_file) as z:
+                compress_sizes.append(z.getinfo('storage/bin_stats.analyze.tsv').compress_size)
+        self.assertLess(compress_sizes[1], compress_sizes[0])
+
+        # level 0 stores everything
+        pack_folder(folder, zip_file, level=0)
+        with zipfile.ZipFile(zip_file) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(set(i.compress_type for i in z.infolist()), set([zipfile.ZIP_STORED]))
+        with self.assertRaises(ValueError):
+            pack_folder(folder, zip_file, level=10)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_file_placer")
+    def test_file_placer(self):
+
+        src = os.path.join(self.scratch, 'file_placer_1.tsv')
+        with open(src, 'w') as f:
+            f.write('NewBins.001\t{}\n')
+        folder = os.path.join(self.scratch, 'file_placer_1')
+
+        placer = FilePlacer()
+        self.assertTrue(placer.place(src, os.path.join(folder, 'storage', 'bin_stats_ext.tsv')))
+        self.assertEqual(os.stat(src).st_ino, os.stat(os.path.join(folder, 'storage', 'bin_stats_ext.tsv')).st_ino)
+        self.assertEqual(placer.linked, 1)
+        self.assertEqual(placer.summary(), '')
+
+        # missing files are collected instead of raised
+        self.assertFalse(placer.place(os.path.join(self.scratch, 'missing.tsv'), os.path.join(folder, 'missing.tsv')))
+        self.assertEqual(len(placer.errors), 1)
+        self.assertIn('missing.tsv', placer.summary())
+
+        # the copy used when a file cannot be linked
+        copy_file(src, os.path.join(folder, 'copy.tsv'))
+        with open(os.path.join(folder, 'copy.tsv')) as f:
+            self.assertEqual(f.read(), 'NewBins.001\t{}\n')
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_scratch_manager")
+    def test_scratch_manager(self):
+
+        scratch_root = os.path.join(self.scratch, 'scratch_manager_1')
+        shutil.rmtree(scratch_root, ignore_errors=True)
+        manager = ScratchManager(scratch_root, quota_bytes=1000, job_reserve_bytes=500)
+
+        job = manager.start_job('job_1')
+        self.assertEqual(job.path, os.path.join(scratch_root, 'jobs', 'job_1'))
+        tetra_file = os.path.join(job.path, 'tetra_1.tsv')
+        with open(tetra_file, 'w') as f:
+            f.write('x' * 600)
+        self.assertEqual(manager.used_bytes(), 600)
+
+        # job_1 and the reserve of a new job do not fit in the quota
+        with self.assertRaises(ScratchQuotaError):
+            manager.start_job('job_2')
+        # but job_1 resumes in its own folder
+        job.finish(keep=True)
+        job = manager.start_job('job_1')
+        self.assertTrue(os.path.isfile(tetra_file))
+
+        self.assertEqual(job.release(tetra_file), 600)
+        self.assertFalse(os.path.exists(tetra_file))
+        job_2 = manager.start_job('job_2')
+        job.finish()
+        self.assertFalse(os.path.exists(job.path))
+        job_2.finish(keep=True)
+        self.assertTrue(os.path.isdir(job_2.path))
+
+        # folders of jobs that were not modified for max_age are removed when a job starts
+        manager.max_age = 3600
+        os.utime(job_2.path, (time.time() - 7200, time.time() - 7200))
+        manager.start_job('job_3')
+        self.assertEqual(os.listdir(manager.jobs_root), ['job_3'])
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_concurrent_jobs")
+    def test_concurrent_jobs(self):
+
+        scratch_root = os.path.join(self.scratch, 'concurrent_jobs_1')
+        shutil.rmtree(scratch_root, ignore_errors=True)
+        manager = ScratchManager(scratch_root, max_jobs=1)
+
+        job = manager.start_job('job_1')
+        job.job_log.stream().write('checkm output\n')
+        # the only job slot is taken, and so is the folder of job_1, also for the other threads
+        with self.assertRaises(ScratchQuotaError):
+            manager.start_job('job_2')
+        manager.max_jobs = 2
+        errors = []
+
+        def start_again():
+            try:
+                manager.start_job('job_1')
+            except ScratchQuotaError as e:
+                errors.append(e)
+        thread = threading.Thread(target=start_again)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+        job.finish()
+        job_2 = manager.start_job('job_2')
+        job_2.finish()
+        with open(manager.log_file('job_1')) as f:
+            self.assertIn('checkm output\n', f.read())
+        self.assertEqual(os.listdir(manager.jobs_root), [])
+
+        # a job that finishes while another is running gives its slot and folder back right away,
+        # the worker processes the jobs share do not hold on to them
+        cfg = dict(self.cfg, scratch=os.path.join(self.scratch, 'concurrent_jobs_2'), max_concurrent_jobs='2',
+                   scratch_wait_minutes='0')
+        first_done = threading.Event()
+        second_started = threading.Event()
+        results = []
+
+        def first_job(job):
+            second_started.wait(10)
+            self.assertEqual(os.path.dirname(cmu_1._write_timings('job_a')), job.path)
+            return 'first'
+
+        def second_job(job):
+            second_started.set()
+            first_done.wait(10)
+            # the pool works for the running job while the other one is done
+            return cmu_2.worker_pool.apply(os.getpid) if cmu_2.worker_pool else 'second'
+
+        cmu_1 = CheckMUtil(cfg)
+        cmu_2 = CheckMUtil(cfg)
+        first = threading.Thread(target=lambda: results.append(cmu_1._run_job('job_a', first_job)))
+        second = threading.Thread(target=lambda: results.append(cmu_2._run_job('job_b', second_job)))
+        first.start()
+        second.start()
+        first.join()
+        try:
+            self.assertEqual(results, ['first'])
+            manager = CheckMUtil(cfg).scratch_manager
+            manager.start_job('job_c').finish()
+            # and job_a could be resumed
+            manager.start_job('job_a').finish()
+            # nothing of the finished job is left outside its log, not even its timings
+            self.assertEqual(sorted(os.listdir(cfg['scratch'])), ['job_slots', 'jobs', 'logs'])
+        finally:
+            first_done.set()
+            second.join()
+        self.assertEqual(len(results), 2)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_client_sessions")
+    def test_client_sessions(self):
+
+        # a service answering every call with the port of the client connection and the cookies
+        # it was sent, and setting a cookie of its own
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                body = json.dumps({'result': [[self.client_address[1], self.headers.get('Cookie')]]})
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Set-Cookie', 'session=' + self.headers['Authorization'] + '; Path=/')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever).start()
+        url = 'http://127.0.0.1:' + str(server.server_address[1])
+        env = dict(os.environ)
+        try:
+            # the connection is kept alive between calls, and shared by the clients of other users,
+            # who never get the cookies set for the first one
+            client_a = baseclient.BaseClient(url, token='user_a', ignore_authrc=True)
+            port, cookie = client_a._call(url, 'Service.method', [])
+            self.assertIsNone(cookie)
+            self.assertEqual(client_a._call(url, 'Service.method', []), [port, None])
+            client_b = baseclient.BaseClient(url, token='user_b', ignore_authrc=True)
+            self.assertEqual(client_b._call(url, 'Service.method', []), [port, None])
+            session = baseclient._get_session(url, 10)
+            self.assertEqual(len(session.cookies), 0)
+
+            # the pool size and keep alive defaults come from the environment
+            os.environ['KB_CLIENT_POOL_SIZE'] = '3'
+            client_c = baseclient.BaseClient(url, token='user_c', ignore_authrc=True)
+            self.assertEqual(client_c.pool_size, 3)
+            self.assertIsNot(baseclient._get_session(url, 3), session)
+            self.assertEqual(baseclient._get_session(url, 3).get_adapter(url)._pool_maxsize, 3)
+            os.environ['KB_CLIENT_KEEP_ALIVE'] = '0'
+            client_d = baseclient.BaseClient(url, token='user_d', ignore_authrc=True)
+            self.assertFalse(client_d.keep_alive)
+            self.assertNotEqual(client_d._call(url, 'Service.method', [])[0], port)
+
+            # a forked process opens sessions of its own, whether or not python resets them at the fork
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0 if baseclient._get_session(url, 10) is not session else 1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertIs(baseclient._get_session(url, 10), session)
+            baseclient._SESSIONS_PID = -1
+            self.assertIsNot(baseclient._get_session(url, 10), session)
+            self.assertEqual(len(baseclient._SESSIONS), 1)
+        finally:
+            os.environ.clear()
+            os.environ.update(env)
+            server.shutdown()
+            server.server_close()
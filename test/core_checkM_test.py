@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import unittest
+import ast
 import os  # noqa: F401
 import json  # noqa: F401
 import time
 import shutil
+import struct
+import zlib
 
 from os import environ
+from multiprocessing import Pool
 try:
     from ConfigParser import ConfigParser  # py2
 except:
@@ -24,7 +28,14 @@ from kb_Msuite.authclient import KBaseAuth as _KBaseAuth
 
 from kb_Msuite.Utils.CheckMUtil import CheckMUtil
 from kb_Msuite.Utils.DataStagingUtils import DataStagingUtils
-from kb_Msuite.Utils.OutputBuilder import OutputBuilder
+from kb_Msuite.Utils.OutputBuilder import OutputBuilder, QA_PLOT_PAGES_FILE
+from kb_Msuite.Utils.BinResultCache import BinResultCache
+from kb_Msuite.Utils.BinStatsTable import parse_stats_value, read_marker_gene_stats, read_stats_table
+from kb_Msuite.Utils.TetraProfiler import compute_tetra_profile
+from kb_Msuite.Utils.PlotImages import PREVIEW_WIDTH, THUMBNAIL_WIDTH, build_plot_images, png_size
+from kb_Msuite.Utils.FastaConcat import (INDEX_COLUMNS, VirtualFasta, concatenate_fasta, fasta_index_path,
+                                         read_fasta_index)
+from kb_Msuite.Utils.BinShards import split_bin_folder, page_bin_folder, merge_lineage_wf_outputs, namespace_bin_folder
 
 
 class CoreCheckMTest(unittest.TestCase):
@@ -165,6 +176,41 @@ class CoreCheckMTest(unittest.TestCase):
         # print('RESULT:')
         # pprint(result)
 
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_checkM_lineage_wf_batch")
+    def test_checkM_lineage_wf_batch(self):
+
+        # run checkM lineage_wf app on a batch of two inputs, in a single CheckM run
+        params = {
+            'workspace_name': self.ws_info[1],
+            'input_refs': [self.assembly_ref1, self.assembly_ref1],
+            'save_output_dir': 0,
+            'save_plots_dir': 1
+        }
+        result = self.getImpl().run_checkM_lineage_wf_batch(self.getContext(), params)[0]
+
+        pprint('End to end batch test result:')
+        pprint(result)
+
+        self.assertIn('report_name', result)
+        self.assertIn('report_ref', result)
+        self.assertEquals([r['input_ref'] for r in result['input_reports']], params['input_refs'])
+
+        # make sure the combined report was created and includes the HTML report and download links
+        rep = self.getWsClient().get_objects2({'objects': [{'ref': result['report_ref']}]})['data'][0]['data']
+
+        self.assertEquals(rep['direct_html_link_index'], 0)
+        self.assertEquals(len(rep['file_links']), 2)
+        self.assertEquals(len(rep['html_links']), 1)
+        self.assertEquals(rep['html_links'][0]['name'], 'report.html')
+
+        # and a report with the HTML summary of every input
+        for input_report in result['input_reports']:
+            rep = self.getWsClient().get_objects2({'objects': [{'ref': input_report['report_ref']}]})['data'][0]['data']
+            self.assertEquals(len(rep['html_links']), 1)
+            self.assertEquals(len(rep['file_links']), 0)
+
+
     # Uncomment to skip this test
     # @unittest.skip("skipped test_data_staging")
     def test_data_staging(self):
@@ -175,7 +221,9 @@ class CoreCheckMTest(unittest.TestCase):
         pprint(staged_input)
 
         self.assertTrue(os.path.isdir(staged_input['input_dir']))
-        self.assertTrue(os.path.isfile(staged_input['all_seq_fasta']))
+        # the concatenated fasta file is only indexed, it is written out when a tool needs it
+        self.assertTrue(VirtualFasta.exists(staged_input['all_seq_fasta']))
+        self.assertTrue(os.path.isfile(staged_input['all_seq_index']))
         self.assertIn('folder_suffix', staged_input)
 
         self.assertTrue(os.path.isfile(os.path.join(staged_input['input_dir'],
@@ -186,6 +234,8 @@ class CoreCheckMTest(unittest.TestCase):
         pprint(staged_input2)
 
         self.assertTrue(os.path.isdir(staged_input2['input_dir']))
+        self.assertTrue(VirtualFasta.exists(staged_input2['all_seq_fasta']))
+        self.assertEqual(VirtualFasta(staged_input2['all_seq_fasta']).materialize(), staged_input2['all_seq_fasta'])
         self.assertTrue(os.path.isfile(staged_input2['all_seq_fasta']))
         self.assertIn('folder_suffix', staged_input2)
 
@@ -194,6 +244,23 @@ class CoreCheckMTest(unittest.TestCase):
         self.assertTrue(os.path.isfile(os.path.join(staged_input2['input_dir'], 'out_header.003.fna')))
 
 
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_staging_cache")
+    def test_staging_cache(self):
+
+        cfg = dict(self.cfg)
+        cfg['staging_cache_dir'] = os.path.join(self.scratch, 'staging_cache_1')
+        dsu = DataStagingUtils(cfg)
+        staged_input = dsu.stage_input(self.binned_contigs_ref1, 'fna')
+        self.assertEqual(len(os.listdir(cfg['staging_cache_dir'])), 2)  # the entry and the lock file
+
+        # the second time around the bins come out of the cache
+        staged_input2 = dsu.stage_input(self.binned_contigs_ref1, 'fna')
+        self.assertEqual(sorted(os.listdir(staged_input['input_dir'])),
+                         sorted(os.listdir(staged_input2['input_dir'])))
+        self.assertTrue(VirtualFasta.exists(staged_input2['all_seq_fasta']))
+
+
     # Uncomment to skip this test
     # @unittest.skip("skipped test_output_plotting")
     def test_output_plotting(self):
@@ -219,6 +286,54 @@ class CoreCheckMTest(unittest.TestCase):
         self.assertEqual(res['name'], 'report.html')
 
 
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_parallel_dist_plot")
+    def test_parallel_dist_plot(self):
+
+        cmu = CheckMUtil(self.cfg)
+        cmu.dist_plot_processes = 2
+        plots_dir = os.path.join(self.scratch, 'plots_parallel_1')
+        tetra_file = os.path.join(self.scratch, 'tetra_parallel_1.tsv')
+
+        cmu.run_tetra(self.all_seq_fasta, tetra_file)
+        cmu.run_dist_plot(self.input_dir, self.output_dir, plots_dir, tetra_file)
+        self.assertTrue(os.path.isfile(os.path.join(plots_dir, 'NewBins.001.ref_dist_plots.png')))
+        self.assertTrue(os.path.isfile(os.path.join(plots_dir, 'NewBins.002.ref_dist_plots.png')))
+        # the chunk folders are removed once their plots are collected
+        self.assertFalse(os.path.exists(plots_dir + '_chunks'))
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_paged_bin_qa_plot")
+    def test_paged_bin_qa_plot(self):
+
+        pages = page_bin_folder(self.input_dir, os.path.join(self.scratch, 'pages_1'), 1)
+        bins = sorted(f[:-len('.fna')] for f in os.listdir(self.input_dir) if f.endswith('.fna'))
+        self.assertEqual([bin_ids for _, bin_ids in pages], [[b] for b in bins])
+
+        cmu = CheckMUtil(self.cfg)
+        cmu.bin_qa_plot_page_size = 1
+        plots_dir = os.path.join(self.scratch, 'plots_paged_1')
+        cmu.run_bin_qa_plot(self.input_dir, self.output_dir, plots_dir)
+        with open(os.path.join(plots_dir, QA_PLOT_PAGES_FILE)) as f:
+            plotted = json.load(f)['pages']
+        self.assertEqual([page['bins'] for page in plotted], [[b] for b in bins])
+        for page in plotted:
+            self.assertTrue(os.path.isfile(os.path.join(plots_dir, page['plot'])))
+        self.assertFalse(os.path.exists(plots_dir + '_pages'))
+
+        # the report shows a thumbnail of each page instead of the single plot
+        html_dir = os.path.join(self.scratch, 'html_paged_1')
+        os.makedirs(html_dir)
+        builder = OutputBuilder(self.output_dir, plots_dir, self.scratch, self.callback_url)
+        with open(os.path.join(html_dir, 'report.html'), 'w') as html:
+            builder._write_qa_plot_pages(html, builder._qa_plot_pages(plots_dir))
+        with open(os.path.join(html_dir, 'report.html')) as html:
+            report = html.read()
+        for page in plotted:
+            self.assertIn('href="' + page['plot'] + '"', report)
+
+
     # Uncomment to skip this test
     # @unittest.skip("skipped test_output_plotting")
     def test_checkM_local_function_wiring(self):
@@ -232,3 +347,350 @@ class CoreCheckMTest(unittest.TestCase):
         }
         self.getImpl().run_checkM(self.getContext(), params)
         os.path.isfile(tetra_file)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_lineage_wf_shards")
+    def test_lineage_wf_shards(self):
+
+        shard_root = os.path.join(self.scratch, 'shards_1')
+        shard_bin_folders = split_bin_folder(self.input_dir, shard_root, 2)
+        self.assertEqual(len(shard_bin_folders), 2)
+        sharded_bins = []
+        for f in shard_bin_folders:
+            sharded_bins.extend(os.listdir(f))
+        self.assertEqual(sorted(sharded_bins),
+                         sorted([f for f in os.listdir(self.input_dir) if f.endswith('.fna')]))
+
+        # fake the output of two lineage_wf runs and merge them
+        shard_out_folders = []
+        for i, bin_id in enumerate(['NewBins.001', 'NewBins.002']):
+            shard_out = os.path.join(shard_root, 'shard_' + str(i), 'output')
+            os.makedirs(os.path.join(shard_out, 'storage'))
+            os.makedirs(os.path.join(shard_out, 'bins', bin_id))
+            with open(os.path.join(shard_out, 'storage', 'bin_stats_ext.tsv'), 'w') as f:
+                f.write(bin_id + '\t{}\n')
+            with open(os.path.join(shard_out, 'lineage.ms'), 'w') as f:
+                f.write('# [Lineage Marker File]\n' + bin_id + '\t1\n')
+            shard_out_folders.append(shard_out)
+
+        merged = os.path.join(self.scratch, 'merged_output_1')
+        merge_lineage_wf_outputs(shard_out_folders, merged)
+        with open(os.path.join(merged, 'storage', 'bin_stats_ext.tsv')) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        with open(os.path.join(merged, 'lineage.ms')) as f:
+            self.assertEqual(len(f.readlines()), 3)
+        self.assertTrue(os.path.isdir(os.path.join(merged, 'bins', 'NewBins.001')))
+        self.assertTrue(os.path.isdir(os.path.join(merged, 'bins', 'NewBins.002')))
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_namespaced_bins")
+    def test_namespaced_bins(self):
+
+        batch_bins = os.path.join(self.scratch, 'bins_batch_1')
+        bin_ids = namespace_bin_folder(self.input_dir, batch_bins, 'input2')
+        input_bins = sorted(f for f in os.listdir(self.input_dir) if f.endswith('.fna'))
+        self.assertEqual(sorted(os.listdir(batch_bins)), ['input2__' + f for f in input_bins])
+        for bin_id in bin_ids:
+            self.assertTrue(bin_id.startswith('input2__'))
+            with open(os.path.join(batch_bins, bin_id + '.fna')) as f:
+                headers = [line for line in f if line.startswith('>')]
+            self.assertTrue(headers)
+            self.assertTrue(all(h.startswith('>input2__') for h in headers))
+
+        # the report of a single input only lists its own bins
+        stats_dir = os.path.join(self.scratch, 'output_batch_1', 'storage')
+        os.makedirs(stats_dir)
+        with open(os.path.join(stats_dir, 'bin_stats_ext.tsv'), 'w') as f:
+            f.write('input1__bin.001\t{}\ninput2__bin.001\t{}\n')
+        html_file = os.path.join(self.scratch, 'batch_summary_1.html')
+        ob = OutputBuilder(os.path.dirname(stats_dir), None, self.scratch, self.callback_url)
+        with open(html_file, 'w') as html:
+            ob.build_summary_table(html, self.scratch, bin_ids=['input2__bin.001'])
+        with open(html_file) as f:
+            table = f.read()
+        self.assertIn('input2__bin.001', table)
+        self.assertNotIn('input1__bin.001', table)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_paginated_report")
+    def test_paginated_report(self):
+
+        html_dir = os.path.join(self.scratch, 'html_paginated_1')
+        os.makedirs(html_dir)
+        stats = read_stats_table(os.path.join(self.output_dir, 'storage', 'bin_stats_ext.tsv'))
+        plotted = stats.bin_ids[0]
+        open(os.path.join(html_dir, plotted + '.ref_dist_plots.png'), 'w').close()
+
+        ob = OutputBuilder(self.output_dir, None, self.scratch, self.callback_url, report_mode='paginated')
+        html_file = os.path.join(html_dir, 'report.html')
+        with open(html_file, 'w') as html:
+            ob._write_summary(html, html_dir)
+        with open(html_file) as f:
+            report = f.read()
+        self.assertIn('summary_table.js', report)
+        self.assertNotIn('<td>', report)
+        for template in ['summary_table.js', 'summary_table.css', 'bin.html']:
+            self.assertTrue(os.path.isfile(os.path.join(html_dir, template)))
+        # no page per bin, the single viewer shows them all
+        self.assertFalse(os.path.isfile(os.path.join(html_dir, plotted + '.html')))
+
+        with open(os.path.join(html_dir, 'summary.json')) as f:
+            summary = json.load(f)
+        fields = [f['id'] for f in summary['fields']]
+        self.assertEqual([row[0] for row in summary['rows']], stats.bin_ids)
+        self.assertEqual([row[1] for row in summary['rows']], [1] + [0] * (len(stats) - 1))
+        completeness = fields.index('Completeness') + 2
+        self.assertEqual(summary['rows'][0][completeness],
+                         round(stats.value('Completeness', 0), 3))
+
+        # auto only paginates large reports
+        auto = OutputBuilder(self.output_dir, None, self.scratch, self.callback_url, report_mode='auto')
+        with open(html_file, 'w') as html:
+            auto._write_summary(html, html_dir, bin_ids=stats.bin_ids[:1])
+        with open(html_file) as f:
+            self.assertIn('<td>', f.read())
+        with self.assertRaises(ValueError):
+            OutputBuilder(self.output_dir, None, self.scratch, self.callback_url, report_mode='pages')
+
+        # the combined report of a batch links every input to a section with the table of its bins
+        batch_html_dir = os.path.join(self.scratch, 'html_paginated_batch_1')
+        os.makedirs(batch_html_dir)
+        inputs = [{'input_ref': '1/2/3', 'bin_ids': stats.bin_ids[:1], 'report_name': 'report_1'},
+                  {'input_ref': '1/4/5', 'bin_ids': stats.bin_ids[1:], 'report_name': 'report_2'}]
+        ob.build_html_output_for_lineage_wf_batch(batch_html_dir, inputs)
+        with open(os.path.join(batch_html_dir, 'report.html')) as f:
+            report = f.read()
+        for n, i in enumerate(inputs):
+            self.assertIn('<a href="#input_' + str(n + 1) + '">' + i['input_ref'] + '</a>', report)
+            self.assertIn('<h3 id="input_' + str(n + 1) + '">', report)
+            with open(os.path.join(batch_html_dir, 'summary_input_' + str(n + 1) + '.json')) as f:
+                self.assertEqual([row[0] for row in json.load(f)['rows']], i['bin_ids'])
+        with open(os.path.join(batch_html_dir, 'summary.json')) as f:
+            self.assertEqual([row[0] for row in json.load(f)['rows']], stats.bin_ids)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_plot_images")
+    def test_plot_images(self):
+
+        def write_png(path, width, height):
+            def chunk(kind, data):
+                return (struct.pack('>I', len(data)) + kind + data +
+                        struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+            rows = b''.join(b'\x00' + b'\xff\x00\x00' * width for _ in range(height))
+            with open(path, 'wb') as f:
+                f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+                        chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+        plots_dir = os.path.join(self.scratch, 'plot_images_1')
+        html_dir = os.path.join(self.scratch, 'html_images_1')
+        os.makedirs(plots_dir)
+        os.makedirs(html_dir)
+        write_png(os.path.join(plots_dir, 'bin_qa_plot.png'), 2400, 600)
+        write_png(os.path.join(plots_dir, 'bin.001.ref_dist_plots.png'), 3000, 1000)
+        write_png(os.path.join(plots_dir, 'bin.002.ref_dist_plots.png'), 200, 100)
+        self.assertEqual(png_size(os.path.join(plots_dir, 'bin_qa_plot.png')), (2400, 600))
+
+        plot_files = [os.path.join(plots_dir, f) for f in sorted(os.listdir(plots_dir))]
+        images = build_plot_images(plot_files, html_dir, processes=2)
+        self.assertEqual(sorted(images), sorted(os.listdir(plots_dir)))
+        self.assertEqual(images['bin_qa_plot.png'], {'full': 'bin_qa_plot.png',
+                                                     'preview': 'bin_qa_plot.preview.png',
+                                                     'thumbnail': 'bin_qa_plot.thumb.png',
+                                                     'resized': True})
+        for name, image in images.items():
+            for version in ['full', 'preview', 'thumbnail']:
+                self.assertTrue(os.path.isfile(os.path.join(html_dir, image[version])))
+        self.assertLessEqual(png_size(os.path.join(html_dir, 'bin_qa_plot.preview.png'))[0], PREVIEW_WIDTH)
+        self.assertLessEqual(png_size(os.path.join(html_dir, 'bin_qa_plot.thumb.png'))[0], THUMBNAIL_WIDTH)
+        # plots that are already small are linked as they are
+        self.assertFalse(images['bin.002.ref_dist_plots.png']['resized'])
+        self.assertEqual(png_size(os.path.join(html_dir, 'bin.002.ref_dist_plots.thumb.png')), (200, 100))
+
+        # the same in a pool started beforehand, as a job does before its stages run
+        pooled_html_dir = os.path.join(self.scratch, 'html_images_2')
+        os.makedirs(pooled_html_dir)
+        pool = Pool(2)
+        try:
+            self.assertEqual(build_plot_images(plot_files, pooled_html_dir, processes=2, pool=pool), images)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(sorted(os.listdir(pooled_html_dir)), sorted(os.listdir(html_dir)))
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_bin_result_cache")
+    def test_bin_result_cache(self):
+
+        cache = BinResultCache(os.path.join(self.scratch, 'bin_cache_1'), 'test_data_version', {'reduced_tree': 1})
+        uncached_dir = os.path.join(self.scratch, 'bins_uncached_1')
+        bin_keys, cached = cache.split_cached_bins(self.input_dir, uncached_dir, 'fna')
+        self.assertEqual(cached, [])
+        self.assertEqual(len(os.listdir(uncached_dir)), len(bin_keys))
+
+        cache.store(self.output_dir, bin_keys)
+        bin_keys, cached = cache.split_cached_bins(self.input_dir, uncached_dir, 'fna')
+        self.assertEqual(sorted(cached), sorted(bin_keys.keys()))
+        self.assertEqual(os.listdir(uncached_dir), [])
+
+        # restoring into an empty folder rebuilds the stats tables read by OutputBuilder
+        restored_dir = os.path.join(self.scratch, 'restored_output_1')
+        cache.restore(restored_dir, bin_keys, cached)
+        with open(os.path.join(restored_dir, 'storage', 'bin_stats_ext.tsv')) as f:
+            self.assertEqual(sorted(line.split('\t')[0] for line in f), sorted(cached))
+        # with the storage files of the run over these bins (eg the reference tree)
+        self.assertEqual(sorted(os.listdir(os.path.join(restored_dir, 'storage'))),
+                         sorted(os.listdir(os.path.join(self.output_dir, 'storage'))))
+
+        # a different option is a different key
+        other = BinResultCache(os.path.join(self.scratch, 'bin_cache_1'), 'test_data_version', {'reduced_tree': 0})
+        self.assertEqual(other.split_cached_bins(self.input_dir, uncached_dir, 'fna')[1], [])
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_bin_stats_table")
+    def test_bin_stats_table(self):
+
+        stats_file = os.path.join(self.output_dir, 'storage', 'bin_stats_ext.tsv')
+        with open(stats_file) as f:
+            expected = [(line.split('\t')[0], ast.literal_eval(line.split('\t')[1])) for line in f if line.strip()]
+
+        table = read_stats_table(stats_file)
+        self.assertEqual(table.bin_ids, [bin_id for bin_id, _ in expected])
+        for i, (bin_id, data) in enumerate(expected):
+            self.assertEqual(table.row(i), data)
+            self.assertEqual(parse_stats_value(repr(data)), data)
+
+        # picking out some fields gives the same values as parsing the whole rows
+        fields = ['marker lineage', '# genomes', 'Completeness', 'Contamination']
+        partial = read_stats_table(stats_file, fields=fields)
+        for i in range(len(table)):
+            self.assertEqual(partial.row(i), dict((f, table.value(f, i)) for f in fields if f in expected[i][1]))
+
+        # filtering and sorting
+        by_completeness = table.sort_by('Completeness', reverse=True)
+        completeness = by_completeness.column('Completeness')
+        self.assertTrue(all(completeness[:-1] >= completeness[1:]))
+        complete = table.filter(table.column('Completeness') >= completeness[0])
+        self.assertEqual(complete.bin_ids, [by_completeness.bin_ids[0]])
+        self.assertEqual(table.select(table.bin_ids[1:]).bin_ids, table.bin_ids[1:])
+
+        markers = read_marker_gene_stats(os.path.join(self.output_dir, 'storage', 'marker_gene_stats.tsv'))
+        self.assertEqual(sorted(markers.bin_ids), sorted(table.bin_ids))
+        self.assertTrue(all(markers.column('# marker hits') >= markers.column('# marker genes')))
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_native_tetra_profile")
+    def test_native_tetra_profile(self):
+
+        # the native engine must write the same file as checkm tetra
+        checkm_tetra_file = os.path.join(self.scratch, 'tetra_checkm_2.tsv')
+        native_tetra_file = os.path.join(self.scratch, 'tetra_native_2.tsv')
+        self.checkm_runner.run_checkM('tetra', {'seq_file': self.all_seq_fasta,
+                                                'tetra_file': checkm_tetra_file,
+                                                'quiet': 1}, dropOutput=True)
+        compute_tetra_profile(self.all_seq_fasta, native_tetra_file, threads=2, chunk_bases=1000)
+
+        def read_lines(tetra_file):
+            with open(tetra_file) as f:
+                return f.readline(), sorted(f.readlines())
+
+        self.assertEqual(read_lines(native_tetra_file), read_lines(checkm_tetra_file))
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_fasta_concat")
+    def test_fasta_concat(self):
+
+        bin_files = sorted(os.path.join(self.input_dir, f) for f in os.listdir(self.input_dir) if f.endswith('.fna'))
+        concat_file = os.path.join(self.scratch, 'all_seq_concat_1.fna')
+        rows = concatenate_fasta(bin_files, concat_file)
+
+        expected = ''
+        for bin_file in bin_files:
+            with open(bin_file) as f:
+                data = f.read()
+            expected += data if data.endswith('\n') else data + '\n'
+        with open(concat_file) as f:
+            concatenated = f.read()
+        self.assertEqual(concatenated, expected)
+
+        # the index points at every contig and has its base composition
+        self.assertEqual(read_fasta_index(fasta_index_path(concat_file)), [dict(zip(INDEX_COLUMNS, r)) for r in rows])
+        self.assertEqual(len(rows), concatenated.count('>'))
+        for contig_id, bin_id, offset, seq_start, seq_end, length, gc, n in rows:
+            self.assertTrue(concatenated[offset:seq_start].startswith('>' + contig_id))
+            seq = concatenated[seq_start:seq_end].replace('\n', '').upper()
+            self.assertEqual(length, len(seq))
+            self.assertEqual(gc, seq.count('G') + seq.count('C'))
+            self.assertEqual(n, seq.count('N'))
+
+        # tetra gives the same result from the index as from parsing the file
+        tetra_file = os.path.join(self.scratch, 'tetra_concat_1.tsv')
+        indexed_tetra_file = os.path.join(self.scratch, 'tetra_concat_indexed_1.tsv')
+        compute_tetra_profile(concat_file, tetra_file)
+        compute_tetra_profile(concat_file, indexed_tetra_file, records=[(r[0], r[3], r[4]) for r in rows])
+        with open(tetra_file) as f1, open(indexed_tetra_file) as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_virtual_fasta")
+    def test_virtual_fasta(self):
+
+        bin_files = sorted(os.path.join(self.input_dir, f) for f in os.listdir(self.input_dir) if f.endswith('.fna'))
+        concat_file = os.path.join(self.scratch, 'all_seq_concat_2.fna')
+        virtual_file = os.path.join(self.scratch, 'all_seq_virtual_2.fna')
+        concatenate_fasta(bin_files, concat_file)
+        view = VirtualFasta.create(bin_files, virtual_file)
+        self.assertFalse(os.path.exists(virtual_file))
+
+        # reads from the view match the concatenated file, also across the end of a bin file
+        with open(concat_file, 'rb') as f:
+            concatenated = f.read()
+        self.assertEqual(view.size, len(concatenated))
+        self.assertEqual(view.read(0, view.size), concatenated)
+        self.assertEqual(view.read(view.files[0]['length'] - 10, 20),
+                         concatenated[view.files[0]['length'] - 10:view.files[0]['length'] + 10])
+
+        # tetra streams from the bin files
+        tetra_file = os.path.join(self.scratch, 'tetra_concat_2.tsv')
+        virtual_tetra_file = os.path.join(self.scratch, 'tetra_virtual_2.tsv')
+        compute_tetra_profile(concat_file, tetra_file)
+        compute_tetra_profile(virtual_file, virtual_tetra_file, file_records=view.file_records())
+        with open(tetra_file) as f1, open(virtual_tetra_file) as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertFalse(os.path.exists(virtual_file))
+
+        # and it is written out on demand
+        view.materialize()
+        with open(virtual_file, 'rb') as f:
+            self.assertEqual(f.read(), concatenated)
+
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_resource_recorder")
+    def test_resource_recorder(self):
+
+        cmu = CheckMUtil(self.cfg)
+        with cmu.recorder.stage('tetra'):
+            cmu.run_checkM('tetra', {'seq_file': self.all_seq_fasta,
+                                     'tetra_file': os.path.join(self.scratch, 'tetra_3.tsv'),
+                                     'quiet': 1}, dropOutput=True)
+
+        timings = cmu.recorder.to_dict()
+        self.assertEqual(timings['stages'][0]['name'], 'tetra')
+        self.assertEqual(timings['stages'][0]['status'], 'ok')
+        self.assertEqual(timings['subprocesses'][0]['stage'], 'tetra')
+        self.assertEqual(timings['subprocesses'][0]['exit_code'], 0)
+        self.assertTrue(timings['subprocesses'][0]['peak_rss_kb'] > 0)
+
+        timings_file = os.path.join(self.scratch, 'timings_3.json')
+        cmu.recorder.write_json(timings_file)
+        with open(timings_file) as f:
+            self.assertEqual(len(json.load(f)['subprocesses']), 1)